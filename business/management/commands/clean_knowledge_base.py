@@ -0,0 +1,32 @@
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+
+from business.models import CleaningStatus, KnowledgeBase
+from business.tasks import enqueue_knowledge_base_cleaning
+
+
+class Command(BaseCommand):
+    help = "Queue knowledge base entries that are still waiting for cleaning, e.g. after a restart"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--status",
+            nargs="+",
+            default=[CleaningStatus.PENDING],
+            choices=CleaningStatus.values,
+            help="Cleaning statuses of the entries to queue, add failed to retry failures",
+        )
+
+    def handle(self, *args, **options):
+        entries = defaultdict(list)
+        for company_id, knowledgebase_id in KnowledgeBase.objects.filter(
+            cleaning_status__in=options["status"]
+        ).values_list("business_id", "knowledgebase_id"):
+            entries[company_id].append(knowledgebase_id)
+
+        for company_id, knowledgebase_ids in entries.items():
+            enqueue_knowledge_base_cleaning(company_id, knowledgebase_ids)
+            self.stdout.write(
+                f"Queued {len(knowledgebase_ids)} knowledge base entries of {company_id}"
+            )
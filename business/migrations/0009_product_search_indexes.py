@@ -0,0 +1,35 @@
+# Generated by Django 4.1.7 on 2026-10-16 23:25
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("business", "0008_knowledgebaseupload_knowledgebase_cleaning_status_and_more"),
+    ]
+
+    operations = [
+        # CREATE EXTENSION needs a superuser and installs pg_trgm in the
+        # first schema of the search path. Create it once as a superuser in
+        # the public schema before migrating (see README), which every
+        # tenant schema sees; this is then a no-op for the app's database user.
+        TrigramExtension(),
+        migrations.AddIndex(
+            model_name="product",
+            index=django.contrib.postgres.indexes.GinIndex(
+                django.contrib.postgres.search.SearchVector(
+                    "name", "sku", "description", config="english"
+                ),
+                name="product_search_vector_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="product",
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=["name"], name="product_name_trgm_idx", opclasses=["gin_trgm_ops"]
+            ),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.1.7 on 2026-10-16 23:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("business", "0009_product_search_indexes"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="CleanedContent",
+            fields=[
+                ("date_created", models.DateTimeField(auto_now_add=True, null=True)),
+                ("last_updated", models.DateTimeField(auto_now=True, null=True)),
+                ("is_deleted", models.BooleanField(default=False)),
+                (
+                    "content_hash",
+                    models.CharField(max_length=64, primary_key=True, serialize=False),
+                ),
+                ("cleaned_data", models.JSONField(default=dict)),
+                ("hits", models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                "abstract": False,
+            },
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 4.1.7 on 2026-10-17 00:15
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("business", "0010_cleanedcontent"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="category",
+            index=django.contrib.postgres.indexes.GinIndex(
+                django.contrib.postgres.search.SearchVector("name", config="english"),
+                name="category_search_vector_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="category",
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=["name"], name="category_name_trgm_idx", opclasses=["gin_trgm_ops"]
+            ),
+        ),
+    ]
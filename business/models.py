@@ -1,6 +1,10 @@
+import hashlib
 import uuid
 
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVector
 from django.db import models
+from django.db.models import Count, Sum
 from django.core.validators import MinValueValidator
 from django.utils import timezone
 from sanusi_backend.classes.base_model import BaseModel
@@ -111,6 +115,37 @@ class EscalationDepartment(BaseModel):
     )
 
 
+class CleaningStatus(models.TextChoices):
+    PENDING = 'pending'
+    PROCESSING = 'processing'
+    DONE = 'done'
+    FAILED = 'failed'
+
+
+class KnowledgeBaseUpload(BaseModel):
+    # A batch of knowledge base entries uploaded together, to follow the
+    # progress of their background cleaning
+    id = models.UUIDField(
+        default=uuid.uuid4, unique=True, db_index=True, primary_key=True
+    )
+    business = models.ForeignKey(
+        Business, on_delete=models.CASCADE, related_name="kb_uploads"
+    )
+    total = models.PositiveIntegerField(default=0)
+
+    def progress(self):
+        counts = dict(
+            self.entries.values_list("cleaning_status")
+            .annotate(count=models.Count("pk"))
+            .order_by()
+        )
+        progress = {status: counts.get(status, 0) for status in CleaningStatus.values}
+        finished = progress[CleaningStatus.DONE] + progress[CleaningStatus.FAILED]
+        progress["finished"] = finished
+        progress["completed"] = finished >= self.total
+        return progress
+
+
 class KnowledgeBase(BaseModel):
     business = models.ForeignKey(
         Business, on_delete=models.CASCADE, related_name="business_kb", db_index=True
@@ -122,6 +157,53 @@ class KnowledgeBase(BaseModel):
     content = models.CharField(max_length=512)
     cleaned_data = models.JSONField(default=dict)
     is_company_description = models.BooleanField(default=False)
+    # cleaned_data is produced by a background job (business.tasks) after
+    # the entry is saved
+    cleaning_status = models.CharField(
+        max_length=20,
+        choices=CleaningStatus.choices,
+        default=CleaningStatus.PENDING,
+        db_index=True,
+    )
+    upload = models.ForeignKey(
+        KnowledgeBaseUpload,
+        on_delete=models.SET_NULL,
+        related_name="entries",
+        null=True,
+        blank=True,
+    )
+
+
+class CleanedContent(BaseModel):
+    """
+    LLM cleaning of a knowledge base content, keyed by the hash of the
+    normalized content and reused for every entry with that content, in
+    any business, instead of cleaning it again.
+    """
+
+    content_hash = models.CharField(max_length=64, primary_key=True)
+    cleaned_data = models.JSONField(default=dict)
+    # cleanings served from here instead of an LLM call
+    hits = models.PositiveIntegerField(default=0)
+
+    @staticmethod
+    def hash_content(content):
+        # only whitespace is normalized, anything else may change the cleaning
+        normalized = " ".join(str(content).split())
+        return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+    @classmethod
+    def stats(cls):
+        totals = cls.objects.aggregate(contents=Count("pk"), saved_calls=Sum("hits"))
+        contents = totals["contents"]
+        saved_calls = totals["saved_calls"] or 0
+        return {
+            "contents": contents,
+            "saved_calls": saved_calls,
+            "dedup_ratio": round(saved_calls / (contents + saved_calls), 3)
+            if contents + saved_calls
+            else 0.0,
+        }
 
 
 class Reply(BaseModel):
@@ -133,6 +215,15 @@ class Reply(BaseModel):
     sentiment = models.CharField(max_length=20)
 
 
+def category_search_vector(prefix=""):
+    """
+    Full-text vector of a category's name, indexed in Category.Meta; queries
+    on products pass prefix="category__" to search their category's name
+    with the same expression, which still hits the index.
+    """
+    return SearchVector(f"{prefix}name", config="english")
+
+
 class Category(BaseModel):
     id = models.UUIDField(
         default=uuid.uuid4, unique=True, db_index=True, primary_key=True
@@ -142,10 +233,24 @@ class Category(BaseModel):
         Business, on_delete=models.CASCADE, related_name="category", db_index=True
     )
 
+    class Meta:
+        indexes = [
+            GinIndex(category_search_vector(), name="category_search_vector_idx"),
+            GinIndex(fields=["name"], opclasses=["gin_trgm_ops"], name="category_name_trgm_idx"),
+        ]
+
     def __str__(self):
         return self.name
 
 
+def product_search_vector():
+    """
+    Full-text vector of a product's name, SKU and description, indexed in
+    Product.Meta; queries must use this same expression to hit the index.
+    """
+    return SearchVector("name", "sku", "description", config="english")
+
+
 class Product(BaseModel):
     id = models.UUIDField(
         default=uuid.uuid4, unique=True, db_index=True, primary_key=True
@@ -162,6 +267,12 @@ class Product(BaseModel):
     )
     bundle = models.JSONField(default=dict)
 
+    class Meta:
+        indexes = [
+            GinIndex(product_search_vector(), name="product_search_vector_idx"),
+            GinIndex(fields=["name"], opclasses=["gin_trgm_ops"], name="product_name_trgm_idx"),
+        ]
+
     def __str__(self):
         return self.name
     
@@ -0,0 +1,326 @@
+import operator
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from functools import reduce
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from django.contrib.postgres.search import SearchQuery, SearchRank, TrigramSimilarity
+from django.db.models import F, Q
+from scipy import sparse
+from sklearn.feature_extraction.text import HashingVectorizer
+
+from .models import Category, Product, category_search_vector, product_search_vector
+
+# text search configuration of product_search_vector
+SEARCH_CONFIG = "english"
+
+
+class CategoryVocabulary:
+    """
+    A business's product categories: names, the list the category prompt
+    offers, in a stable order, and ids, their normalized names mapped to
+    the category ids, to resolve the LLM's pick with a lookup.
+    """
+
+    def __init__(self, categories):
+        self.ids = {}
+        names = []
+        for category_id, name in categories:
+            key = self.normalize(name)
+            if key and key not in self.ids:
+                self.ids[key] = category_id
+                names.append(" ".join(name.split()))
+        self.names = sorted(names, key=str.lower)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @staticmethod
+    def normalize(name):
+        # answers come back as "Shoes.", "'shoes'" or "  Running   shoes"
+        return " ".join(re.sub(r"[^\w\s&-]", " ", str(name)).lower().split())
+
+    def prompt_list(self):
+        return ", ".join(self.names)
+
+    def resolve(self, answer):
+        """Id of the category answer names, or None."""
+        return self.ids.get(self.normalize(answer))
+
+
+def category_vocabulary_key(company_id):
+    return f"business:{company_id}:category_vocabulary"
+
+
+def category_vocabulary(company_id):
+    """
+    The business's CategoryVocabulary, cached until its categories change
+    or for CATEGORY_VOCABULARY_CACHE_TTL seconds at most.
+    """
+    key = category_vocabulary_key(company_id)
+    vocabulary = cache.get(key)
+    if vocabulary is None:
+        vocabulary = CategoryVocabulary(
+            Category.objects.filter(business_id=company_id)
+            .order_by("date_created", "id")
+            .values_list("id", "name")
+        )
+        cache.set(key, vocabulary, settings.CATEGORY_VOCABULARY_CACHE_TTL)
+    return vocabulary
+
+
+def search_products(company_id, keywords, category_id=None, limit=None):
+    """
+    Rank the business's products against keywords.
+
+    Products match when their name, SKU, description or category name
+    contain one of the keywords (stemmed) or their name or category name is
+    similar to them, served by the full-text and trigram indexes on Product
+    and Category. They are ranked by full-text rank plus name similarity, so
+    the cost stays with the matching rows rather than the whole catalog.
+
+    Returns:
+        list: id, name, description and rank of the best limit products.
+    """
+    keywords = [keyword.strip() for keyword in keywords if keyword and keyword.strip()]
+    if not keywords:
+        return []
+    limit = limit or settings.PRODUCT_SEARCH_MAX_RESULTS
+
+    query = reduce(
+        operator.or_,
+        [SearchQuery(keyword, config=SEARCH_CONFIG) for keyword in keywords],
+    )
+    phrase = " ".join(keywords)
+    products = (
+        Product.objects.filter(business_id=company_id)
+        .annotate(
+            search=product_search_vector(),
+            category_search=category_search_vector("category__"),
+        )
+        .filter(
+            Q(search=query)
+            | Q(category_search=query)
+            | Q(name__trigram_similar=phrase)
+            | Q(category__name__trigram_similar=phrase)
+            | Q(sku__in=keywords)
+        )
+    )
+    if category_id:
+        products = products.filter(category_id=category_id)
+
+    return list(
+        products.annotate(
+            rank=SearchRank(F("search"), query)
+            + SearchRank(F("category_search"), query)
+            + TrigramSimilarity("name", phrase)
+        )
+        .order_by("-rank", "name")
+        .values("id", "name", "description", "rank")[:limit]
+    )
+
+
+PRODUCT_FIELDS = ("id", "name", "description", "category_id", "is_deleted", "last_updated")
+
+
+class ProductCatalog:
+    """
+    In-memory snapshot of a business's products for fuzzy name matching.
+
+    Product names are hashed into character trigram vectors, one row of a
+    sparse matrix per product, so a misspelled or plural keyword still
+    shares most of its trigrams with the name and every product is scored
+    in one matrix product. The matrix is kept column-major, so scoring only
+    reads the columns of the keywords' trigrams. The hashing needs no
+    fitted vocabulary, so changed products are appended as new rows and
+    their old rows masked out until the matrix is compacted.
+    """
+
+    vectorizer = HashingVectorizer(
+        analyzer="char_wb",
+        ngram_range=(3, 3),
+        n_features=2**18,
+        alternate_sign=False,
+    )
+
+    def __init__(self):
+        self.products = []
+        self.rows = {}
+        self.alive = np.zeros(0, dtype=bool)
+        self.category_ids = np.zeros(0, dtype=object)
+        self.matrix = sparse.csc_matrix((0, self.vectorizer.n_features))
+        self.watermark = None
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.rows)
+
+    @classmethod
+    def for_business(cls, company_id):
+        catalog = cls()
+        catalog.apply(
+            Product.all_objects.filter(business_id=company_id).values_list(*PRODUCT_FIELDS)
+        )
+        return catalog
+
+    def apply(self, rows):
+        """Add or replace the products read with PRODUCT_FIELDS, dropping deleted ones."""
+        added = []
+        for product_id, name, description, category_id, is_deleted, last_updated in rows:
+            row = self.rows.pop(product_id, None)
+            if row is not None:
+                self.alive[row] = False
+            if last_updated is not None and (self.watermark is None or last_updated > self.watermark):
+                self.watermark = last_updated
+            if not is_deleted:
+                self.rows[product_id] = len(self.products) + len(added)
+                added.append(
+                    {"id": product_id, "name": name, "description": description, "category_id": category_id}
+                )
+        if not added:
+            return
+
+        self.products.extend(added)
+        self.alive = np.concatenate([self.alive, np.ones(len(added), dtype=bool)])
+        self.category_ids = np.concatenate(
+            [self.category_ids, np.array([str(product["category_id"]) for product in added], dtype=object)]
+        )
+        vectors = self.vectorizer.transform([product["name"] for product in added])
+        self.matrix = sparse.vstack([self.matrix, vectors], format="csc")
+        if len(self.products) > 2 * len(self.rows) + 64:
+            self.compact()
+
+    def compact(self):
+        """Drop the rows of replaced and removed products."""
+        live = np.flatnonzero(self.alive)
+        self.products = [self.products[row] for row in live]
+        self.category_ids = self.category_ids[live]
+        self.matrix = self.matrix[live]
+        self.alive = np.ones(len(live), dtype=bool)
+        self.rows = {product["id"]: row for row, product in enumerate(self.products)}
+
+    def refresh(self, company_id):
+        """
+        Apply the business's product changes since the snapshot was taken.
+        Returns False when products were deleted from the database, which
+        only a new snapshot picks up.
+        """
+        changed = Product.all_objects.filter(business_id=company_id)
+        if self.watermark is not None:
+            changed = changed.filter(last_updated__gte=self.watermark)
+        self.apply(changed.values_list(*PRODUCT_FIELDS))
+        return len(self.rows) == Product.objects.filter(business_id=company_id).count()
+
+    def match(self, keywords, category_id=None, limit=None, min_score=None):
+        """
+        Score every product name against keywords.
+
+        Returns:
+            list: id, name, description and score (the best cosine
+            similarity with a keyword) of the best limit products scoring
+            at least min_score, best first.
+        """
+        limit = limit or settings.PRODUCT_SEARCH_MAX_RESULTS
+        min_score = settings.PRODUCT_MATCH_MIN_SCORE if min_score is None else min_score
+        if not keywords or not self.rows:
+            return []
+
+        queries = self.vectorizer.transform(keywords)
+        scores = (queries @ self.matrix.T).toarray().max(axis=0)
+        scores[~self.alive] = 0
+        if category_id:
+            scores[self.category_ids != str(category_id)] = 0
+
+        if len(scores) > limit:
+            top = np.argpartition(-scores, limit)[:limit]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [
+            {
+                "id": self.products[row]["id"],
+                "name": self.products[row]["name"],
+                "description": self.products[row]["description"],
+                "score": float(scores[row]),
+            }
+            for row in top
+            if scores[row] >= min_score and scores[row] > 0
+        ]
+
+
+def product_catalog_version(company_id):
+    """Token that changes whenever one of the business's products changes."""
+    return cache.get_or_set(f"business:{company_id}:catalog_version", uuid.uuid4().hex, None)
+
+
+def bump_product_catalog_version(company_id):
+    cache.set(f"business:{company_id}:catalog_version", uuid.uuid4().hex, None)
+
+
+_catalogs = OrderedDict()
+_catalogs_lock = threading.Lock()
+
+
+def get_product_catalog(company_id):
+    """
+    The business's ProductCatalog, brought up to date with the product
+    changes made since it was last used. Changes made in this process are
+    picked up through product_catalog_version straight away; the others,
+    which the version only reflects with a shared cache, by checking the
+    database at most every PRODUCT_CATALOG_REFRESH_INTERVAL seconds.
+    Catalogs are kept per process for the most recent businesses.
+    """
+    company_id = str(company_id)
+    version = product_catalog_version(company_id)
+    with _catalogs_lock:
+        cached = _catalogs.get(company_id)
+        if cached:
+            _catalogs.move_to_end(company_id)
+    now = time.monotonic()
+    if cached and cached[0] == version and now - cached[1] < settings.PRODUCT_CATALOG_REFRESH_INTERVAL:
+        return cached[2]
+
+    catalog = cached[2] if cached else None
+    if catalog is not None:
+        with catalog.lock:
+            if not catalog.refresh(company_id):
+                catalog = None
+    if catalog is None:
+        catalog = ProductCatalog.for_business(company_id)
+
+    with _catalogs_lock:
+        _catalogs[company_id] = (version, now, catalog)
+        _catalogs.move_to_end(company_id)
+        while len(_catalogs) > settings.PRODUCT_CATALOG_CACHE_SIZE:
+            _catalogs.popitem(last=False)
+    return catalog
+
+
+def match_products(company_id, keywords, category_id=None, limit=None):
+    """
+    Shortlist the business's products whose names are closest to keywords,
+    for when search_products finds no literal match (typos, plurals).
+    """
+    keywords = [keyword.strip() for keyword in keywords if keyword and keyword.strip()]
+    catalog = get_product_catalog(company_id)
+    with catalog.lock:
+        return catalog.match(keywords, category_id=category_id, limit=limit)
+
+
+def decisive_match(products):
+    """
+    The first of the match_products shortlist if it scores high enough and
+    far enough ahead of the runner-up to be picked without asking the LLM.
+    """
+    if not products or "score" not in products[0]:
+        return None
+    best = products[0]["score"]
+    runner_up = products[1]["score"] if len(products) > 1 else 0.0
+    if best >= settings.PRODUCT_MATCH_DECISIVE_SCORE and best - runner_up >= settings.PRODUCT_MATCH_DECISIVE_MARGIN:
+        return products[0]
+    return None
@@ -1,9 +1,17 @@
-import json
 from rest_framework import serializers
 from django.shortcuts import get_object_or_404
-from .models import Business, KnowledgeBase, EscalationDepartment, Product, Category
+from .models import (
+    Business,
+    CleaningStatus,
+    KnowledgeBase,
+    KnowledgeBaseUpload,
+    EscalationDepartment,
+    Product,
+    Category,
+)
 # from business.private.models import KnowledgeBase, EscalationDepartment
-from sanusi.views import generate_response_chat
+from .signals import notify_knowledge_base_changed
+from .tasks import enqueue_knowledge_base_cleaning
 from sanusi_backend.utils.error_handler import ErrorHandler
 from decimal import Decimal, ROUND_HALF_UP
 
@@ -17,8 +25,14 @@ class KnowledgeBaseSerializer(serializers.ModelSerializer):
             "knowledgebase_id",
             "is_company_description",
             "cleaned_data",
+            "cleaning_status",
+            "upload",
         ]
-        extra_kwargs = {"cleaned_data": {"read_only": True}}
+        extra_kwargs = {
+            "cleaned_data": {"read_only": True},
+            "cleaning_status": {"read_only": True},
+            "upload": {"read_only": True},
+        }
 
     def create(self, validated_data):
         title = validated_data["title"]
@@ -29,49 +43,68 @@ class KnowledgeBaseSerializer(serializers.ModelSerializer):
 
         business = get_object_or_404(Business, company_id=company_id)
 
-        prompt = [
-            {
-                "role": "system",
-                "content": "Clean this data into a reusable json content that openai chat can understand and use for response processing later not more than 512 characters",
-            },
-            {
-                "role": "user",
-                "content": f"data to be cleaned {content}",
-            },
-        ]
-        response = generate_response_chat(prompt, 400)
-
-        try:
-            cleaned_data = json.dumps(response["choices"][0]["message"]["content"])
-        except Exception as e:
-            print("An error occurred:", str(e))
-            cleaned_data = response["choices"][0]["message"]["content"]
-
+        # saved right away, cleaned_data is filled in by a background job
         kb = KnowledgeBase.objects.create(
             title=title,
             content=content,
             knowledgebase_id=knowledgebase_id,
             is_company_description=is_company_description,
-            cleaned_data=cleaned_data,
             business=business,
         )
+        enqueue_knowledge_base_cleaning(business.company_id, [kb.knowledgebase_id])
 
         return kb
 
+    def update(self, instance, validated_data):
+        content_changed = validated_data.get("content", instance.content) != instance.content
+        if content_changed:
+            validated_data["cleaning_status"] = CleaningStatus.PENDING
+        instance = super().update(instance, validated_data)
+        if content_changed:
+            enqueue_knowledge_base_cleaning(
+                instance.business_id, [instance.knowledgebase_id]
+            )
+        return instance
+
 
 class BulkCreateKnowledgeBaseSerializer(serializers.ListSerializer):
     child = KnowledgeBaseSerializer()
 
     def create(self, validated_data):
-        knowledge_bases = []
-        for item in validated_data:
-            kb_serializer = KnowledgeBaseSerializer(data=item, context=self.context)
-            if kb_serializer.is_valid():
-                knowledge_base = kb_serializer.save()
-                knowledge_bases.append(knowledge_base)
+        """
+        Save every entry at once as one upload and clean them in the
+        background; the upload's progress is served by the knowledge base
+        uploads/<upload_id> endpoint.
+        """
+        company_id = self.context.get("company_id")
+        business = get_object_or_404(Business, company_id=company_id)
+
+        upload = KnowledgeBaseUpload.objects.create(
+            business=business, total=len(validated_data)
+        )
+        knowledge_bases = KnowledgeBase.objects.bulk_create(
+            [
+                KnowledgeBase(**{**item, "business": business, "upload": upload})
+                for item in validated_data
+            ]
+        )
+        knowledgebase_ids = [kb.knowledgebase_id for kb in knowledge_bases]
+        notify_knowledge_base_changed(business.company_id, knowledgebase_ids)
+        enqueue_knowledge_base_cleaning(business.company_id, knowledgebase_ids)
         return knowledge_bases
 
 
+class KnowledgeBaseUploadSerializer(serializers.ModelSerializer):
+    progress = serializers.SerializerMethodField()
+
+    class Meta:
+        model = KnowledgeBaseUpload
+        fields = ["id", "total", "date_created", "progress"]
+
+    def get_progress(self, upload):
+        return upload.progress()
+
+
 class KnowledgeBaseDeleteSerializer(serializers.Serializer):
     knowledgebase_id = serializers.CharField(required=False, allow_null=True)
 
@@ -0,0 +1,68 @@
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import Signal, receiver
+
+from .models import Category, KnowledgeBase, Product
+from .search import bump_product_catalog_version, category_vocabulary_key
+
+# Sent once the transaction that changed a business's knowledge base commits.
+# Receivers get company_id and knowledgebase_ids, the ids of the entries that
+# were created, updated or deleted, as keyword arguments; knowledgebase_ids is
+# None when the changed entries are not known.
+#
+# post_save/post_delete are forwarded here automatically; code paths that
+# bypass model signals (bulk_create, queryset.update) must send it themselves
+# through notify_knowledge_base_changed.
+knowledge_base_changed = Signal()
+
+
+def notify_knowledge_base_changed(company_id, knowledgebase_ids=None):
+    if knowledgebase_ids is not None:
+        knowledgebase_ids = [str(knowledgebase_id) for knowledgebase_id in knowledgebase_ids]
+    transaction.on_commit(
+        lambda: knowledge_base_changed.send(
+            sender=KnowledgeBase,
+            company_id=str(company_id),
+            knowledgebase_ids=knowledgebase_ids,
+        )
+    )
+
+
+@receiver(post_save, sender=KnowledgeBase)
+@receiver(post_delete, sender=KnowledgeBase)
+def forward_knowledge_base_change(sender, instance, **kwargs):
+    if instance.business_id:
+        notify_knowledge_base_changed(instance.business_id, [instance.pk])
+
+
+@receiver(knowledge_base_changed)
+def invalidate_semantic_cache(sender, company_id, **kwargs):
+    # imported here as it pulls in the embedding vectorizers
+    from sanusi.llm.semantic_cache import semantic_cache
+
+    semantic_cache.invalidate(company_id)
+
+
+@receiver(knowledge_base_changed)
+def update_knowledge_base_index(sender, company_id, knowledgebase_ids=None, **kwargs):
+    # imported here as the tasks pull in the whole LLM layer
+    from .tasks import enqueue_knowledge_base_index_update
+
+    enqueue_knowledge_base_index_update(company_id, knowledgebase_ids)
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def refresh_category_vocabulary(sender, instance, **kwargs):
+    if instance.business_id:
+        key = category_vocabulary_key(instance.business_id)
+        transaction.on_commit(lambda: cache.delete(key))
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def refresh_product_catalog(sender, instance, **kwargs):
+    if instance.business_id:
+        company_id = instance.business_id
+        transaction.on_commit(lambda: bump_product_catalog_version(company_id))
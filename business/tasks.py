@@ -0,0 +1,242 @@
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from celery import shared_task
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import F
+from django.utils import timezone
+from loguru import logger
+
+from sanusi.llm.metrics import company_scope
+from sanusi.llm.ratelimit import max_wait
+from sanusi.llm.retrieval import update_index
+from sanusi.utilities.constants import LLMStage
+from sanusi.utilities.helpers import run_concurrently
+from sanusi.views import generate_response_chat
+
+from .models import CleanedContent, CleaningStatus, KnowledgeBase
+from .signals import notify_knowledge_base_changed
+
+
+def clean_content(content):
+    """
+    Ask the LLM for a compact version of a knowledge base entry.
+
+    Returns:
+        str: The cleaned content as a JSON string, or None if the call failed.
+    """
+    prompt = [
+        {
+            "role": "system",
+            "content": "Clean this data into a reusable json content that openai chat can understand and use for response processing later not more than 512 characters",
+        },
+        {
+            "role": "user",
+            "content": f"data to be cleaned {content}",
+        },
+    ]
+    response = generate_response_chat(prompt, 400, stage=LLMStage.KB_CLEANING)
+    try:
+        return json.dumps(response["choices"][0]["message"]["content"])
+    except (KeyError, IndexError, TypeError):
+        return None
+
+
+def cleaned_content(content):
+    """
+    The cleaning of content from the cleaning store, or from the LLM when
+    no entry with the same content was cleaned before, which is then
+    stored for the next ones.
+
+    Returns:
+        str: The cleaned content as a JSON string, or None if the call failed.
+    """
+    content_hash = CleanedContent.hash_content(content)
+    stored = CleanedContent.objects.filter(content_hash=content_hash)
+    cleaned_data = stored.values_list("cleaned_data", flat=True).first()
+    if cleaned_data is not None:
+        stored.update(hits=F("hits") + 1)
+        return cleaned_data
+
+    cleaned_data = clean_content(content)
+    if cleaned_data is not None:
+        CleanedContent.objects.get_or_create(
+            content_hash=content_hash, defaults={"cleaned_data": cleaned_data}
+        )
+    return cleaned_data
+
+
+def clean_entry(knowledgebase_id):
+    """Clean one knowledge base entry and record the outcome on it."""
+    try:
+        entry = KnowledgeBase.objects.filter(knowledgebase_id=knowledgebase_id).first()
+        if entry is None:
+            return
+        KnowledgeBase.objects.filter(knowledgebase_id=knowledgebase_id).update(
+            cleaning_status=CleaningStatus.PROCESSING
+        )
+
+        cleaned_data = cleaned_content(entry.content)
+        if cleaned_data is None:
+            outcome = {"cleaning_status": CleaningStatus.FAILED}
+        else:
+            outcome = {"cleaned_data": cleaned_data, "cleaning_status": CleaningStatus.DONE}
+        # only written while the entry still has the content that was cleaned,
+        # an edit made in the meantime is kept and cleaned in turn
+        updated = KnowledgeBase.objects.filter(
+            knowledgebase_id=knowledgebase_id, content=entry.content
+        ).update(last_updated=timezone.now(), **outcome)
+        if not updated:
+            logger.info(
+                "Knowledge base entry changed while it was cleaned, cleaning it again",
+                knowledgebase_id=str(knowledgebase_id),
+            )
+            enqueue_knowledge_base_cleaning(entry.business_id, [knowledgebase_id])
+        else:
+            notify_knowledge_base_changed(entry.business_id, [knowledgebase_id])
+    except Exception as e:
+        logger.error(
+            f"Cleaning knowledge base entry failed: {str(e)}",
+            knowledgebase_id=str(knowledgebase_id),
+        )
+        KnowledgeBase.objects.filter(knowledgebase_id=knowledgebase_id).update(
+            cleaning_status=CleaningStatus.FAILED
+        )
+    finally:
+        # runs on a pool thread, whose connections are never reused
+        connections.close_all()
+
+
+@shared_task
+def clean_knowledge_base(company_id, knowledgebase_ids):
+    """
+    Clean the given knowledge base entries of a business, with at most
+    KB_CLEANING_CONCURRENCY cleaning calls in flight. Nobody is waiting on
+    the job, so its calls wait longer than requests for room under the
+    rate limits.
+
+    Only the first entry of each distinct content is cleaned by the LLM,
+    the entries repeating it are served from the cleaning store after.
+    """
+    contents = dict(
+        KnowledgeBase.objects.filter(knowledgebase_id__in=knowledgebase_ids).values_list(
+            "knowledgebase_id", "content"
+        )
+    )
+    first_entries = {}
+    repeated_entries = []
+    for knowledgebase_id, content in contents.items():
+        content_hash = CleanedContent.hash_content(content)
+        if content_hash in first_entries:
+            repeated_entries.append(knowledgebase_id)
+        else:
+            first_entries[content_hash] = knowledgebase_id
+
+    with company_scope(company_id), max_wait(settings.KB_CLEANING_RATELIMIT_WAIT):
+        for batch in (list(first_entries.values()), repeated_entries):
+            run_concurrently(
+                {
+                    knowledgebase_id: partial(clean_entry, knowledgebase_id)
+                    for knowledgebase_id in batch
+                },
+                max_workers=settings.KB_CLEANING_CONCURRENCY,
+            )
+
+
+_local_executors = {}
+_local_executor_lock = threading.Lock()
+
+
+def local_executor(name="jobs"):
+    """
+    Thread pool running the jobs in the web process when no Celery broker
+    is configured, one per name so slow jobs do not hold up the others.
+    Jobs of a pool run one after another, each with its own bounded
+    concurrency.
+    """
+    pid = os.getpid()
+    with _local_executor_lock:
+        executor_pid, executor = _local_executors.get(name, (None, None))
+        if executor is None or executor_pid != pid:
+            executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix=f"sanusi-{name}"
+            )
+            _local_executors[name] = (pid, executor)
+        return executor
+
+
+def enqueue_knowledge_base_cleaning(company_id, knowledgebase_ids):
+    """
+    Clean the entries in the background once the current transaction
+    commits, on a Celery worker when CELERY_BROKER_URL is set and on the
+    local thread pool otherwise.
+    """
+    company_id = str(company_id)
+    knowledgebase_ids = [str(knowledgebase_id) for knowledgebase_id in knowledgebase_ids]
+    if not knowledgebase_ids:
+        return
+
+    def submit():
+        if settings.CELERY_BROKER_URL:
+            clean_knowledge_base.delay(company_id, knowledgebase_ids)
+        else:
+            local_executor().submit(clean_knowledge_base, company_id, knowledgebase_ids)
+
+    transaction.on_commit(submit)
+
+
+@shared_task
+def update_knowledge_base_index(company_id, knowledgebase_ids=None):
+    """
+    Apply changes to knowledge base entries to the business's search index,
+    or rebuild it when knowledgebase_ids is None.
+    """
+    update_index(company_id, knowledgebase_ids)
+
+
+# company_id -> ids of the changed entries not applied to the index yet, or
+# None for a rebuild; only used without a Celery broker
+_pending_index_updates = {}
+_pending_index_updates_lock = threading.Lock()
+
+
+def _run_index_update(company_id):
+    with _pending_index_updates_lock:
+        knowledgebase_ids = _pending_index_updates.pop(company_id)
+    try:
+        update_knowledge_base_index(
+            company_id, None if knowledgebase_ids is None else sorted(knowledgebase_ids)
+        )
+    except Exception as e:
+        logger.error(f"Updating knowledge base index failed: {str(e)}", company_id=company_id)
+    finally:
+        connections.close_all()
+
+
+def enqueue_knowledge_base_index_update(company_id, knowledgebase_ids=None):
+    """
+    Update the business's search index in the background, on a Celery
+    worker when CELERY_BROKER_URL is set and on the local thread pool
+    otherwise, where changes arriving before the update runs are merged
+    into it.
+    """
+    company_id = str(company_id)
+    if knowledgebase_ids is not None:
+        knowledgebase_ids = [str(knowledgebase_id) for knowledgebase_id in knowledgebase_ids]
+    if settings.CELERY_BROKER_URL:
+        update_knowledge_base_index.delay(company_id, knowledgebase_ids)
+        return
+
+    with _pending_index_updates_lock:
+        queued = company_id in _pending_index_updates
+        pending = _pending_index_updates.get(company_id, set())
+        if pending is None or knowledgebase_ids is None:
+            _pending_index_updates[company_id] = None
+        else:
+            _pending_index_updates[company_id] = pending | set(knowledgebase_ids)
+    if not queued:
+        local_executor("index").submit(_run_index_update, company_id)
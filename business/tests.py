@@ -1,3 +1,263 @@
-from django.test import TestCase
+import datetime
+from unittest import mock
 
-# Create your tests here.
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from business import search, tasks
+from business.models import Business, CleanedContent, CleaningStatus, KnowledgeBase, KnowledgeBaseUpload
+from business.search import ProductCatalog, decisive_match
+
+
+def product_row(product_id, name, category_id="shoes", is_deleted=False, minute=0):
+    last_updated = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc) + datetime.timedelta(
+        minutes=minute
+    )
+    return (product_id, name, f"The {name}", category_id, is_deleted, last_updated)
+
+
+def names(products):
+    return [product["name"] for product in products]
+
+
+class ProductCatalogTests(SimpleTestCase):
+    def catalog(self):
+        catalog = ProductCatalog()
+        catalog.apply(
+            [
+                product_row(1, "Red Running Sneakers"),
+                product_row(2, "Leather Boots"),
+                product_row(3, "Wool Socks", category_id="accessories"),
+            ]
+        )
+        return catalog
+
+    def test_matches_misspelled_names(self):
+        self.assertEqual(names(self.catalog().match(["sneekers"], min_score=0.1))[:1], ["Red Running Sneakers"])
+
+    def test_replaced_product_masks_its_old_row(self):
+        catalog = self.catalog()
+        catalog.apply([product_row(1, "Blue Suede Loafers", minute=1)])
+
+        self.assertEqual(len(catalog), 3)
+        self.assertEqual(catalog.alive.tolist(), [False, True, True, True])
+        self.assertNotIn("Red Running Sneakers", names(catalog.match(["sneakers"], min_score=0)))
+        self.assertEqual(names(catalog.match(["loafers"]))[:1], ["Blue Suede Loafers"])
+        self.assertEqual(catalog.watermark.minute, 1)
+
+    def test_deleted_product_masks_its_row(self):
+        catalog = self.catalog()
+        catalog.apply([product_row(2, "Leather Boots", is_deleted=True, minute=1)])
+
+        self.assertEqual(len(catalog), 2)
+        self.assertEqual(catalog.alive.tolist(), [True, False, True])
+        self.assertEqual(catalog.match(["leather boots"]), [])
+
+    def test_compact_drops_masked_rows(self):
+        catalog = self.catalog()
+        catalog.apply([product_row(1, "Blue Suede Loafers"), product_row(2, "Leather Boots", is_deleted=True)])
+        before = catalog.match(["loafers", "socks"], min_score=0)
+        catalog.compact()
+
+        self.assertEqual(catalog.matrix.shape[0], 2)
+        self.assertEqual(catalog.alive.tolist(), [True, True])
+        self.assertEqual(catalog.rows, {3: 0, 1: 1})
+        self.assertEqual(catalog.match(["loafers", "socks"], min_score=0), before)
+
+    def test_match_filters_by_category(self):
+        matches = self.catalog().match(["socks", "boots"], category_id="accessories", min_score=0)
+        self.assertEqual(names(matches), ["Wool Socks"])
+
+
+@override_settings(PRODUCT_MATCH_DECISIVE_SCORE=0.6, PRODUCT_MATCH_DECISIVE_MARGIN=0.2)
+class DecisiveMatchTests(SimpleTestCase):
+    def test_high_score_well_ahead(self):
+        products = [{"name": "a", "score": 0.9}, {"name": "b", "score": 0.5}]
+        self.assertEqual(decisive_match(products), products[0])
+
+    def test_single_high_score(self):
+        products = [{"name": "a", "score": 0.7}]
+        self.assertEqual(decisive_match(products), products[0])
+
+    def test_close_runner_up(self):
+        self.assertIsNone(decisive_match([{"name": "a", "score": 0.9}, {"name": "b", "score": 0.8}]))
+
+    def test_low_score(self):
+        self.assertIsNone(decisive_match([{"name": "a", "score": 0.5}]))
+
+    def test_unscored_or_empty(self):
+        self.assertIsNone(decisive_match([{"name": "a", "rank": 0.9}]))
+        self.assertIsNone(decisive_match([]))
+
+
+@override_settings(PRODUCT_CATALOG_REFRESH_INTERVAL=30)
+class GetProductCatalogTests(SimpleTestCase):
+    def setUp(self):
+        search._catalogs.clear()
+        patches = [
+            mock.patch.object(search, "product_catalog_version", return_value="v1"),
+            mock.patch.object(ProductCatalog, "for_business", side_effect=lambda company_id: ProductCatalog()),
+            mock.patch.object(ProductCatalog, "refresh", return_value=True),
+            mock.patch.object(search.time, "monotonic", return_value=100.0),
+        ]
+        self.version, self.for_business, self.refresh, self.monotonic = [patch.start() for patch in patches]
+        for patch in patches:
+            self.addCleanup(patch.stop)
+        self.addCleanup(search._catalogs.clear)
+
+    def test_reused_within_the_refresh_interval(self):
+        catalog = search.get_product_catalog("company")
+        self.monotonic.return_value = 120.0
+        self.assertIs(search.get_product_catalog("company"), catalog)
+        self.refresh.assert_not_called()
+
+    def test_refreshed_after_the_interval_with_an_unchanged_version(self):
+        catalog = search.get_product_catalog("company")
+        self.monotonic.return_value = 131.0
+        self.assertIs(search.get_product_catalog("company"), catalog)
+        self.refresh.assert_called_once_with("company")
+
+    def test_refreshed_when_the_version_changes(self):
+        catalog = search.get_product_catalog("company")
+        self.version.return_value = "v2"
+        self.assertIs(search.get_product_catalog("company"), catalog)
+        self.refresh.assert_called_once_with("company")
+
+    def test_rebuilt_after_hard_deletes(self):
+        catalog = search.get_product_catalog("company")
+        self.monotonic.return_value = 131.0
+        self.refresh.return_value = False
+        self.assertIsNot(search.get_product_catalog("company"), catalog)
+        self.assertEqual(self.for_business.call_count, 2)
+
+
+def run_inline(calls, **kwargs):
+    return {name: call() for name, call in calls.items()}
+
+
+class KnowledgeBaseCleaningTests(TestCase):
+    def setUp(self):
+        self.business = Business.objects.create(name="Acme")
+        patches = [
+            mock.patch.object(tasks, "clean_content", return_value='"cleaned"'),
+            # the entries are not committed, so the pool threads would not see them
+            mock.patch.object(tasks, "run_concurrently", side_effect=run_inline),
+            # closing them would end the test's transaction
+            mock.patch.object(tasks, "connections"),
+            mock.patch.object(tasks, "enqueue_knowledge_base_cleaning"),
+        ]
+        self.clean_content, _, _, self.enqueue = [patch.start() for patch in patches]
+        for patch in patches:
+            self.addCleanup(patch.stop)
+
+    def entry(self, content="Refunds take 5 days.", **kwargs):
+        return KnowledgeBase.objects.create(business=self.business, title="Returns", content=content, **kwargs)
+
+    def test_cleaned_entry_is_done(self):
+        entry = self.entry()
+        tasks.clean_knowledge_base(str(self.business.pk), [str(entry.pk)])
+
+        entry.refresh_from_db()
+        self.assertEqual(entry.cleaning_status, CleaningStatus.DONE)
+        self.assertEqual(entry.cleaned_data, '"cleaned"')
+        self.enqueue.assert_not_called()
+
+    def test_failed_cleaning_is_recorded(self):
+        self.clean_content.return_value = None
+        entry = self.entry()
+        tasks.clean_entry(entry.pk)
+
+        entry.refresh_from_db()
+        self.assertEqual(entry.cleaning_status, CleaningStatus.FAILED)
+        self.assertEqual(entry.cleaned_data, {})
+
+    def test_entry_edited_while_cleaned_is_cleaned_again(self):
+        entry = self.entry()
+
+        def edit(content):
+            KnowledgeBase.objects.filter(pk=entry.pk).update(content="Refunds take 10 days.")
+            return '"cleaned"'
+
+        self.clean_content.side_effect = edit
+        tasks.clean_entry(entry.pk)
+
+        entry.refresh_from_db()
+        self.assertEqual(entry.content, "Refunds take 10 days.")
+        self.assertEqual(entry.cleaned_data, {})
+        self.assertEqual(entry.cleaning_status, CleaningStatus.PROCESSING)
+        self.enqueue.assert_called_once_with(self.business.pk, [entry.pk])
+
+    def test_identical_entries_are_cleaned_once(self):
+        first = self.entry()
+        repeated = [self.entry(), self.entry(" Refunds take  5 days.\n")]
+        tasks.clean_knowledge_base(str(self.business.pk), [str(entry.pk) for entry in [first, *repeated]])
+
+        self.clean_content.assert_called_once_with("Refunds take 5 days.")
+        for entry in [first, *repeated]:
+            entry.refresh_from_db()
+            self.assertEqual(entry.cleaning_status, CleaningStatus.DONE)
+            self.assertEqual(entry.cleaned_data, '"cleaned"')
+        self.assertEqual(CleanedContent.stats(), {"contents": 1, "saved_calls": 2, "dedup_ratio": 0.667})
+
+    def test_edit_made_while_the_content_is_cleaned_is_kept(self):
+        entry = self.entry()
+
+        def edit(content):
+            KnowledgeBase.objects.filter(pk=entry.pk).update(content="Refunds take 10 days.")
+            return '"cleaned"'
+
+        self.clean_content.side_effect = edit
+        tasks.clean_entry(entry.pk)
+
+        entry.refresh_from_db()
+        self.assertEqual(entry.content, "Refunds take 10 days.")
+        self.assertEqual(entry.cleaned_data, {})
+        # the cleaning is stored for the content it was made from
+        self.assertEqual(tasks.cleaned_content("Refunds take 5 days."), '"cleaned"')
+        self.assertFalse(
+            CleanedContent.objects.filter(content_hash=CleanedContent.hash_content(entry.content)).exists()
+        )
+        self.assertEqual(self.clean_content.call_count, 1)
+
+    def test_upload_progress_counts_the_entries(self):
+        upload = KnowledgeBaseUpload.objects.create(business=self.business, total=3)
+        for status in (CleaningStatus.DONE, CleaningStatus.FAILED, CleaningStatus.PENDING):
+            self.entry(upload=upload, cleaning_status=status)
+
+        progress = upload.progress()
+        self.assertEqual(progress[CleaningStatus.DONE], 1)
+        self.assertEqual(progress[CleaningStatus.FAILED], 1)
+        self.assertEqual(progress[CleaningStatus.PENDING], 1)
+        self.assertEqual(progress[CleaningStatus.PROCESSING], 0)
+        self.assertEqual(progress["finished"], 2)
+        self.assertFalse(progress["completed"])
+
+        KnowledgeBase.objects.filter(upload=upload).update(cleaning_status=CleaningStatus.DONE)
+        self.assertTrue(upload.progress()["completed"])
+
+
+class EnqueueKnowledgeBaseCleaningTests(TestCase):
+    @override_settings(CELERY_BROKER_URL="")
+    def test_runs_on_the_local_executor_without_a_broker(self):
+        executor = mock.Mock()
+        with mock.patch.object(tasks, "local_executor", return_value=executor), self.captureOnCommitCallbacks(
+            execute=True
+        ) as callbacks:
+            tasks.enqueue_knowledge_base_cleaning(1, [2, 3])
+            executor.submit.assert_not_called()
+
+        self.assertEqual(len(callbacks), 1)
+        executor.submit.assert_called_once_with(tasks.clean_knowledge_base, "1", ["2", "3"])
+
+    @override_settings(CELERY_BROKER_URL="redis://broker")
+    def test_runs_on_celery_with_a_broker(self):
+        with mock.patch.object(tasks.clean_knowledge_base, "delay") as delay, mock.patch.object(
+            tasks, "local_executor"
+        ) as local_executor, self.captureOnCommitCallbacks(execute=True):
+            tasks.enqueue_knowledge_base_cleaning(1, [2])
+
+        delay.assert_called_once_with("1", ["2"])
+        local_executor.assert_not_called()
+
+    def test_local_executor_is_reused_per_name(self):
+        self.assertIs(tasks.local_executor("jobs"), tasks.local_executor("jobs"))
+        self.assertIsNot(tasks.local_executor("jobs"), tasks.local_executor("index"))
@@ -1,9 +1,11 @@
 import hashlib
 
+from django.conf import settings
 from django.shortcuts import get_object_or_404
 from django.db import transaction, models
 from django.core.exceptions import ObjectDoesNotExist
 from django.db.models import Case, When
+from django.utils import timezone
 from loguru import logger
 
 
@@ -18,17 +20,28 @@ from drf_yasg import openapi
 from django_filters import FilterSet, NumberFilter
 import django_filters
 
+from sanusi.llm.retrieval import search_knowledge_base
 from sanusi_backend.decorators.telemetry import with_telemetry
 from sanusi_backend.utils.error_handler import ErrorHandler, LogicException
 
-from .models import Business, Product, Category
-from business.private.models import KnowledgeBase, EscalationDepartment
+from .models import (
+    Business,
+    CleaningStatus,
+    EscalationDepartment,
+    KnowledgeBase,
+    KnowledgeBaseUpload,
+    Product,
+    Category,
+)
+from .signals import notify_knowledge_base_changed
+from .tasks import enqueue_knowledge_base_cleaning
 from .serializers import (
     BulkCreateKnowledgeBaseSerializer,
     BusinessSerializer,
     KnowledgeBaseBulkUpdateSerializer,
     KnowledgeBaseDeleteSerializer,
     KnowledgeBaseSerializer,
+    KnowledgeBaseUploadSerializer,
     SanusiBusinessCreateSerializer,
     InventorySerializer,
     CategorySerializer
@@ -263,6 +276,49 @@ class KnowledgeBaseViewSet(
         serializer = self.get_serializer(instance)
         return Response(serializer.data)
 
+    @swagger_auto_schema(
+        manual_parameters=[
+            openapi.Parameter(
+                "q",
+                openapi.IN_QUERY,
+                description="Search query",
+                type=openapi.TYPE_STRING,
+                required=True,
+            ),
+            openapi.Parameter(
+                "top_k",
+                openapi.IN_QUERY,
+                description="Number of entries to return",
+                type=openapi.TYPE_INTEGER,
+            ),
+        ]
+    )
+    @action(detail=False, methods=["get"], url_path="search")
+    def search(self, request, *args, **kwargs):
+        """
+        Search the business's knowledge base, best matches first.
+        """
+        business = get_object_or_404(Business, company_id=self.kwargs.get("company_id"))
+        query = request.query_params.get("q", "").strip()
+        if not query:
+            raise ValidationError({"q": "This query parameter is required."})
+        try:
+            top_k = int(request.query_params.get("top_k", settings.KB_RETRIEVAL_TOP_K))
+        except ValueError:
+            raise ValidationError({"top_k": "A valid integer is required."})
+        top_k = min(max(top_k, 1), settings.KB_SEARCH_MAX_RESULTS)
+
+        results = search_knowledge_base(business.company_id, query, top_k)
+        return Response(
+            {
+                "query": query,
+                "results": [
+                    {"knowledgebase_id": knowledgebase_id, "score": round(score, 4)}
+                    for knowledgebase_id, score in results
+                ],
+            }
+        )
+
     @swagger_auto_schema(request_body=no_body)
     @action(
         detail=False,
@@ -284,6 +340,10 @@ class KnowledgeBaseViewSet(
         serializer_class=BulkCreateKnowledgeBaseSerializer,
     )
     def bulk_create(self, request, *args, **kwargs):
+        """
+        Create many knowledge bases at once. Entries are saved as pending and
+        cleaned in the background; follow them with the uploads endpoint.
+        """
         business_id = self.kwargs.get("company_id")
         business = Business.objects.get(company_id=business_id)
         serializer = self.get_serializer(data=request.data)
@@ -294,6 +354,23 @@ class KnowledgeBaseViewSet(
             serializer.data, status=status.HTTP_201_CREATED, headers=headers
         )
 
+    @swagger_auto_schema(responses={200: KnowledgeBaseUploadSerializer})
+    @action(
+        detail=False,
+        methods=["get"],
+        url_path="uploads/(?P<upload_id>[^/.]+)",
+    )
+    def upload_status(self, request, *args, **kwargs):
+        """
+        Cleaning progress of the entries of a bulk upload.
+        """
+        upload = get_object_or_404(
+            KnowledgeBaseUpload,
+            id=self.kwargs["upload_id"],
+            business_id=self.kwargs.get("company_id"),
+        )
+        return Response(KnowledgeBaseUploadSerializer(upload).data)
+
     @action(
         detail=False,
         methods=["put"],
@@ -331,10 +408,29 @@ class KnowledgeBaseViewSet(
             for knowledgebase_id, value in knowledgebase_updates.items()
         ]
 
+        current_contents = dict(
+            KnowledgeBase.objects.filter(
+                knowledgebase_id__in=knowledgebase_ids
+            ).values_list("knowledgebase_id", "content")
+        )
+        changed_ids = [
+            knowledgebase_id
+            for knowledgebase_id, value in knowledgebase_updates.items()
+            if current_contents.get(knowledgebase_id) != value["content"]
+        ]
+
         KnowledgeBase.objects.filter(knowledgebase_id__in=knowledgebase_ids).update(
             title=Case(*whens_title, output_field=models.CharField()),
             content=Case(*whens_content, output_field=models.TextField()),
+            # update() skips auto_now, the search indexes go by last_updated
+            last_updated=timezone.now(),
+        )
+        # entries whose content changed need cleaning again
+        KnowledgeBase.objects.filter(knowledgebase_id__in=changed_ids).update(
+            cleaning_status=CleaningStatus.PENDING
         )
+        notify_knowledge_base_changed(self.kwargs.get("company_id"), knowledgebase_ids)
+        enqueue_knowledge_base_cleaning(self.kwargs.get("company_id"), changed_ids)
 
         return Response(serializer.data, status=status.HTTP_200_OK)
 
@@ -377,6 +473,9 @@ class SanusiBusinessViewSet(mixins.CreateModelMixin, viewsets.GenericViewSet):
             for knowledge_base in knowledge_bases
         ]
         KnowledgeBase.objects.bulk_create(knowledge_base_instances)
+        knowledgebase_ids = [kb.knowledgebase_id for kb in knowledge_base_instances]
+        notify_knowledge_base_changed(business.company_id, knowledgebase_ids)
+        enqueue_knowledge_base_cleaning(business.company_id, knowledgebase_ids)
 
         # Create EscalationDepartment instances
         department_instances = [
@@ -0,0 +1,273 @@
+import hashlib
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, wait
+from contextvars import copy_context
+
+from django.core.cache import caches
+from django.db import connections
+from loguru import logger
+from opentelemetry import trace
+from opentelemetry.trace import Status, StatusCode
+
+from sanusi.utilities.helpers import STEAL_AFTER, call_executor, in_call_executor
+
+tracer = trace.get_tracer(__name__)
+
+
+class StopPipeline(Exception):
+    """
+    Raised by a stage to end its pipeline early with result, e.g. an answer
+    served from a cache. Stages still running are abandoned.
+    """
+
+    def __init__(self, result):
+        super().__init__("pipeline stopped")
+        self.result = result
+        self.stage = None
+        self.duration = None
+
+
+class Stage:
+    """
+    One step of a Pipeline.
+
+    fn(context) gets the pipeline inputs and the values of the stages that
+    ran before it, and its return value is stored in the context under name.
+    The stage starts as soon as every stage named in after has finished.
+    Stages run on the shared call_executor pool unless inline is set; inline
+    stages run on the calling thread, so the ones touching the database
+    share the request's connection and transaction. With cache_key, the
+    stage's value is cached for the TTL its pipeline configures for it,
+    under cache_key(context).
+    """
+
+    def __init__(self, name, fn, after=(), inline=False, cache_key=None):
+        self.name = name
+        self.fn = fn
+        self.after = tuple(after)
+        self.inline = inline
+        self.cache_key = cache_key
+
+
+class PipelineRun:
+    """Outcome of one Pipeline.run: its context, result and stage timings."""
+
+    def __init__(self, pipeline, context):
+        self.pipeline = pipeline
+        self.context = context
+        self.result = None
+        self.timings = {}
+        self.cached = set()
+        self.started = time.perf_counter()
+        self.duration = None
+
+    def server_timing(self):
+        """The stage timings as a Server-Timing header value."""
+        return ", ".join(
+            f"{name};dur={duration * 1000:.1f}" + (';desc="cached"' if name in self.cached else "")
+            for name, duration in self.timings.items()
+        )
+
+
+class PipelineMetrics:
+    """Stage timings and cache hits of the pipelines run by this process."""
+
+    def __init__(self):
+        self._totals = defaultdict(lambda: defaultdict(float))
+        self._lock = threading.Lock()
+
+    def record(self, pipeline, stage, duration, cached=False, failed=False):
+        with self._lock:
+            totals = self._totals[(pipeline, stage)]
+            totals["runs"] += 1
+            totals["cache_hits"] += int(cached)
+            totals["errors"] += int(failed)
+            totals["duration"] += duration
+            totals["max_duration"] = max(totals["max_duration"], duration)
+
+    def stats(self):
+        with self._lock:
+            totals = {key: dict(counters) for key, counters in self._totals.items()}
+
+        pipelines = defaultdict(dict)
+        for (pipeline, stage), counters in sorted(totals.items()):
+            runs = int(counters["runs"])
+            pipelines[pipeline][stage] = {
+                "runs": runs,
+                "cache_hits": int(counters["cache_hits"]),
+                "errors": int(counters["errors"]),
+                "avg_duration_ms": round(counters["duration"] * 1000 / runs, 1),
+                "max_duration_ms": round(counters["max_duration"] * 1000, 1),
+            }
+        return dict(pipelines)
+
+
+pipeline_metrics = PipelineMetrics()
+
+
+class Pipeline:
+    """
+    A DAG of stages run with as much parallelism as their dependencies allow.
+
+    Every stage is timed, traced as a span and recorded in pipeline_metrics;
+    a stage listed in cache_ttls (stage name -> seconds) that declares a
+    cache key is served from the cache_alias Django cache when it can be.
+    The run's result is the value of the output stage, or what a stage
+    raised StopPipeline with.
+    """
+
+    key_prefix = "pipeline"
+
+    def __init__(self, name, stages, output, cache_ttls=None, cache_alias="default"):
+        self.name = name
+        self.stages = list(stages)
+        self.output = output
+        self.cache_ttls = cache_ttls or {}
+        self.cache_alias = cache_alias
+        self._check()
+
+    def _check(self):
+        names = set()
+        for stage in self.stages:
+            if stage.name in names:
+                raise ValueError(f"Pipeline {self.name}: duplicate stage {stage.name!r}")
+            missing = [name for name in stage.after if name not in names]
+            if missing:
+                # stages are declared in dependency order, which also rules out cycles
+                raise ValueError(
+                    f"Pipeline {self.name}: stage {stage.name!r} runs after undeclared {missing}"
+                )
+            names.add(stage.name)
+        if self.output not in names:
+            raise ValueError(f"Pipeline {self.name}: unknown output stage {self.output!r}")
+
+    def run(self, **inputs):
+        """Run every stage on inputs and return the PipelineRun."""
+        run = PipelineRun(self, dict(inputs))
+        pending = list(self.stages)
+        done = set()
+        running = {}
+        # a run from a call_executor worker runs the stages no worker has
+        # started on itself, like a nested run_concurrently batch
+        nested = in_call_executor()
+
+        try:
+            while pending or running:
+                ready = [stage for stage in pending if set(stage.after) <= done]
+                if ready:
+                    pending = [stage for stage in pending if stage not in ready]
+                    pooled = [stage for stage in ready if not stage.inline]
+                    if len(ready) == 1 and not running:
+                        pooled = []  # nothing to overlap with, skip the thread hop
+                    for stage in pooled:
+                        future = call_executor().submit(
+                            copy_context().run, self._execute, stage, run.context, True
+                        )
+                        running[future] = stage
+                    for stage in ready:
+                        if stage not in pooled:
+                            self._finish(run, stage, *self._execute(stage, run.context))
+                            done.add(stage.name)
+                    continue
+
+                finished, _ = wait(
+                    running,
+                    timeout=STEAL_AFTER if nested else None,
+                    return_when=FIRST_COMPLETED,
+                )
+                for future in finished:
+                    stage = running.pop(future)
+                    self._finish(run, stage, *future.result())
+                    done.add(stage.name)
+                if not finished:
+                    for future, stage in list(running.items()):
+                        if future.cancel():
+                            del running[future]
+                            self._finish(run, stage, *self._execute(stage, run.context))
+                            done.add(stage.name)
+                            break
+
+            run.result = run.context[self.output]
+        except StopPipeline as stop:
+            run.result = stop.result
+            run.timings[stop.stage] = stop.duration
+        finally:
+            # never block the caller on abandoned stages, the started ones
+            # finish in the background
+            for future in running:
+                future.cancel()
+            run.duration = time.perf_counter() - run.started
+            logger.info(
+                "Pipeline run",
+                pipeline=self.name,
+                duration_ms=round(run.duration * 1000, 1),
+                stages={name: round(value * 1000, 1) for name, value in run.timings.items()},
+                cached=sorted(run.cached),
+            )
+        return run
+
+    def _finish(self, run, stage, value, duration, cached):
+        run.context[stage.name] = value
+        run.timings[stage.name] = duration
+        if cached:
+            run.cached.add(stage.name)
+
+    def _execute(self, stage, context, pooled=False):
+        """Run one stage; returns its value, duration and whether it was cached."""
+        started = time.perf_counter()
+        cached = False
+        failed = False
+        with tracer.start_as_current_span(
+            f"stage.{stage.name}",
+            attributes={"pipeline": self.name},
+            record_exception=False,
+            set_status_on_exception=False,
+        ) as span:
+            try:
+                key = self._cache_key(stage, context)
+                value = self._cache_get(key) if key else None
+                cached = value is not None
+                if not cached:
+                    value = stage.fn(context)
+                    if key and value is not None:
+                        self._cache_set(key, value, self.cache_ttls[stage.name])
+                span.set_attribute("stage.cached", cached)
+                return value, time.perf_counter() - started, cached
+            except StopPipeline as stop:
+                span.set_attribute("stage.stopped", True)
+                stop.stage = stage.name
+                stop.duration = time.perf_counter() - started
+                raise
+            except Exception as e:
+                failed = True
+                span.record_exception(e)
+                span.set_status(Status(StatusCode.ERROR, type(e).__name__))
+                raise
+            finally:
+                pipeline_metrics.record(
+                    self.name, stage.name, time.perf_counter() - started, cached, failed
+                )
+                if pooled:
+                    # pool threads are never reused by a request, close what they opened
+                    connections.close_all()
+
+    def _cache_key(self, stage, context):
+        if stage.cache_key is None or not self.cache_ttls.get(stage.name):
+            return None
+        digest = hashlib.sha256(str(stage.cache_key(context)).encode("utf-8")).hexdigest()
+        return f"{self.key_prefix}:{self.name}:{stage.name}:{digest}"
+
+    def _cache_get(self, key):
+        try:
+            return caches[self.cache_alias].get(key)
+        except Exception as e:
+            logger.warning(f"Pipeline stage cache read failed: {str(e)}")
+            return None
+
+    def _cache_set(self, key, value, ttl):
+        try:
+            caches[self.cache_alias].set(key, value, ttl)
+        except Exception as e:
+            logger.warning(f"Pipeline stage cache write failed: {str(e)}")
@@ -1,3 +1,158 @@
-from django.test import TestCase
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
 
-# Create your tests here.
+from django.core.cache import cache
+from django.test import SimpleTestCase
+
+from chat import pipeline as pipeline_module
+from chat.pipeline import Pipeline, Stage, StopPipeline
+from chat.views import build_chat_prompts, chat_pipeline
+
+
+def recording(name, log, value=None, delay=0):
+    def fn(context):
+        if delay:
+            time.sleep(delay)
+        log.append(name)
+        return value if value is not None else name
+
+    return fn
+
+
+class PipelineTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_stages_run_after_their_dependencies(self):
+        log = []
+        pipeline = Pipeline(
+            "test",
+            [
+                Stage("a", recording("a", log, delay=0.05)),
+                Stage("b", recording("b", log), after=["a"]),
+                Stage("c", recording("c", log), after=["a"]),
+                Stage("d", lambda context: context["b"] + context["c"], after=["b", "c"], inline=True),
+            ],
+            output="d",
+        )
+        run = pipeline.run()
+
+        self.assertEqual(run.result, "bc")
+        self.assertEqual(log[0], "a")
+        self.assertCountEqual(log[1:], ["b", "c"])
+        self.assertEqual(set(run.timings), {"a", "b", "c", "d"})
+
+    def test_independent_stages_overlap(self):
+        barrier = threading.Barrier(2, timeout=2)
+
+        def meet(context):
+            # both stages must be running at once to get past the barrier
+            barrier.wait()
+            return True
+
+        pipeline = Pipeline(
+            "test",
+            [
+                Stage("a", meet),
+                Stage("b", meet),
+                Stage("both", lambda context: context["a"] and context["b"], after=["a", "b"]),
+            ],
+            output="both",
+        )
+        self.assertTrue(pipeline.run().result)
+
+    def test_inputs_are_in_the_context(self):
+        pipeline = Pipeline("test", [Stage("echo", lambda context: context["message"] * 2)], output="echo")
+        self.assertEqual(pipeline.run(message="hi").result, "hihi")
+
+    def test_stop_pipeline_skips_the_remaining_stages(self):
+        log = []
+
+        def stop(context):
+            raise StopPipeline("cached answer")
+
+        pipeline = Pipeline(
+            "test",
+            [
+                Stage("first", recording("first", log), inline=True),
+                Stage("stop", stop, after=["first"], inline=True),
+                Stage("last", recording("last", log), after=["stop"]),
+            ],
+            output="last",
+        )
+        run = pipeline.run()
+
+        self.assertEqual(run.result, "cached answer")
+        self.assertEqual(log, ["first"])
+        self.assertIn("stop", run.timings)
+        self.assertNotIn("last", run.timings)
+
+    def test_stage_errors_are_raised(self):
+        def fail(context):
+            raise ValueError("broken")
+
+        pipeline = Pipeline("test", [Stage("fail", fail)], output="fail")
+        with self.assertRaises(ValueError):
+            pipeline.run()
+
+    def test_cached_stage_is_served_from_the_cache(self):
+        log = []
+        pipeline = Pipeline(
+            "test",
+            [Stage("slow", recording("slow", log), cache_key=lambda context: context["message"])],
+            output="slow",
+            cache_ttls={"slow": 60},
+        )
+        pipeline.run(message="hi")
+        run = pipeline.run(message="hi")
+        pipeline.run(message="other")
+
+        self.assertEqual(run.result, "slow")
+        self.assertEqual(run.cached, {"slow"})
+        self.assertEqual(log, ["slow", "slow"])
+
+    def test_run_from_a_saturated_pool_does_not_deadlock(self):
+        pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sanusi-call")
+        self.addCleanup(pool.shutdown)
+        pipeline = Pipeline(
+            "test",
+            [
+                Stage("a", lambda context: 1),
+                Stage("b", lambda context: 2),
+                Stage("sum", lambda context: context["a"] + context["b"], after=["a", "b"]),
+            ],
+            output="sum",
+        )
+        with mock.patch.object(pipeline_module, "call_executor", return_value=pool):
+            # the only worker runs a pipeline whose stages need a worker too
+            outer = pool.submit(lambda: pipeline.run().result)
+            self.assertEqual(outer.result(timeout=2), 3)
+
+    def test_stages_must_be_declared_in_dependency_order(self):
+        with self.assertRaises(ValueError):
+            Pipeline("test", [Stage("b", None, after=["a"]), Stage("a", None)], output="b")
+        with self.assertRaises(ValueError):
+            Pipeline("test", [Stage("a", None), Stage("a", None)], output="a")
+        with self.assertRaises(ValueError):
+            Pipeline("test", [Stage("a", None)], output="b")
+
+
+class ChatPipelineTests(SimpleTestCase):
+    def test_reply_waits_for_the_product_lookup(self):
+        stages = {stage.name: stage for stage in chat_pipeline.stages}
+        self.assertEqual(stages["product"].after, ("route_kb",))
+        self.assertIn("product", stages["generate"].after)
+
+    def test_product_is_part_of_the_reply_prompt(self):
+        prompts, fused_prompt = build_chat_prompts(
+            "do you have red sneakers", "kb", "", "", [], "Ada", product="Red Running Sneakers"
+        )
+        response_prompt = prompts["response"][0]
+        self.assertEqual(response_prompt[-1], {"role": "user", "content": "do you have red sneakers"})
+        self.assertIn("Red Running Sneakers", response_prompt[-2]["content"])
+        self.assertIn(response_prompt[-2], fused_prompt)
+
+        prompts, _ = build_chat_prompts("hello there", "kb", "", "", [], "Ada")
+        self.assertNotIn("product", str(prompts["response"][0]))
@@ -1,7 +1,13 @@
 from django.urls import path
 from rest_framework import routers
 
-from .views import ChatViewSet, CustomerViewSet
+from .views import (
+    AsyncAutoResponseStreamView,
+    AsyncAutoResponseView,
+    AsyncRestructureTextView,
+    ChatViewSet,
+    CustomerViewSet,
+)
 
 
 app_name = "chat"
@@ -12,6 +18,25 @@ router.register(
     r"business/(?P<company_id>[^/]+)/customers", CustomerViewSet, basename="customer"
 )
 
+# async versions of the LLM-bound chat actions, for ASGI deployments
+urlpatterns = [
+    path(
+        "chat/<str:business_id>/<str:chat_identifier>/auto-response/async/",
+        AsyncAutoResponseView.as_view(),
+        name="auto_response_async",
+    ),
+    path(
+        "chat/<str:business_id>/<str:chat_identifier>/auto-response/stream/async/",
+        AsyncAutoResponseStreamView.as_view(),
+        name="auto_response_stream_async",
+    ),
+    path(
+        "chat/restructure-text/async/",
+        AsyncRestructureTextView.as_view(),
+        name="restructure_text_async",
+    ),
+]
+
 # urlpatterns = [
 #     # Your other URL patterns...
 #     path("create-chat", views.create_chat, name="create_chat"),
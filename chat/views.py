@@ -1,8 +1,13 @@
-import ast, logging, json, re
+import asyncio
+import logging, json, re
 import html
+from contextvars import copy_context
+from functools import partial
 
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.views.decorators.csrf import csrf_exempt
-from django.http import JsonResponse, Http404
+from django.http import JsonResponse, Http404, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
 from django.views.decorators.http import require_http_methods
@@ -19,6 +24,7 @@ from rest_framework import viewsets, status, mixins, filters
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
+from rest_framework.renderers import JSONRenderer
 from drf_yasg.utils import swagger_auto_schema, no_body
 from drf_yasg import openapi
 from loguru import logger as loggeru
@@ -28,9 +34,18 @@ from sanusi_backend.utils.error_handler import ErrorHandler, LogicException
 # from llama_index import GPTVectorStoreIndex
 # from llama_index.data_structs.node import Node
 
-from sanusi.analysis.entity_recognition import extract_topics
+from sanusi.analysis.message_analysis import analyze_message
+from sanusi.analysis.text_classification import confident_labels
+from sanusi.llm.metrics import company_scope
+from sanusi.llm.parsing import answer_parser
+from sanusi.llm.ratelimit import RateLimitExceeded
+from sanusi.llm.retrieval import retrieve_knowledge_base
+from sanusi.llm.semantic_cache import semantic_cache
+from sanusi.utilities.constants import LLMStage
+from sanusi.utilities.helpers import arun_concurrently, call_executor, run_concurrently
 
 from .models import Chat, ChatStatus, Message, Customer
+from .pipeline import Pipeline, Stage, StopPipeline
 from .serializers import (
     AutoResponseSerializer,
     ChatListDetailSerializer,
@@ -44,27 +59,32 @@ from .serializers import (
 from .models import Chat, Message, Customer, SENDER_CHOICES
 
 from sanusi.views import (
+    agenerate_response_chat,
+    agenerate_response_email,
+    agenerate_structured_response,
+    astream_response_chat,
     generate_response,
     generate_response_chat,
     generate_response_chat_v2,
     generate_response_email,
     generate_response_email_v2,
+    generate_structured_response,
+    stream_response_chat,
     construct_index,
     structure_response,
 )
 from business.models import Business
-from business.private.models import Category, KnowledgeBase, Product
-from sanusi.models import Message as sanusi_message
-from sanusi.utils import (
-    is_valid_format,
-    parse_answer_with_regex,
-    parse_json_from_answer,
-    parse_response_data,
-    save_chat_and_message,
-    try_parse_json,
+from business.private.models import KnowledgeBase
+from business.search import (
+    category_vocabulary,
+    decisive_match,
+    match_products,
+    search_products,
 )
+from sanusi.models import Message as sanusi_message
+from sanusi.utils import is_valid_format, save_chat_and_message
 
-from sanusi_backend.classes.custom import  CustomPagination, BaseSearchFilter
+from sanusi_backend.classes.custom import  AsyncAPIView, AsyncStreamingHttpResponse, CustomPagination, BaseSearchFilter, EventStreamRenderer
 
 
 instructions_for_auto_response = "Return your response as each of these parameters in a JSON format. Json format should be {'response': '[Generated response based on the information provided]',set escalation_department to 'none' if escalate Issue is false 'escalate Issue : boolean, 'escalation_department': '[sales/operations/billing/engineering]', 'severity': '[low/medium/high]','sentiment': '[positive/negative/neutral]'}."
@@ -87,7 +107,1031 @@ severity_instructions = json_data["severity_instructions"]
 dummy_knowledge_base = json_data["dummy_knowledge_base"]
 response_instructions_chat = json_data["response_instructions_chat"]
 chat_context_instructions = json_data["chat_context_instructions"]
+fused_instructions = json_data["fused_instructions"]
 valid_channels = ["chat", "whatsapp", "telegram", "instagram", "tiktok"]
+# channels whose answers can be served from the per-business semantic cache
+semantic_cache_channels = ["email_v1", "email"] + valid_channels
+escalation_departments_list = ["sales", "operations", "billing", "engineering", "support"]
+# classification prompts the local label models can answer instead of the LLM
+local_label_tasks = [LLMStage.ESCALATION, LLMStage.SENTIMENT, LLMStage.SEVERITY]
+
+
+chat_department_options = (
+    "'sales', 'operations', 'billing', 'engineering', 'support', 'legal', 'none'"
+)
+
+
+def get_chat_history(chat):
+    """
+    Return the recent replies and messages of chat joined into strings, most
+    recent first, and a list of the customer's last messages.
+    """
+    all_messages = (
+        Message.objects.filter(chat=chat)
+        .order_by("-sent_time")
+        .values_list("sanusi_response", "content")[:10]
+    )
+    result = list(all_messages)
+    sanusi_response = [item[0] for item in result if item[0] is not None]
+    content = [item[1] for item in result if item[1] is not None]
+
+    sanusi_response_str = ", ".join(sanusi_response)
+    content_str = ", ".join(content)
+    last_message = list(Message.objects.filter(chat=chat, sender="customer")[:2])
+    return sanusi_response_str, content_str, last_message
+
+
+def build_chat_response_prompt(
+    message, knowledge_base_contents, last_message, customer_name, product=None
+):
+    """
+    Build the reply prompt used by the chat channels; product is the name of
+    the product suggest_inventory_product found the message to be about.
+    """
+    prompt = [
+        {
+            "role": "system",
+            "content": f"response_instructions: {response_instructions_chat}",
+        },
+        {
+            "role": "system",
+            "content": f"knowledge base to answer from: {knowledge_base_contents}",
+        },
+        {
+            "role": "system",
+            "content": f"User's previous messages for reflection: {[message.content for message in last_message] if last_message else ''} and your last response was: {[message.sanusi_response for message in last_message] if last_message else ' '} and user's name is {customer_name}",
+        },
+        {"role": "user", "content": f"{message}"},
+    ]
+    if product:
+        prompt.insert(
+            -1,
+            {
+                "role": "system",
+                "content": f"The product the user's message is about: {product}",
+            },
+        )
+    return prompt
+
+
+def build_classification_prompts(
+    message, sanusi_response_str, content_str, department_options, context_tokens
+):
+    """
+    Build the escalation, sentiment, severity and chat context prompts for a message.
+
+    Returns a dict of name -> (prompt, max_tokens) ready for generate_reply_and_labels.
+    """
+    return {
+        "escalation": (
+            [
+                {
+                    "role": "system",
+                    "content": f"escalation_instructions: {escalation_instructions}. Possible answers are {department_options}. none if you are unable to determine the department from the options provided",
+                },
+                {
+                    "role": "assistant",
+                    "content": f"message to be analysed: {message}",
+                },
+            ],
+            1,
+        ),
+        "sentiment": (
+            [
+                {
+                    "role": "system",
+                    "content": f"sentiment_analysis: {sentiment_analysis}. Possible answers are 'positive', 'negative', 'neutral'.",
+                },
+                {
+                    "role": "assistant",
+                    "content": f"message to be analysed: {message}",
+                },
+            ],
+            1,
+        ),
+        "severity": (
+            [
+                {
+                    "role": "system",
+                    "content": f"severity_instructions: {severity_instructions}. only answers are 'low', 'medium', 'high'.",
+                },
+                {
+                    "role": "assistant",
+                    "content": f"message to be analysed: {message}",
+                },
+            ],
+            1,
+        ),
+        "chat_context": (
+            [
+                {
+                    "role": "system",
+                    "content": f"Chat Context instructions: {chat_context_instructions}",
+                },
+                {
+                    "role": "assistant",
+                    "content": f"Chat to be analysed: ('sanusi previous responses': {sanusi_response_str}), ('the user messages': {content_str}), ('user's current message': {message})",
+                },
+            ],
+            context_tokens,
+        ),
+    }
+
+
+def build_fused_prompt(
+    response_prompt, sanusi_response_str, content_str, department_options
+):
+    """
+    Fold the classification questions into the reply prompt so that a single
+    structured-output call answers all of them.
+    """
+    *context, user_message = response_prompt
+    return context + [
+        {
+            "role": "system",
+            "content": f"{fused_instructions} Possible escalation departments are {department_options}.",
+        },
+        {
+            "role": "system",
+            "content": f"Chat history for the chat_context: ('sanusi previous responses': {sanusi_response_str}), ('the user messages': {content_str})",
+        },
+        user_message,
+    ]
+
+
+def build_chat_prompts(
+    message,
+    knowledge_base_contents,
+    sanusi_response_str,
+    content_str,
+    last_message,
+    customer_name,
+    product=None,
+):
+    """
+    Build the reply and classification prompts of a chat channel auto
+    response, and the fused prompt answering all of them at once.
+    """
+    response_instructions_prompt = build_chat_response_prompt(
+        message, knowledge_base_contents, last_message, customer_name, product
+    )
+    prompts = {"response": (response_instructions_prompt, 300)}
+    prompts.update(
+        build_classification_prompts(
+            message, sanusi_response_str, content_str, chat_department_options, 5
+        )
+    )
+    fused_prompt = build_fused_prompt(
+        response_instructions_prompt,
+        sanusi_response_str,
+        content_str,
+        chat_department_options,
+    )
+    return prompts, fused_prompt
+
+
+def build_kb_routing_prompt(message):
+    """Prompt asking which knowledge base a chat message belongs to."""
+    return [
+        {
+            "role": "system",
+            "content": "Based on the message content, which knowledge base should be used for the message, respond with only one word from this list [inventory, general, billing, business logic, finance, security, operations, engineering], if it is difficult to determine, then you should respond with general.",
+        },
+        {"role": "user", "content": f"{message}"},
+    ]
+
+
+def route_message(message):
+    """Which knowledge base the message is about, e.g. "inventory"."""
+    return completion_content(
+        generate_response_chat(build_kb_routing_prompt(message), 50, stage=LLMStage.KB_ROUTING)
+    )
+
+
+async def aroute_message(message):
+    """route_message for async views."""
+    return completion_content(
+        await agenerate_response_chat(
+            build_kb_routing_prompt(message), 50, stage=LLMStage.KB_ROUTING
+        )
+    )
+
+
+def find_product(company_id, message):
+    """The product the message is about when it is routed to the inventory knowledge base."""
+    if route_message(message) == "inventory":
+        return suggest_inventory_product(company_id, message)
+    return None
+
+
+async def afind_product(company_id, message):
+    """find_product for async views."""
+    if await aroute_message(message) == "inventory":
+        return await sync_to_async(suggest_inventory_product, thread_sensitive=False)(
+            company_id, message
+        )
+    return None
+
+
+def suggest_inventory_product(company_id, message):
+    """
+    Inventory thought process for messages routed to the inventory knowledge
+    base: guess the product category, search the business's products for
+    the message's keywords and let the LLM pick among several matches.
+
+    Returns: The name of the product the message is about, or None.
+    """
+    categories = category_vocabulary(company_id)
+    if not categories:
+        logger.debug("No product categories, skipping the product lookup")
+        return None
+
+    which_category = [
+        {
+            "role": "system",
+            "content": f"Based on the message content, which product category does this context of this message fall in, respond with only one category from this list [{categories.prompt_list()}], if it is difficult to determine, then you should respond with 'Sorry, we currently don't have this product.",
+        },
+        {"role": "user", "content": f"{message}"},
+    ]
+    probable_category = completion_content(
+        generate_response_chat(which_category, 50, stage=LLMStage.CATEGORY)
+    )
+    category_id = categories.resolve(probable_category)
+    logger.debug("Probable product category %r resolved to %s", probable_category, category_id)
+
+    # get the keywords and entities from the analysis nlp mmodule
+    analysis = analyze_message(message)
+    logger.debug("Message topics: %s", analysis.topics())
+
+    def get_matching_products(keywords, category_id=None):
+        products = search_products(company_id, keywords, category_id=category_id)
+        if not products:
+            # nothing matches literally, e.g. misspelled or plural names
+            products = match_products(company_id, keywords, category_id=category_id)
+        logger.debug("Products matching %s: %s", keywords, products)
+        return products
+
+    def get_contextual_product(message, probable_products):
+        # Construct a dynamic list of products to include in the prompt.
+        product_list_string = "\n".join(
+            [
+                f"- {product['name']}: {product['description']}"
+                for product in probable_products
+            ]
+        )
+        prompt = [
+            {
+                "role": "system",
+                "content": f"We have identified the following probable products based on the message content. Which one is the most relevant?\n\n{product_list_string}\n\nIf none of these match, respond with 'None'.",
+            },
+            {"role": "user", "content": message},
+        ]
+
+        response = generate_response_chat(prompt, 200, stage=LLMStage.PRODUCT_PICK)
+        chosen_product = (completion_content(response) or "").strip()
+        if chosen_product.strip("'\".").lower() in ("", "none"):
+            return None  # the prompt asks for 'None' when no product fits
+        return chosen_product
+
+    # probable_category_response = probable_category
+    # probable_category = probable_category_response["choices"][0]["message"][
+    #     "content"
+    # ]
+
+    probable_products = get_matching_products(list(analysis.keywords), category_id)
+
+    # If there's more than one matching product and none clearly stands out,
+    # use OpenAI for further narrowing down.
+    decisive_product = decisive_match(probable_products)
+    if decisive_product:
+        logger.debug("Decisive product match: %s", decisive_product["name"])
+        return decisive_product["name"]
+    elif len(probable_products) > 1:
+        chosen_product = get_contextual_product(message, probable_products)
+        logger.debug("Product picked by the LLM: %s", chosen_product)
+        return chosen_product
+    elif probable_products:
+        logger.debug("Single product match: %s", probable_products[0]["name"])
+        return probable_products[0]["name"]
+    else:
+        logger.debug("No matching products found")
+        return None
+
+
+# Fields of the fused structured answer and the per-field prompt that backs each one
+fused_answer_fields = {
+    "response": "response",
+    "escalation_department": "escalation",
+    "severity": "severity",
+    "sentiment": "sentiment",
+    "chat_context": "chat_context",
+}
+
+
+def generate_fused_answers(fused_prompt):
+    """
+    Answer the reply and every label with one call, keeping only the fields
+    that pass validation.
+    """
+    data, invalid_fields = generate_structured_response(
+        fused_prompt, 400, fields=list(fused_answer_fields)
+    )
+    return fused_answers(data, invalid_fields)
+
+
+async def agenerate_fused_answers(fused_prompt):
+    """generate_fused_answers for async views."""
+    data, invalid_fields = await agenerate_structured_response(
+        fused_prompt, 400, fields=list(fused_answer_fields)
+    )
+    return fused_answers(data, invalid_fields)
+
+
+def fused_answers(data, invalid_fields):
+    answers = {}
+    for field, name in fused_answer_fields.items():
+        if field in invalid_fields:
+            continue
+        value = data[field]
+        if field == "escalation_department" and value == "null":
+            value = "none"
+        answers[name] = value
+    return answers
+
+
+def completion_content(response):
+    """Return the message content of a chat completion, or None if the call failed."""
+    try:
+        return response["choices"][0]["message"]["content"]
+    except (KeyError, IndexError, TypeError):
+        return None
+
+
+def escalation_department_names(business):
+    """Lower-cased names of the departments the business escalates to."""
+    return {
+        name.strip().lower()
+        for name in business.escalation_departments.values_list("name", flat=True)
+    }
+
+
+def local_labels(prompts, message, departments=None):
+    """
+    Labels of prompts the local classifier predicts confidently for message.
+    An escalation to a department not in departments is left to the LLM.
+    """
+    if message is None or not settings.LOCAL_LABELS_ENABLED:
+        return {}
+    labels = confident_labels(message, [name for name in local_label_tasks if name in prompts])
+    department = labels.get(LLMStage.ESCALATION)
+    if departments is not None and department not in (None, "none", *departments):
+        del labels[LLMStage.ESCALATION]
+    return labels
+
+
+def generate_reply_and_labels(prompts, fused_prompt=None, message=None, departments=None):
+    """
+    Run the reply and classification prompts of an auto response.
+
+    None of the prompts depends on another one's answer, so in "concurrent"
+    execution mode they are fired together and awaited under a single
+    AUTO_RESPONSE_DEADLINE; in "serial" mode they run one after another.
+    In "fused" mode fused_prompt is sent first and only the fields it failed
+    to answer validly fall back to their own prompts, concurrently.
+
+    When message is given, labels the local classifier predicts with enough
+    confidence are used as-is and their prompts are never sent.
+
+    Args:
+        prompts (dict): Mapping of name -> (prompt, max_tokens)
+        fused_prompt (list): Structured-output prompt used in "fused" mode
+        message (str): Customer message, used for local label prediction
+        departments (set): Departments the business escalates to, the only
+            local escalation predictions used besides "none"
+
+    Returns:
+        dict: Mapping of name -> generated text, None for calls that failed
+        or missed the deadline.
+    """
+    mode = settings.AUTO_RESPONSE_EXECUTION_MODE
+    answers = local_labels(prompts, message, departments)
+    prompts = {name: value for name, value in prompts.items() if name not in answers}
+
+    if mode == "fused" and fused_prompt:
+        answers = {**generate_fused_answers(fused_prompt), **answers}
+        prompts = {name: value for name, value in prompts.items() if name not in answers}
+
+    calls = {
+        name: partial(generate_response_chat, prompt, max_tokens, stage=name)
+        for name, (prompt, max_tokens) in prompts.items()
+    }
+    if mode in ["concurrent", "fused"]:
+        responses = run_concurrently(
+            calls,
+            timeout=settings.AUTO_RESPONSE_DEADLINE,
+            propagate=(RateLimitExceeded,),
+        )
+    else:
+        responses = {name: call() for name, call in calls.items()}
+
+    answers.update(
+        {name: completion_content(response) for name, response in responses.items()}
+    )
+    return answers
+
+
+async def agenerate_reply_and_labels(prompts, fused_prompt=None, message=None, departments=None):
+    """
+    generate_reply_and_labels for async views: the calls run as tasks on
+    the event loop rather than on a thread pool.
+    """
+    mode = settings.AUTO_RESPONSE_EXECUTION_MODE
+    answers = await sync_to_async(local_labels, thread_sensitive=False)(
+        prompts, message, departments
+    )
+    prompts = {name: value for name, value in prompts.items() if name not in answers}
+
+    if mode == "fused" and fused_prompt:
+        answers = {**await agenerate_fused_answers(fused_prompt), **answers}
+        prompts = {name: value for name, value in prompts.items() if name not in answers}
+
+    calls = {
+        name: partial(agenerate_response_chat, prompt, max_tokens, stage=name)
+        for name, (prompt, max_tokens) in prompts.items()
+    }
+    if mode in ["concurrent", "fused"]:
+        responses = await arun_concurrently(
+            calls,
+            timeout=settings.AUTO_RESPONSE_DEADLINE,
+            propagate=(RateLimitExceeded,),
+        )
+    else:
+        responses = {name: await call() for name, call in calls.items()}
+
+    answers.update(
+        {name: completion_content(response) for name, response in responses.items()}
+    )
+    return answers
+
+
+def build_auto_response_json(answers, escape_html=False):
+    """
+    Assemble the auto response payload from the reply and classification answers.
+    """
+    text = answers.get("response")
+    if not text:
+        ErrorHandler.log_and_raise(
+            message="Failed to generate a response for the message",
+            exception_class=LogicException,
+            error_code="LLM_RESPONSE_FAILED",
+            status_code=503,
+            log_level="error",
+        )
+
+    if escape_html:
+        # Escape the text and replace newline characters with HTML line breaks
+        text = "<p>{}</p>".format(html.escape(text).replace("\n", "<br/>"))
+
+    escalation_department = answers.get("escalation") or "none"
+    severity = (answers.get("severity") or "").lower().strip()
+    if severity not in ["low", "medium", "high"]:
+        severity = "low"  # default to 'low' if invalid response
+
+    return {
+        "response": text,
+        "escalate_issue": escalation_department.lower() in escalation_departments_list,
+        "escalation_department": escalation_department,
+        "severity": severity,
+        "sentiment": answers.get("sentiment") or "neutral",
+        "chat_context": answers.get("chat_context") or "",
+    }
+
+
+def build_restructure_prompt(channel, content):
+    """Completion prompt rewriting content for an email or chat channel."""
+    if channel == "email":
+        prompt = [
+            f"You are Sanusi's smart assistant that assists with writing professional emails like grammarly, Make sure to avoid mentioning that you are an AI language model. Please regenerate/rewrite the following text into a grammatically correct and formal email body like <p>[your response]</p>: {content}.",
+            # {
+            #     "role": "assistant",
+            #     "content": f"Please restructure the following content to have a formal HTML email format like <p>[your response]</p>.: {content}",
+            # },
+        ]
+    elif channel == "chat":
+        prompt = [
+            f"You are Sanusi's smart assistant that assists with editing text and puts it in a friendly way like grammarly, Make sure to avoid mentioning that you are an AI language model. Please regenerate/rewrite the following text into a grammatically correct one: {content}.",
+        ]
+    return prompt
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def event_stream_response(events, response_class=StreamingHttpResponse):
+    response = response_class(events, content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"  # stop nginx from buffering the stream
+    return response
+
+
+def cached_answer_events(response_json):
+    yield sse_event("token", {"content": response_json["response"]})
+    yield sse_event("done", response_json)
+
+
+async def acached_answer_events(response_json):
+    for event in cached_answer_events(response_json):
+        yield event
+
+
+def cached_answer(company_id, chat, channel, message, customer_name):
+    """
+    The semantic cache's answer to a similar message of the business, with
+    the chat_context the cache does not keep filled in from the chat.
+    """
+    response_json = semantic_cache.lookup(company_id, channel, message, customer_name)
+    if response_json is not None:
+        response_json["chat_context"] = chat.keyword
+    return response_json
+
+
+def stream_auto_response_events(
+    chat,
+    sender,
+    message,
+    channel,
+    company_id,
+    customer_name,
+    response_prompt,
+    label_prompts,
+    departments,
+):
+    """
+    Server-sent events of a streamed auto response, for WSGI deployments.
+
+    Reply tokens are sent as "token" events as soon as the provider emits
+    them, while the classification calls run on the shared call_executor
+    pool. Once the reply is complete the labels are awaited, the chat and
+    message are saved and the full response json is sent as a "done" event.
+    """
+    with company_scope(company_id):
+        labels = call_executor().submit(
+            copy_context().run,
+            generate_reply_and_labels,
+            label_prompts,
+            message=message,
+            departments=departments,
+        )
+
+        chunks = []
+        try:
+            for content in stream_response_chat(response_prompt, 300):
+                chunks.append(content)
+                yield sse_event("token", {"content": content})
+        except Exception as e:
+            loggeru.error(f"Streaming the auto response failed: {str(e)}", chat=str(chat.id))
+
+        if not chunks:
+            labels.cancel()
+            yield sse_event("error", {"message": "Failed to generate a response for the message"})
+            return
+
+        try:
+            answers = labels.result(timeout=settings.AUTO_RESPONSE_DEADLINE)
+        except Exception as e:
+            loggeru.error(f"Classifying the auto response failed: {str(e)}", chat=str(chat.id))
+            answers = {}
+        answers["response"] = "".join(chunks)
+
+        response_json = build_auto_response_json(answers)
+        semantic_cache.store(company_id, channel, message, response_json, customer_name)
+        save_chat_and_message(chat, sender, message, response_json, channel)
+        yield sse_event("done", response_json)
+
+
+async def astream_auto_response_events(
+    chat,
+    sender,
+    message,
+    channel,
+    company_id,
+    customer_name,
+    response_prompt,
+    label_prompts,
+    departments,
+):
+    """
+    stream_auto_response_events for ASGI deployments: the classification
+    calls run as a task on the event loop and the chat and message are
+    saved through sync_to_async.
+    """
+    with company_scope(company_id):
+        labels = asyncio.ensure_future(
+            agenerate_reply_and_labels(label_prompts, message=message, departments=departments)
+        )
+        try:
+            chunks = []
+            try:
+                async for content in astream_response_chat(response_prompt, 300):
+                    chunks.append(content)
+                    yield sse_event("token", {"content": content})
+            except Exception as e:
+                loggeru.error(f"Streaming the auto response failed: {str(e)}", chat=str(chat.id))
+
+            if not chunks:
+                yield sse_event("error", {"message": "Failed to generate a response for the message"})
+                return
+
+            try:
+                answers = await asyncio.wait_for(labels, settings.AUTO_RESPONSE_DEADLINE)
+            except Exception as e:
+                loggeru.error(f"Classifying the auto response failed: {str(e)}", chat=str(chat.id))
+                answers = {}
+            answers["response"] = "".join(chunks)
+
+            response_json = build_auto_response_json(answers)
+            await sync_to_async(semantic_cache.store)(
+                company_id, channel, message, response_json, customer_name
+            )
+            await sync_to_async(transaction.atomic(save_chat_and_message))(
+                chat, sender, message, response_json, channel
+            )
+            yield sse_event("done", response_json)
+        finally:
+            if not labels.done():
+                labels.cancel()
+
+
+# Auto response pipelines. Every channel answers a message by running the
+# stages of its pipeline (see chat.pipeline); a stage reads the request
+# inputs (business, chat, message, channel, sender, customer_name) and the
+# values of the stages it runs after from the context.
+
+
+def load_knowledge_base(context):
+    """The knowledge base entries relevant to the message; stops when there are none."""
+    knowledge_base_contents = retrieve_knowledge_base(
+        context["business"].company_id, context["message"]
+    )
+    if not knowledge_base_contents:
+        raise StopPipeline(
+            Response(
+                "This business has no knowledge base, kindly create one to activate auto response"
+            )
+        )
+    return knowledge_base_contents
+
+
+def answer_from_semantic_cache(context):
+    """Stop with the cached answer to a similar message, if there is one."""
+    channel = context["channel"]
+    if channel not in semantic_cache_channels:
+        return None
+    response_json = cached_answer(
+        context["business"].company_id,
+        context["chat"],
+        channel,
+        context["message"],
+        context["customer_name"],
+    )
+    if response_json is not None:
+        save_chat_and_message(
+            context["chat"], context["sender"], context["message"], response_json, channel
+        )
+        raise StopPipeline(Response(response_json, status=status.HTTP_200_OK))
+    return None
+
+
+def load_chat_history(context):
+    return get_chat_history(context["chat"])
+
+
+def route_knowledge_base(context):
+    return route_message(context["message"])
+
+
+def lookup_product(context):
+    """The product the message is about when it is routed to the inventory knowledge base."""
+    if context["route_kb"] == "inventory":
+        return suggest_inventory_product(context["business"].company_id, context["message"])
+    return None
+
+
+def generate_chat_answers(context):
+    sanusi_response_str, content_str, last_message = context["history"]
+    prompts, fused_prompt = build_chat_prompts(
+        context["message"],
+        context["knowledge_base"],
+        sanusi_response_str,
+        content_str,
+        last_message,
+        context["customer_name"],
+        context["product"],
+    )
+    return generate_reply_and_labels(
+        prompts,
+        fused_prompt,
+        message=context["message"],
+        departments=escalation_department_names(context["business"]),
+    )
+
+
+def generate_email_answers(context):
+    message = context["message"]
+    sanusi_response_str, content_str, last_message = context["history"]
+    response_instructions_prompt = [
+        {
+            "role": "system",
+            "content": f"response_instructions: {response_instructions}",
+        },
+        {
+            "role": "system",
+            "content": f"knowledge base to answer from: {context['knowledge_base']}",
+        },
+        {
+            "role": "system",
+            "content": f"User's previous messages for reflection: {[message.content for message in last_message] if last_message else ''} and your last response was: {[message.sanusi_response for message in last_message] if last_message else ' '} and user's name is {context['customer_name']}",
+        },
+        {"role": "user", "content": f"{message}"},
+    ]
+    email_department_options = "'sales', 'operations', 'billing', 'engineering', 'none'"
+    prompts = {"response": (response_instructions_prompt, 300)}
+    prompts.update(
+        build_classification_prompts(
+            message, sanusi_response_str, content_str, email_department_options, 1
+        )
+    )
+    fused_prompt = build_fused_prompt(
+        response_instructions_prompt,
+        sanusi_response_str,
+        content_str,
+        email_department_options,
+    )
+    return generate_reply_and_labels(
+        prompts,
+        fused_prompt,
+        message=message,
+        departments=escalation_department_names(context["business"]),
+    )
+
+
+def parse_answers(context, escape_html=False):
+    return build_auto_response_json(context["generate"], escape_html=escape_html)
+
+
+def save_response(context):
+    """
+    Save the parsed answer as the chat's reply to the message, remembering
+    it in the semantic cache for the channels served from it.
+    """
+    response_json = context["parse"]
+    channel = context["channel"]
+    if channel in semantic_cache_channels:
+        semantic_cache.store(
+            context["business"].company_id,
+            channel,
+            context["message"],
+            response_json,
+            context["customer_name"],
+        )
+    save_chat_and_message(
+        context["chat"], context["sender"], context["message"], response_json, channel
+    )
+    return Response(response_json, status=status.HTTP_200_OK)
+
+
+def respond(context):
+    return Response(context["parse"], status=status.HTTP_200_OK)
+
+
+def generate_email_v2_answer(context):
+    last_message = context["history"][2]
+    prompt = [
+        f"Reply instructions: {email_v1_instructions}",
+        f"knowledge base to answer based off: {context['knowledge_base']}",
+        f"User's previous messages for reflection: {[message.content for message in last_message] if last_message else ''}",
+        f"User's name: {context['customer_name']}",
+        f"User's Message to be replied to: {context['message']}",
+    ]
+    response_content = generate_response_email(prompt)
+    logger.debug("email_v2 completion: %s", response_content)
+    return response_content["choices"][0]["text"]
+
+
+def parse_email_v2_answer(context):
+    """The parsed answer, falling back to the answer as the bare response."""
+    answer = context["generate"]
+    logger.info({"answer": answer})
+    parsed = answer_parser.parse(answer)
+    if parsed.data is not None:
+        return parsed.data
+    logger.error("The email_v2 answer could not be parsed")
+    return {
+        "response": answer,
+        "escalate_issue": False,
+        "escalation_department": "",
+        "severity": "",
+        "sentiment": "",
+    }
+
+
+def generate_email_v3_answers(context):
+    """The reply and label fields, asked for again while some of them come back empty."""
+    max_retry_attempts = 3
+    for attempt in range(max_retry_attempts):
+        response_parts = generate_response_email_v2([])
+
+        # Check if response_parts is an error message
+        if isinstance(response_parts, dict) and "data" in response_parts:
+            raise StopPipeline(
+                Response(response_parts, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+            )
+        if all(response_parts):
+            break
+        logger.warning(f"Retry attempt {attempt + 1} due to missing or empty field.")
+    return response_parts
+
+
+def parse_email_v3_answers(context):
+    response_parts = context["generate"]
+    return {
+        "response": response_parts[0] if len(response_parts) > 0 else None,
+        "escalate_issue": response_parts[1] if len(response_parts) > 1 else None,
+        "escalation_department": response_parts[2] if len(response_parts) > 2 else None,
+        "severity": response_parts[3] if len(response_parts) > 3 else None,
+        "sentiment": response_parts[4] if len(response_parts) > 4 else None,
+    }
+
+
+def save_email_v3_response(context):
+    """Save the answer as the chat's reply, unless some of its fields are missing."""
+    chat = context["chat"]
+    chat.channel = context["channel"]
+    chat.save()
+    if all(context["generate"]):
+        Message.objects.create(
+            chat=chat,
+            content=context["message"],
+            sender=str(context["sender"]),
+            sanusi_response=context["parse"],
+        )
+    return Response(data=context["parse"], status=status.HTTP_200_OK)
+
+
+def generate_canned_answer(context):
+    return generate_response("Hello, I'm having trouble with my account. Can you help?")
+
+
+def save_structured_response(context):
+    structured_response = structure_response(
+        context["generate"],
+        escalate_issue=True,
+        escalation_department="support",
+        severity="medium",
+        sentiment="neutral",
+    )
+    sanusi_message.objects.create(chat_session=structured_response)
+    return Response(structured_response, status=status.HTTP_200_OK)
+
+
+def generate_chat_v1_answer(context):
+    last_message = context["history"][2]
+    prompt = [
+        f"Reply instructions: {chat_v1_instructions}",
+        f"knowledge base to answer based off: {context['knowledge_base']}",
+        f"User's previous message for reflection: {[message.content for message in last_message] if last_message else ' '}",
+        f"Openai previous messages: {[message.sanusi_response for message in last_message] if last_message else ' '}",
+        f"User's name: {context['customer_name']}",
+        f"User's Message to be replied to: {context['message']}",
+    ]
+    logger.debug("chat_v1 prompt: %s", prompt)
+    response_content = generate_response_email(prompt)
+    return response_content["choices"][0]["text"]
+
+
+def parse_chat_v1_answer(context):
+    """The parsed answer, falling back to the stripped answer text."""
+    answer = context["generate"]
+    logger.debug("chat_v1 answer: %s", answer)
+    parsed = answer_parser.parse(answer)
+    return answer.strip() if parsed.data is None else parsed.data
+
+
+def generate_chat_v2_answer(context):
+    response_content = generate_response_chat([], 300)
+    return response_content["choices"][0]["message"]["content"]
+
+
+def parse_chat_v2_answer(context):
+    answer = context["generate"]
+    parsed = answer_parser.parse(answer)
+    if parsed.data is None:
+        logger.error("The assistant's response could not be parsed as JSON.")
+        return answer  # Return the original string
+    return parsed.data
+
+
+def auto_response_pipeline(name, stages):
+    """
+    Pipeline of a channel's stages, run after the knowledge base, semantic
+    cache and chat history stages every channel starts with.
+    """
+    stages = [
+        Stage("knowledge_base", load_knowledge_base, inline=True),
+        Stage("cached_answer", answer_from_semantic_cache, after=["knowledge_base"], inline=True),
+        Stage("history", load_chat_history, after=["cached_answer"], inline=True),
+    ] + stages
+    return Pipeline(
+        name,
+        stages,
+        output=stages[-1].name,
+        cache_ttls=settings.AUTO_RESPONSE_STAGE_CACHE_TTLS,
+        cache_alias=settings.AUTO_RESPONSE_STAGE_CACHE_ALIAS,
+    )
+
+
+# Routing and product lookup only depend on the message, so they run while
+# the history loads; the product found is part of the reply prompt.
+chat_pipeline = auto_response_pipeline(
+    "chat",
+    [
+        Stage("route_kb", route_knowledge_base, after=["cached_answer"]),
+        Stage(
+            "product",
+            lookup_product,
+            after=["route_kb"],
+            cache_key=lambda context: (context["business"].company_id, context["message"]),
+        ),
+        Stage("generate", generate_chat_answers, after=["history", "product"]),
+        Stage("parse", parse_answers, after=["generate"], inline=True),
+        Stage("persist", save_response, after=["parse"], inline=True),
+    ],
+)
+
+email_pipeline = auto_response_pipeline(
+    "email",
+    [
+        Stage("generate", generate_email_answers, after=["history"]),
+        Stage("parse", partial(parse_answers, escape_html=True), after=["generate"], inline=True),
+        Stage("persist", save_response, after=["parse"], inline=True),
+    ],
+)
+
+email_v2_pipeline = auto_response_pipeline(
+    "email_v2",
+    [
+        Stage("generate", generate_email_v2_answer, after=["history"]),
+        Stage("parse", parse_email_v2_answer, after=["generate"], inline=True),
+        Stage("persist", save_response, after=["parse"], inline=True),
+    ],
+)
+
+email_v3_pipeline = auto_response_pipeline(
+    "email_v3",
+    [
+        Stage("generate", generate_email_v3_answers, after=["history"]),
+        Stage("parse", parse_email_v3_answers, after=["generate"], inline=True),
+        Stage("persist", save_email_v3_response, after=["parse"], inline=True),
+    ],
+)
+
+email_v4_pipeline = auto_response_pipeline(
+    "email_v4",
+    [
+        Stage("generate", generate_canned_answer, after=["cached_answer"]),
+        Stage("persist", save_structured_response, after=["generate", "history"], inline=True),
+    ],
+)
+
+chat_v1_pipeline = auto_response_pipeline(
+    "chat_v1",
+    [
+        Stage("generate", generate_chat_v1_answer, after=["history"]),
+        Stage("parse", parse_chat_v1_answer, after=["generate"], inline=True),
+        Stage("persist", save_response, after=["parse"], inline=True),
+    ],
+)
+
+chat_v2_pipeline = auto_response_pipeline(
+    "chat_v2",
+    [
+        Stage("generate", generate_chat_v2_answer, after=["history"]),
+        Stage("parse", parse_chat_v2_answer, after=["generate"], inline=True),
+        Stage("respond", respond, after=["parse"], inline=True),
+    ],
+)
+
+auto_response_pipelines = {
+    "email": email_pipeline,
+    "email_v1": email_pipeline,
+    "email_v2": email_v2_pipeline,
+    "email_v3": email_v3_pipeline,
+    "email_v4": email_v4_pipeline,
+    "chat_v1": chat_v1_pipeline,
+    "chat_v2": chat_v2_pipeline,
+    **{channel: chat_pipeline for channel in valid_channels},
+}
 
 
 
@@ -259,6 +1303,11 @@ class ChatViewSet(viewsets.GenericViewSet):
     filter_backend = filters.SearchFilter
     search_fields = ["channel", "read", "customer__name", "status"]
 
+    def dispatch(self, request, *args, **kwargs):
+        # attribute the LLM calls made for the request to the business
+        with company_scope(kwargs.get("business_id")):
+            return super().dispatch(request, *args, **kwargs)
+
     @transaction.atomic
     @swagger_auto_schema(request_body=CreateChatRequestSerializer)
     @action(
@@ -491,6 +1540,11 @@ class ChatViewSet(viewsets.GenericViewSet):
     )
     @transaction.atomic
     def auto_response(self, request, business_id, chat_identifier):
+        """
+        Answer a customer message by running its channel's pipeline (see
+        auto_response_pipelines). The time each stage took is returned in
+        the Server-Timing header.
+        """
         # Deserialize and validate request data
         business = get_object_or_404(Business, company_id=business_id)
         serializer = AutoResponseSerializer(data=request.data)
@@ -529,612 +1583,87 @@ class ChatViewSet(viewsets.GenericViewSet):
                 Chat, business_id=business, identifier=chat_identifier
             )
 
-        # Retrieve knowledge bases and instructions for the business
-        knowledge_bases = business.business_kb.all()
-        # knowledge_base_contents = dummy_knowledge_base
-        if knowledge_bases:
-            # instructions = business.reply_instructions
-            # knowledge_base_contents = "\n".join(
-            #     [kb.cleaned_data for kb in knowledge_bases]
-            # )
-            knowledge_base_contents = [kb.cleaned_data for kb in knowledge_bases]
-        else:
-            return Response(
-                "This business has no knowledge base, kindly create one to activate auto response"
+        pipeline = auto_response_pipelines.get(channel)
+        if pipeline is None:
+            ErrorHandler.validation_error(
+                message=f"Unsupported channel {channel}", field="channel"
             )
 
-        # Retrieve escalation departments for the business
-        # escalation_departments = "/".join(
-        #     [dept.name for dept in business.escalation_departments.all()]
-        # )
-
-        # Ensure messages are ordered by creation time (or however they should be ordered)
-        all_messages = (
-            Message.objects.filter(chat=chat)
-            .order_by("-sent_time")
-            .values_list("sanusi_response", "content")[:10]
+        run = pipeline.run(
+            business=business,
+            chat=chat,
+            message=message,
+            channel=channel,
+            sender=sender,
+            customer_name=customer_name,
         )
-        result = list(all_messages)
-        sanusi_response = [item[0] for item in result if item[0] is not None]
-        content = [item[1] for item in result if item[1] is not None]
-
-        sanusi_response_str = ", ".join(sanusi_response)
-        content_str = ", ".join(content)
-        last_message = Message.objects.filter(chat=chat, sender="customer")[:2]
-        # Build the prompt
-        prompt = []
-
-        # add all knowlegdebase to the prompt
-        # prompt.insert(
-        #     1,
-        #     {
-        #         "role": "system",
-        #         "content": (
-        #             f"Knowledge base to answer based off: {knowledge_base_contents}"
-        #         ),
-        #     },
-        # )
-
-        if channel == "email_v4":
-            prompt = "Hello, I'm having trouble with my account. Can you help?"
-            ai_response = generate_response(prompt)
-
-            structured_response = structure_response(
-                ai_response,
-                escalate_issue=True,
-                escalation_department="support",
-                severity="medium",
-                sentiment="neutral",
-            )
-            sanusi_message.objects.create(chat_session=structured_response)
-            return Response(structured_response, status=status.HTTP_200_OK)
+        response = run.result
+        response["Server-Timing"] = run.server_timing()
+        return response
 
-        if channel == "email_v1" or channel == "email":
-            response_instructions_prompt = [
-                {
-                    "role": "system",
-                    "content": f"response_instructions: {response_instructions}",
-                },
-                {
-                    "role": "system",
-                    "content": f"knowledge base to answer from: {knowledge_base_contents}",
-                },
-                {
-                    "role": "system",
-                    "content": f"User's previous messages for reflection: {last_message.content if last_message else ''} and your last response was: {last_message.sanusi_response if last_message else ' '} and user's name is {customer_name}",
-                },
-                {"role": "user", "content": f"{message}"},
-            ]
-            answer_4_response = generate_response_chat(
-                response_instructions_prompt, 300
-            )
-
-            escalation_department_prompt = [
-                {
-                    "role": "system",
-                    "content": f"escalation_instructions: {escalation_instructions}. Possible answers are 'sales', 'operations', 'billing', 'engineering', 'none'. none if you are unable to determine the department from the options provided",
-                },
-                {
-                    "role": "assistant",
-                    "content": f"message to be analysed: {message}",
-                },
-            ]
-            answer_4_escalation_department = generate_response_chat(
-                escalation_department_prompt, 1
-            )
-            print(answer_4_escalation_department)
-
-            sentiment_analysis_prompt = [
-                {
-                    "role": "system",
-                    "content": f"sentiment_analysis: {sentiment_analysis}. Possible answers are 'positive', 'negative', 'neutral'.",
-                },
-                {
-                    "role": "assistant",
-                    "content": f"message to be analysed: {message}",
-                },
-            ]
-            answer_4_sentiment = generate_response_chat(sentiment_analysis_prompt, 1)
-
-            severity_instructions_prompt = [
-                {
-                    "role": "system",
-                    "content": f"severity_instructions: {severity_instructions}. only answers are 'low', 'medium', 'high'.",
-                },
-                {
-                    "role": "assistant",
-                    "content": f"message to be analysed: {message}",
-                },
-            ]
-            answer_4_severity = generate_response_chat(severity_instructions_prompt, 1)
-
-            severity = (
-                answer_4_severity["choices"][0]["message"]["content"].lower().strip()
-            )
-            if severity not in ["low", "medium", "high"]:
-                severity = "low"  # default to 'low' if invalid response
-
-            chat_context_instructions_prompt = [
-                {
-                    "role": "system",
-                    "content": f"Chat Context instructions: {chat_context_instructions}",
-                },
-                {
-                    "role": "assistant",
-                    "content": f"Chat to be analysed: ('sanusi previous responses': {sanusi_response_str}), ('the user messages': {content_str}), ('user's current message': {message})",
-                },
-            ]
-            answer_4_chat_context = generate_response_chat(
-                chat_context_instructions_prompt, 1
-            )
-
-            text = answer_4_response["choices"][0]["message"]["content"]
-            html_text = html.escape(text)  # This will escape the text
-
-            html_text = html_text.replace(
-                "\n", "<br/>"
-            )  # Replace newline characters with HTML line breaks
-
-            response_html = "<p>{}</p>".format(html_text)
-
-            response_json = {
-                "response": response_html,
-                "escalate_issue": (
-                    True
-                    if answer_4_escalation_department["choices"][0]["message"][
-                        "content"
-                    ].lower()
-                    in ["sales", "operations", "billing", "engineering", "support"]
-                    else False
-                ),
-                "escalation_department": answer_4_escalation_department["choices"][0][
-                    "message"
-                ]["content"],
-                "severity": severity,
-                "sentiment": answer_4_sentiment["choices"][0]["message"]["content"],
-                "chat_context": answer_4_chat_context["choices"][0]["message"][
-                    "content"
-                ],
-            }
-            save_chat_and_message(chat, sender, message, response_json, channel)
-            return Response(response_json, status=status.HTTP_200_OK)
-
-        if channel == "email_v2":
-            prompt.insert(0, f"Reply instructions: {email_v1_instructions}")
-            prompt.insert(
-                1, f"knowledge base to answer based off: {knowledge_base_contents}"
-            )
-            prompt.insert(
-                2,
-                f"User's previous messages for reflection: {last_message.content if last_message else ''}",
-            )
-            prompt.insert(3, f"User's name: {customer_name}")
-            prompt.insert(4, f"User's Message to be replied to: {message}")
-
-            response_content = generate_response_email(prompt)
-            answer = response_content["choices"][0]["text"]
-            max_retry_attempts = 3
-            print("--------------------------------", response_content)
-
-            for attempt in range(max_retry_attempts):
-                logger.info({"answer": answer})
-                try:
-                    start_index = answer.index("{")
-                    end_index = answer.rindex("}") + 1
-                    response_json_str = answer[start_index:end_index]
-                    response_json = json.loads(response_json_str)
-                    print(
-                        response_json,
-                        "-----------this is the parsed response--------------",
-                    )
-                    save_chat_and_message(chat, sender, message, response_json, channel)
-                    return Response(response_json, status=status.HTTP_200_OK)
-                except ValueError:
-                    print(answer, "-----------this is the answer--------------")
-                    try:
-                        response_json = parse_response_data(answer)
-                        print(
-                            response_json,
-                            "-----------this is after value error for email_v1---------------------",
-                        )
-                        save_chat_and_message(
-                            chat, sender, message, response_json, channel
-                        )
-                        return Response(response_json, status=status.HTTP_200_OK)
-                    except (json.JSONDecodeError, ValueError, AttributeError) as e:
-                        if attempt < max_retry_attempts - 1:  # not the last attempt
-                            prompt[
-                                0
-                            ] += "\nRemember to adhere strictly to the response instructions provided. An assistant is supposed to listen to instructions."
-                            logger.error(
-                                f"Error occurred during attempt {attempt + 1}: {str(e)}"
-                            )
-                        else:
-                            logger.error(f"All attempts failed. Error: {str(e)}")
-                            print(answer)
-                            response_json = {
-                                "response": answer,
-                                "escalate_issue": False,
-                                "escalation_department": "",
-                                "severity": "",
-                                "sentiment": "",
-                            }
-                            save_chat_and_message(
-                                chat, sender, message, response_json, channel
-                            )
-                            return Response(
-                                data=response_json, status=status.HTTP_200_OK
-                            )
-
-            # chat.channel = channel
-            # chat.save()
-
-            # Message.objects.create(
-            #     chat=chat,
-            #     content=message,
-            #     sender=str(sender),
-            #     sanusi_response=response_json,
-            # )
-            # return Response(data=response_json, status=status.HTTP_200_OK)
-
-        elif channel == "email_v3":
-            max_retry_attempts = 3
-            for attempt in range(max_retry_attempts):
-                response_parts = generate_response_email_v2(prompt)
-
-                # Check if response_parts is an error message
-                if isinstance(response_parts, dict) and "data" in response_parts:
-                    return Response(
-                        response_parts, status=status.HTTP_500_INTERNAL_SERVER_ERROR
-                    )
-
-                response_json = {
-                    "response": response_parts[0] if len(response_parts) > 0 else None,
-                    "escalate_issue": (
-                        response_parts[1] if len(response_parts) > 1 else None
-                    ),
-                    "escalation_department": (
-                        response_parts[2] if len(response_parts) > 2 else None
-                    ),
-                    "severity": response_parts[3] if len(response_parts) > 3 else None,
-                    "sentiment": response_parts[4] if len(response_parts) > 4 else None,
-                }
-
-                chat.channel = channel
-                chat.save()
-
-                # Check if any field is missing or is an empty string
-                if all(response_parts):
-                    Message.objects.create(
-                        chat=chat,
-                        content=message,
-                        sender=str(sender),
-                        sanusi_response=response_json,
-                    )
-                    return Response(data=response_json, status=status.HTTP_200_OK)
-                else:
-                    prompt[0][
-                        "content"
-                    ] += "\nRemember to adhere strictly to the response instructions provided. an assistant is supposed to listen to instructions"
-                    logger.warning(
-                        f"Retry attempt {attempt + 1} due to missing or empty field."
-                    )
-                    continue
-            # If we reached this point, it means all attempts failed.
-            return Response(data=response_json, status=status.HTTP_200_OK)
-
-        elif channel == "chat_v2":
-            # Generate a response using the constructed prompt
-            response_content = generate_response_chat(prompt)
-
-            # Extract answer from the response
-            answer = response_content["choices"][0]["message"]["content"]
-            max_retry_attempts = 3
-            for attempt in range(max_retry_attempts):
-                logger.error("retrying attempt %d", attempt)
-                try:
-                    # Attempt to parse as JSON
-                    response_json = json.loads(answer)
-                except json.JSONDecodeError:
-                    try:
-                        # If the above fails, attempt to parse as a Python dictionary string
-                        response_json = ast.literal_eval(answer)
-                        break
-                    except (ValueError, SyntaxError):
-                        # If parsing fails, add adherence reminder to the system instructions and continue
-                        if attempt < max_retry_attempts - 1:  # not the last attempt
-                            prompt[0][
-                                "content"
-                            ] += "\nRemember to adhere strictly to the response instructions provided. an assistant is supposed to listen to instructions"
-                        else:
-                            logger.error(
-                                "The assistant's response could not be parsed as JSON or a Python dictionary string."
-                            )
-                            response_json = answer  # Return the original string
-
-        elif channel in valid_channels:
-            # determine the context figure out which knowledge base to choose from
-            which_knowledge_base = [
-                {
-                    "role": "system",
-                    "content": "Based on the message content, which knowledge base should be used for the message, respond with only one word from this list [inventory, general, billing, business logic, finance, security, operations, engineering], if it is difficult to determine, then you should respond with general.",
-                },
-                {"role": "user", "content": f"{message}"},
-            ]
-            which_knowledge_base_res = generate_response_chat(which_knowledge_base, 50)
-            print(which_knowledge_base_res)
-
-            # if the category is inventory then trigger the invenotry thought process logic
-            if (
-                which_knowledge_base_res["choices"][0]["message"]["content"]
-                == "inventory"
-            ):
-                which_category = [
-                    {
-                        "role": "system",
-                        "content": f"Based on the message content, which product category does this context of this message fall in, respond with only one word from this list {Category.objects.all()}, if it is difficult to determine, then you should respond with 'Sorry, we currently don't have this product.",
-                    },
-                    {"role": "user", "content": f"{message}"},
-                ]
-                probable_category = generate_response_chat(which_category, 50)[
-                    "choices"
-                ][0]["message"]["content"]
-                print(probable_category)
-
-                # get the keywords and entities from the analysis nlp mmodule
-                kw_and_ents = extract_topics(message)
-                print("kw_and_ents: ", kw_and_ents)
-
-                def get_matching_products(keywords, probable_category=None):
-                    print("keywords: %s", keywords)
-                    keywords = keywords["keywords"]
-                    queries = [
-                        Q(name__icontains=keyword) | Q(description__icontains=keyword)
-                        for keyword in keywords
-                    ]
-                    print("queries: ", queries)
-
-                    query = queries.pop()
-                    for item in queries:
-                        query |= item
-
-                    if probable_category:
-                        products = Product.objects.filter(
-                            query, category__name__icontains=probable_category
-                        )
-                    else:
-                        products = Product.objects.filter(query)
-
-                    print("products: %s" % products)
-
-                    return [
-                        {"name": product.name, "description": product.description}
-                        for product in products
-                    ]
-
-                def get_contextual_product(message, probable_products):
-                    # Construct a dynamic list of products to include in the prompt.
-                    product_list_string = "\n".join(
-                        [
-                            f"- {product['name']}: {product['description']}"
-                            for product in probable_products
-                        ]
-                    )
-                    print("probable_products: %s", probable_products)
-
-                    prompt = [
-                        {
-                            "role": "system",
-                            "content": f"We have identified the following probable products based on the message content. Which one is the most relevant?\n\n{product_list_string}\n\nIf none of these match, respond with 'None'.",
-                        },
-                        {"role": "user", "content": message},
-                    ]
-
-                    response = generate_response_chat(prompt, 200)
-
-                    return response["choices"][0]["message"]["content"]
-
-                kw_and_ents = extract_topics(message)
-                # probable_category_response = probable_category
-                # probable_category = probable_category_response["choices"][0]["message"][
-                #     "content"
-                # ]
-
-                probable_products = get_matching_products(
-                    kw_and_ents, probable_category
-                )
-
-                # If there's more than one matching product, use OpenAI for further narrowing down.
-                if len(probable_products) > 1:
-                    chosen_product = get_contextual_product(message, probable_products)
-                    print(f"OpenAI's chosen product: {chosen_product}")
-                elif probable_products:
-                    print(f"Direct match found: {probable_products[0]['name']}")
-                else:
-                    print("No matching products found.")
+    @swagger_auto_schema(request_body=AutoResponseSerializer)
+    @action(
+        detail=False,
+        methods=["post"],
+        url_path="(?P<business_id>[^/]+)/(?P<chat_identifier>[^/.]+)/auto-response/stream",
+        renderer_classes=[EventStreamRenderer, JSONRenderer],
+    )
+    def auto_response_stream(self, request, business_id, chat_identifier):
+        """
+        Streaming variant of auto_response for the chat channels: the reply is
+        sent as server-sent events while it is being generated. This view is
+        for WSGI deployments, ASGI ones use AsyncAutoResponseStreamView.
+        """
+        business = get_object_or_404(Business, company_id=business_id)
+        serializer = AutoResponseSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
 
-            response_instructions_prompt = [
-                {
-                    "role": "system",
-                    "content": f"response_instructions: {response_instructions_chat}",
-                },
-                {
-                    "role": "system",
-                    "content": f"knowledge base to answer from: {knowledge_base_contents}",
-                },
-                {
-                    "role": "system",
-                    "content": f"User's previous messages for reflection: {[message.content for message in last_message] if last_message else ''} and your last response was: {[message.sanusi_response for message in last_message] if last_message else ' '} and user's name is {customer_name}",
-                },
-                {"role": "user", "content": f"{message}"},
-            ]
-            answer_4_response = generate_response_chat(
-                response_instructions_prompt, 300
+        validated_data = serializer.validated_data
+        message = validated_data["message"]
+        channel = validated_data["channel"]
+        sender = validated_data["sender"]
+        customer_name = validated_data.get("customer_name")
+        if channel not in valid_channels:
+            ErrorHandler.validation_error(
+                message=f"Streaming is only available for the {', '.join(valid_channels)} channels",
+                field="channel",
             )
 
-            escalation_department_prompt = [
-                {
-                    "role": "system",
-                    "content": f"escalation_instructions: {escalation_instructions}. Possible answers are 'sales', 'operations', 'billing', 'engineering', 'support', 'legal', 'none'. none if you are unable to determine the department from the options provided",
-                },
-                {
-                    "role": "assistant",
-                    "content": f"message to be analysed: {message}",
-                },
-            ]
-            answer_4_escalation_department = generate_response_chat(
-                escalation_department_prompt, 1
-            )
+        chat = get_object_or_404(Chat, business_id=business, identifier=chat_identifier)
 
-            sentiment_analysis_prompt = [
-                {
-                    "role": "system",
-                    "content": f"sentiment_analysis: {sentiment_analysis}. Possible answers are 'positive', 'negative', 'neutral'.",
-                },
-                {
-                    "role": "assistant",
-                    "content": f"message to be analysed: {message}",
-                },
-            ]
-            answer_4_sentiment = generate_response_chat(sentiment_analysis_prompt, 1)
-
-            severity_instructions_prompt = [
-                {
-                    "role": "system",
-                    "content": f"severity_instructions: {severity_instructions}. only answers are 'low', 'medium', 'high'.",
-                },
-                {
-                    "role": "assistant",
-                    "content": f"message to be analysed: {message}",
-                },
-            ]
-            answer_4_severity = generate_response_chat(severity_instructions_prompt, 1)
-            severity = (
-                answer_4_severity["choices"][0]["message"]["content"].lower().strip()
+        knowledge_base_contents = retrieve_knowledge_base(business.company_id, message)
+        if not knowledge_base_contents:
+            return Response(
+                "This business has no knowledge base, kindly create one to activate auto response"
             )
-            if severity not in ["low", "medium", "high"]:
-                severity = "low"  # default to 'low' if invalid response
 
-            chat_context_instructions_prompt = [
-                {
-                    "role": "system",
-                    "content": f"Chat Context instructions: {chat_context_instructions}",
-                },
-                {
-                    "role": "assistant",
-                    "content": f"Chat to be analysed: ('sanusi previous responses': {sanusi_response_str}), ('the user messages': {content_str}), ('user's current message': {message})",
-                },
-            ]
-            answer_4_chat_context = generate_response_chat(
-                chat_context_instructions_prompt, 5
-            )
-            response_json = {
-                "response": answer_4_response["choices"][0]["message"]["content"],
-                "escalate_issue": (
-                    True
-                    if answer_4_escalation_department["choices"][0]["message"][
-                        "content"
-                    ].lower()
-                    in ["sales", "operations", "billing", "engineering", "support"]
-                    else False
-                ),
-                "escalation_department": answer_4_escalation_department["choices"][0][
-                    "message"
-                ]["content"],
-                "severity": severity,
-                "sentiment": answer_4_sentiment["choices"][0]["message"]["content"],
-                "chat_context": answer_4_chat_context["choices"][0]["message"][
-                    "content"
-                ],
-            }
+        # everything but the final save is read before the stream starts
+        response_json = cached_answer(business.company_id, chat, channel, message, customer_name)
+        if response_json is not None:
             save_chat_and_message(chat, sender, message, response_json, channel)
-            return Response(response_json, status=status.HTTP_200_OK)
+            return event_stream_response(cached_answer_events(response_json))
 
-        elif channel == "chat_v1":
-            prompt.insert(0, f"Reply instructions: {chat_v1_instructions}")
-            prompt.insert(
-                1, f"knowledge base to answer based off: {knowledge_base_contents}"
-            )
-            prompt.insert(
-                2,
-                f"User's previous message for reflection: {last_message.content if last_message else ' '}",
-            )
-            prompt.insert(
-                3,
-                f"Openai previous messages: {last_message.content if last_message else ' '}",
+        sanusi_response_str, content_str, last_message = get_chat_history(chat)
+        product = find_product(business.company_id, message)
+        response_prompt = build_chat_response_prompt(
+            message, knowledge_base_contents, last_message, customer_name, product
+        )
+        label_prompts = build_classification_prompts(
+            message, sanusi_response_str, content_str, chat_department_options, 5
+        )
+        return event_stream_response(
+            stream_auto_response_events(
+                chat,
+                sender,
+                message,
+                channel,
+                business.company_id,
+                customer_name,
+                response_prompt,
+                label_prompts,
+                escalation_department_names(business),
             )
-
-            prompt.insert(4, f"User's name: {customer_name}")
-            prompt.insert(5, f"User's Message to be replied to: {message}")
-
-            print("--------------------------------", prompt)
-            response_content = generate_response_email(prompt)
-            answer = response_content["choices"][0]["text"]
-            max_retry_attempts = 3
-            response_json = None
-
-            for attempt in range(max_retry_attempts):
-                print(answer, "--------------Here is answer----------------")
-                try:
-                    start_index = answer.index("{")
-                    end_index = answer.rindex("}") + 1
-                    response_json_str = answer[start_index:end_index]
-                    response_json = json.loads(response_json_str)
-                    print(
-                        response_json,
-                        "-------this is the tried parse--------------",
-                        response_json.get("response"),
-                    )
-                    save_chat_and_message(chat, sender, message, response_json, channel)
-                    return Response(response_json, status=status.HTTP_200_OK)
-                    # break
-                except ValueError:
-                    try:
-                        try:
-                            response_content = re.search(
-                                r"Response: (.*?)\r\n", answer
-                            ).group(1)
-                        except AttributeError:
-                            response_json = parse_response_data(answer)
-                            print(
-                                response_json,
-                                "-----------this is after value error for email_v1---------------------",
-                            )
-                            save_chat_and_message(
-                                chat, sender, message, response_json, channel
-                            )
-                            return Response(response_json, status=status.HTTP_200_OK)
-                    except (
-                        json.JSONDecodeError,
-                        ValueError,
-                        TypeError,
-                        SyntaxError,
-                        AttributeError,
-                    ):
-                        if attempt < max_retry_attempts - 1:  # not the last attempt
-                            prompt[
-                                0
-                            ] += "\nRemember to adhere strictly to the response type instructions provided. An assistant is supposed to listen to instructions"
-                        else:
-                            logger.error("retrying attempt %d", attempt)
-                            continue
-
-            # if answer.index("Response:"):
-            #     try:
-            #         response_json = parse_answer_with_regex(answer)
-            #     except:
-            response_json = answer.strip()
-            save_chat_and_message(chat, sender, message, response_json, channel)
-            return Response(data=response_json, status=status.HTTP_200_OK)
-
-        # elif channel == "chat_v3":
-        #     # Construct the Node object with the appropriate arguments
-        #     for p in prompt:
-        #         content_nodes = []
-        #         node = Node(p)
-        #         content_nodes.append(node)
-        #     response_content = construct_index(content_nodes)
-        #     return Response(data=response_content, status=status.HTTP_200_OK)
+        )
 
     @swagger_auto_schema(request_body=RestructureTextSerializer)
     @action(
@@ -1146,22 +1675,10 @@ class ChatViewSet(viewsets.GenericViewSet):
     def restructure_text(self, request):
         serializer = RestructureTextSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
-        channel = serializer.validated_data["channel"]
-        content = serializer.validated_data["content"]
-
-        if channel == "email":
-            prompt = [
-                f"You are Sanusi's smart assistant that assists with writing professional emails like grammarly, Make sure to avoid mentioning that you are an AI language model. Please regenerate/rewrite the following text into a grammatically correct and formal email body like <p>[your response]</p>: {content}.",
-                # {
-                #     "role": "assistant",
-                #     "content": f"Please restructure the following content to have a formal HTML email format like <p>[your response]</p>.: {content}",
-                # },
-            ]
-        elif channel == "chat":
-            prompt = [
-                f"You are Sanusi's smart assistant that assists with editing text and puts it in a friendly way like grammarly, Make sure to avoid mentioning that you are an AI language model. Please regenerate/rewrite the following text into a grammatically correct one: {content}.",
-            ]
-        new_text = generate_response_email(prompt)
+        prompt = build_restructure_prompt(
+            serializer.validated_data["channel"], serializer.validated_data["content"]
+        )
+        new_text = generate_response_email(prompt, stage=LLMStage.RESTRUCTURE)
         return Response(data=new_text["choices"][0]["text"])
 
     @swagger_auto_schema(request_body=no_body)
@@ -1201,6 +1718,183 @@ class ChatViewSet(viewsets.GenericViewSet):
         return Response(data=serializer.data, status=status.HTTP_200_OK)
 
 
+class AsyncAutoResponseView(AsyncAPIView):
+    """
+    auto_response of the chat channels for ASGI deployments. The LLM calls
+    are awaited on the event loop and the database is reached through
+    sync_to_async, so a request waiting on the provider holds no thread.
+    """
+
+    async def dispatch(self, request, *args, **kwargs):
+        with company_scope(kwargs.get("business_id")):
+            return await super().dispatch(request, *args, **kwargs)
+
+    @swagger_auto_schema(request_body=AutoResponseSerializer)
+    async def post(self, request, business_id, chat_identifier):
+        try:
+            business = await Business.objects.aget(company_id=business_id)
+        except Business.DoesNotExist:
+            raise Http404
+        serializer = AutoResponseSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        validated_data = serializer.validated_data
+        message = validated_data["message"]
+        channel = validated_data["channel"]
+        sender = validated_data["sender"]
+        customer_name = validated_data.get("customer_name")
+        if channel not in valid_channels:
+            ErrorHandler.validation_error(
+                message=f"The async auto response is only available for the {', '.join(valid_channels)} channels",
+                field="channel",
+            )
+
+        try:
+            chat = await Chat.objects.aget(business=business, identifier=chat_identifier)
+        except Chat.DoesNotExist:
+            raise Http404
+
+        knowledge_base_contents = await sync_to_async(retrieve_knowledge_base)(
+            business.company_id, message
+        )
+        if not knowledge_base_contents:
+            return Response(
+                "This business has no knowledge base, kindly create one to activate auto response"
+            )
+
+        save = sync_to_async(transaction.atomic(save_chat_and_message))
+        response_json = await sync_to_async(cached_answer)(
+            business.company_id, chat, channel, message, customer_name
+        )
+        if response_json is not None:
+            await save(chat, sender, message, response_json, channel)
+            return Response(response_json, status=status.HTTP_200_OK)
+
+        # as in chat_pipeline, the routing and product lookup run while the
+        # history loads and the product found is part of the reply prompt
+        (sanusi_response_str, content_str, last_message), product = await asyncio.gather(
+            sync_to_async(get_chat_history)(chat), afind_product(business.company_id, message)
+        )
+        prompts, fused_prompt = build_chat_prompts(
+            message,
+            knowledge_base_contents,
+            sanusi_response_str,
+            content_str,
+            last_message,
+            customer_name,
+            product,
+        )
+        departments = await sync_to_async(escalation_department_names)(business)
+        answers = await agenerate_reply_and_labels(
+            prompts, fused_prompt, message=message, departments=departments
+        )
+
+        response_json = build_auto_response_json(answers)
+        await sync_to_async(semantic_cache.store)(
+            business.company_id, channel, message, response_json, customer_name
+        )
+        await save(chat, sender, message, response_json, channel)
+        return Response(response_json, status=status.HTTP_200_OK)
+
+
+class AsyncAutoResponseStreamView(AsyncAPIView):
+    """
+    auto_response_stream for ASGI deployments: the events come from an
+    async generator, so the reply is streamed without holding a thread and
+    the database is only reached through sync_to_async. Needs the
+    StreamingASGIHandler of sanusi_backend.asgi.
+    """
+
+    renderer_classes = [EventStreamRenderer, JSONRenderer]
+
+    async def dispatch(self, request, *args, **kwargs):
+        with company_scope(kwargs.get("business_id")):
+            return await super().dispatch(request, *args, **kwargs)
+
+    @swagger_auto_schema(request_body=AutoResponseSerializer)
+    async def post(self, request, business_id, chat_identifier):
+        try:
+            business = await Business.objects.aget(company_id=business_id)
+        except Business.DoesNotExist:
+            raise Http404
+        serializer = AutoResponseSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        validated_data = serializer.validated_data
+        message = validated_data["message"]
+        channel = validated_data["channel"]
+        sender = validated_data["sender"]
+        customer_name = validated_data.get("customer_name")
+        if channel not in valid_channels:
+            ErrorHandler.validation_error(
+                message=f"Streaming is only available for the {', '.join(valid_channels)} channels",
+                field="channel",
+            )
+
+        try:
+            chat = await Chat.objects.aget(business=business, identifier=chat_identifier)
+        except Chat.DoesNotExist:
+            raise Http404
+
+        knowledge_base_contents = await sync_to_async(retrieve_knowledge_base)(
+            business.company_id, message
+        )
+        if not knowledge_base_contents:
+            return Response(
+                "This business has no knowledge base, kindly create one to activate auto response"
+            )
+
+        response_json = await sync_to_async(cached_answer)(
+            business.company_id, chat, channel, message, customer_name
+        )
+        if response_json is not None:
+            await sync_to_async(transaction.atomic(save_chat_and_message))(
+                chat, sender, message, response_json, channel
+            )
+            return event_stream_response(
+                acached_answer_events(response_json), AsyncStreamingHttpResponse
+            )
+
+        (sanusi_response_str, content_str, last_message), product = await asyncio.gather(
+            sync_to_async(get_chat_history)(chat), afind_product(business.company_id, message)
+        )
+        response_prompt = build_chat_response_prompt(
+            message, knowledge_base_contents, last_message, customer_name, product
+        )
+        label_prompts = build_classification_prompts(
+            message, sanusi_response_str, content_str, chat_department_options, 5
+        )
+        departments = await sync_to_async(escalation_department_names)(business)
+        return event_stream_response(
+            astream_auto_response_events(
+                chat,
+                sender,
+                message,
+                channel,
+                business.company_id,
+                customer_name,
+                response_prompt,
+                label_prompts,
+                departments,
+            ),
+            AsyncStreamingHttpResponse,
+        )
+
+
+class AsyncRestructureTextView(AsyncAPIView):
+    """restructure_text for ASGI deployments."""
+
+    @swagger_auto_schema(request_body=RestructureTextSerializer)
+    async def post(self, request):
+        serializer = RestructureTextSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        prompt = build_restructure_prompt(
+            serializer.validated_data["channel"], serializer.validated_data["content"]
+        )
+        new_text = await agenerate_response_email(prompt, stage=LLMStage.RESTRUCTURE)
+        return Response(data=new_text["choices"][0]["text"])
+
+
 # Create a new chat
 def create_chat(request):
     if request.method == "POST":
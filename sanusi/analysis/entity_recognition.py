@@ -1,17 +1,65 @@
-from rake_nltk import Rake
+import threading
+import time
+
 import spacy
+from loguru import logger
+from rake_nltk import Rake
+
+from sanusi.preprocessing.stopword_removal import english_stopwords
+
+SPACY_MODEL = "en_core_web_sm"
+# only the entity recognizer is used, the rest of the model is never loaded
+UNUSED_COMPONENTS = ["tagger", "parser", "senter", "attribute_ruler", "lemmatizer"]
+
+_nlp = None
+_nlp_lock = threading.Lock()
+
+
+def load_nlp():
+    nlp = spacy.load(SPACY_MODEL, exclude=UNUSED_COMPONENTS)
+    if "tok2vec" in nlp.pipe_names and "ner" not in nlp.get_pipe("tok2vec").listening_components:
+        # the shared tok2vec layer only feeds the excluded components
+        nlp.remove_pipe("tok2vec")
+    return nlp
+
+
+def get_nlp():
+    """
+    The spaCy pipeline, loaded on first use and shared by every thread of
+    the process, so processes that never extract entities never load it.
+    """
+    global _nlp
+
+    if _nlp is None:
+        with _nlp_lock:
+            if _nlp is None:
+                started = time.perf_counter()
+                _nlp = load_nlp()
+                logger.info(
+                    "Loaded spaCy model",
+                    model=SPACY_MODEL,
+                    components=_nlp.pipe_names,
+                    duration_ms=round((time.perf_counter() - started) * 1000, 1),
+                )
+    return _nlp
+
 
-nlp = spacy.load("en_core_web_sm")
+def warm_up():
+    """
+    Load the pipeline and run it once, e.g. in a server process before it
+    forks its workers so they share the loaded model copy-on-write.
+    """
+    get_nlp()("Warm up the entity recognizer.")
 
 
 def extract_keywords(text):
-    r = Rake()
+    r = Rake(stopwords=english_stopwords())
     r.extract_keywords_from_text(text)
     return r.get_ranked_phrases()
 
 
 def extract_entities(text):
-    doc = nlp(text)
+    doc = get_nlp()(text)
     entities = [(ent.text, ent.label_) for ent in doc.ents]
     return entities
 
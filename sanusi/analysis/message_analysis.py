@@ -0,0 +1,99 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import NamedTuple, Tuple
+
+from django.conf import settings
+
+from sanusi.preprocessing.lemmatize import lemmatize_token
+
+from .entity_recognition import extract_keywords, get_nlp
+
+
+class MessageAnalysis(NamedTuple):
+    """
+    NLP analysis of a message: its RAKE keywords, best first, its named
+    entities as (text, label) pairs, and its tokens with their lemmas.
+    """
+
+    text: str
+    keywords: Tuple[str, ...]
+    entities: Tuple[Tuple[str, str], ...]
+    tokens: Tuple[str, ...]
+    lemmas: Tuple[str, ...]
+
+    def topics(self):
+        """The keywords and entities in the shape extract_topics returns them."""
+        entities = list(dict.fromkeys(entity for entity, label in self.entities))
+        return {
+            "keywords": list(self.keywords),
+            "entities": entities,
+            "combined": list(dict.fromkeys(list(self.keywords) + entities)),
+        }
+
+
+def _lemmas(tokens):
+    try:
+        return tuple(lemmatize_token(token.lower()) for token in tokens)
+    except LookupError:
+        # without the WordNet data the lower-cased tokens stand in
+        return tuple(token.lower() for token in tokens)
+
+
+def analyze(text):
+    doc = get_nlp()(text)
+    tokens = tuple(token.text for token in doc)
+    return MessageAnalysis(
+        text=text,
+        keywords=tuple(dict.fromkeys(extract_keywords(text))),
+        entities=tuple((ent.text, ent.label_) for ent in doc.ents),
+        tokens=tokens,
+        lemmas=_lemmas(tokens),
+    )
+
+
+class MessageAnalyzer:
+    """
+    Memoizes analyze for the max_size most recently analysed messages, so
+    every stage of a reply can ask for the analysis of its message and the
+    message is analysed once. Concurrent requests for a message being
+    analysed wait for that analysis.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._analyses = OrderedDict()
+        self._lock = threading.Lock()
+
+    def analyze(self, text):
+        text = str(text)
+        with self._lock:
+            future = self._analyses.get(text)
+            leader = future is None
+            if leader:
+                future = self._analyses[text] = Future()
+                while len(self._analyses) > self.max_size:
+                    self._analyses.popitem(last=False)
+            else:
+                self._analyses.move_to_end(text)
+
+        if not leader:
+            return future.result()
+        try:
+            analysis = analyze(text)
+        except BaseException as e:
+            with self._lock:
+                if self._analyses.get(text) is future:
+                    del self._analyses[text]
+            future.set_exception(e)
+            raise
+        future.set_result(analysis)
+        return analysis
+
+
+message_analyzer = MessageAnalyzer(settings.MESSAGE_ANALYSIS_CACHE_SIZE)
+
+
+def analyze_message(text):
+    """The memoized MessageAnalysis of text."""
+    return message_analyzer.analyze(text)
@@ -0,0 +1,48 @@
+import numpy as np
+from sklearn.feature_extraction.text import HashingVectorizer
+
+EMBEDDING_DIMENSIONS = 1024
+
+# Stateless hashed features, so embeddings are stable across processes and
+# restarts without a fitted vocabulary. Character n-grams absorb typos and
+# inflections, word n-grams keep some of the word order.
+_char_vectorizer = HashingVectorizer(
+    analyzer="char_wb",
+    ngram_range=(3, 5),
+    n_features=EMBEDDING_DIMENSIONS,
+    alternate_sign=False,
+    norm="l2",
+)
+_word_vectorizer = HashingVectorizer(
+    analyzer="word",
+    ngram_range=(1, 2),
+    n_features=EMBEDDING_DIMENSIONS,
+    alternate_sign=False,
+    norm="l2",
+)
+
+
+def embed_texts(texts):
+    """
+    Return an L2-normalised float32 matrix with one embedding row per text.
+    """
+    texts = [" ".join(str(text).lower().split()) for text in texts]
+    embeddings = (
+        _char_vectorizer.transform(texts) + _word_vectorizer.transform(texts)
+    ).toarray()
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (embeddings / norms).astype(np.float32)
+
+
+def embed_text(text):
+    return embed_texts([text])[0]
+
+
+def cosine_similarities(embedding, embeddings):
+    """
+    Cosine similarity of one normalised embedding against a matrix of them.
+    """
+    if len(embeddings) == 0:
+        return np.zeros(0, dtype=np.float32)
+    return embeddings @ embedding
@@ -0,0 +1,14 @@
+from .text_classification import classify_messages
+
+SENTIMENT_LABELS = ["positive", "negative", "neutral"]
+
+
+def analyze_sentiment(texts):
+    """
+    Sentiment of a batch of texts from the local sentiment model.
+
+    Returns:
+        list: (label, confidence) per text, or None when no sentiment model
+        has been trained yet.
+    """
+    return classify_messages(texts, ["sentiment"]).get("sentiment")
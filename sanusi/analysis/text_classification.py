@@ -0,0 +1,252 @@
+import os
+import threading
+from collections import Counter
+
+import joblib
+import numpy as np
+from django.conf import settings
+from django.utils import timezone
+from loguru import logger
+from scipy.special import expit, softmax
+from sklearn.feature_extraction.text import CountVectorizer, HashingVectorizer
+from sklearn.linear_model import LogisticRegression
+
+
+_word_ngrams = CountVectorizer(analyzer="word", ngram_range=(1, 2)).build_analyzer()
+_char_ngrams = CountVectorizer(analyzer="char_wb", ngram_range=(2, 4)).build_analyzer()
+
+
+def message_ngrams(text):
+    """
+    Word unigrams/bigrams plus character n-grams (robust to typos). Character
+    n-grams are prefixed so they never share a hash bucket with a word.
+    """
+    return _word_ngrams(text) + ["#" + ngram for ngram in _char_ngrams(text)]
+
+
+class MessageFeatures:
+    """
+    Vectorized feature extractor shared by every label model.
+
+    Hashed message n-grams with sublinear term frequencies, re-weighted by IDF
+    weights fitted on the training messages and L2-normalised. The steps are
+    composed by hand rather than through Pipeline/TfidfTransformer, whose
+    per-call validation costs more than the maths for a single message.
+    """
+
+    def __init__(self, n_features=2**19):
+        self.hasher = HashingVectorizer(
+            analyzer=message_ngrams,
+            n_features=n_features,
+            alternate_sign=False,
+            norm=None,
+        )
+        self.idf = None
+
+    def _counts(self, texts):
+        counts = self.hasher.transform(texts)
+        counts.data = np.log1p(counts.data)
+        return counts
+
+    def fit_transform(self, texts):
+        counts = self._counts(texts)
+        document_frequency = np.bincount(counts.indices, minlength=counts.shape[1])
+        self.idf = np.log((1 + counts.shape[0]) / (1 + document_frequency)) + 1
+        return self._weight(counts)
+
+    def transform(self, texts):
+        return self._weight(self._counts(texts))
+
+    def _weight(self, counts):
+        counts.data *= self.idf[counts.indices]
+        rows = np.repeat(np.arange(counts.shape[0]), np.diff(counts.indptr))
+        norms = np.sqrt(
+            np.bincount(rows, weights=counts.data**2, minlength=counts.shape[0])
+        )
+        norms[norms == 0] = 1.0
+        counts.data /= norms[rows]
+        return counts
+
+
+class TextClassifier:
+    """
+    A CPU-only text classifier for one label task (sentiment, severity, ...).
+    """
+
+    def __init__(self, task, features=None, model=None, trained_at=None, samples=0):
+        self.task = task
+        self.features = features
+        self.model = model
+        self.trained_at = trained_at
+        self.samples = samples
+
+    @property
+    def labels(self):
+        return [str(label) for label in self.model.classes_] if self.model is not None else []
+
+    def fit(self, texts, labels):
+        self.features = MessageFeatures()
+        matrix = self.features.fit_transform([normalize_text(text) for text in texts])
+        self.model = LogisticRegression(max_iter=1000, class_weight="balanced")
+        self.model.fit(matrix, labels)
+        self.trained_at = timezone.now()
+        self.samples = len(texts)
+        return self
+
+    def predict_proba(self, texts):
+        # Same maths as LogisticRegression.predict_proba without its input
+        # validation, which costs more than the prediction for one message.
+        matrix = self.features.transform([normalize_text(text) for text in texts])
+        scores = matrix @ self.model.coef_.T + self.model.intercept_
+        if scores.shape[1] == 1:
+            positive = expit(scores)
+            return np.hstack([1 - positive, positive])
+        return softmax(scores, axis=1)
+
+    def predict_batch(self, texts):
+        """
+        Label a batch of texts in one vectorized pass.
+
+        Returns:
+            list: (label, confidence) per text, confidence being the
+            predicted class probability.
+        """
+        if not texts:
+            return []
+        probabilities = self.predict_proba(texts)
+        best = np.argmax(probabilities, axis=1)
+        classes = self.labels
+        return [
+            (classes[index], float(row[index]))
+            for index, row in zip(best, probabilities)
+        ]
+
+    def predict(self, text):
+        return self.predict_batch([text])[0]
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        joblib.dump(
+            {
+                "task": self.task,
+                "features": self.features,
+                "model": self.model,
+                "trained_at": self.trained_at,
+                "samples": self.samples,
+            },
+            path,
+        )
+
+    @classmethod
+    def load(cls, path):
+        data = joblib.load(path)
+        return cls(
+            task=data["task"],
+            features=data["features"],
+            model=data["model"],
+            trained_at=data["trained_at"],
+            samples=data["samples"],
+        )
+
+
+def normalize_text(text):
+    return " ".join(str(text).lower().split())
+
+
+def model_path(task):
+    return os.path.join(settings.LABEL_MODEL_DIR, f"{task}.joblib")
+
+
+def train_classifier(task, texts, labels, min_samples=None):
+    """
+    Train and persist the classifier for task.
+
+    Returns:
+        TextClassifier: The trained model, or None when there is not enough
+        data (fewer than min_samples examples or a single label).
+    """
+    min_samples = min_samples or settings.LABEL_MODEL_MIN_SAMPLES
+    if len(texts) < min_samples or len(set(labels)) < 2:
+        logger.warning(
+            "Not enough data to train label model",
+            task=task,
+            samples=len(texts),
+            labels=dict(Counter(labels)),
+        )
+        return None
+
+    classifier = TextClassifier(task).fit(texts, labels)
+    classifier.save(model_path(task))
+    _models.pop(task, None)
+    logger.info(
+        "Trained label model",
+        task=task,
+        samples=len(texts),
+        labels=dict(Counter(labels)),
+    )
+    return classifier
+
+
+_models = {}
+_models_lock = threading.Lock()
+
+
+def _model_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def get_classifier(task):
+    """
+    Return the trained classifier for task, loaded once per process and
+    reloaded when its model file changes, e.g. after it was (re)trained by
+    another process. None while no model has been trained.
+    """
+    path = model_path(task)
+    mtime = _model_mtime(path)
+    cached = _models.get(task)
+    if cached is None or cached[0] != mtime:
+        with _models_lock:
+            cached = _models.get(task)
+            if cached is None or cached[0] != mtime:
+                classifier = None
+                if mtime is not None:
+                    try:
+                        classifier = TextClassifier.load(path)
+                    except Exception as e:
+                        logger.error(f"Failed to load label model {task}: {str(e)}")
+                # a failed load is only retried once the file changes again
+                _models[task] = cached = (mtime, classifier)
+    return cached[1]
+
+
+def classify_messages(texts, tasks):
+    """
+    Batch predict API: label every text for each task that has a model.
+
+    Returns:
+        dict: task -> list of (label, confidence), one per text.
+    """
+    predictions = {}
+    for task in tasks:
+        classifier = get_classifier(task)
+        if classifier is not None:
+            predictions[task] = classifier.predict_batch(texts)
+    return predictions
+
+
+def confident_labels(message, tasks, min_confidence=None):
+    """
+    Labels for a single message whose confidence reaches min_confidence.
+
+    Returns:
+        dict: task -> label, only for the confident predictions.
+    """
+    min_confidence = min_confidence or settings.LABEL_MODEL_MIN_CONFIDENCE
+    return {
+        task: results[0][0]
+        for task, results in classify_messages([message], tasks).items()
+        if results[0][1] >= min_confidence
+    }
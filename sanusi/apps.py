@@ -1,6 +1,16 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class SanusiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'sanusi'
+
+    def ready(self):
+        from .llm.ratelimit import check_settings
+
+        check_settings()
+        if settings.NLP_WARM_UP:
+            from .analysis.entity_recognition import warm_up
+
+            warm_up()
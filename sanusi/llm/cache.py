@@ -0,0 +1,173 @@
+import hashlib
+import json
+import re
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+from django.conf import settings
+from django.core.cache import caches
+from loguru import logger
+from openai.openai_object import OpenAIObject
+from openai.util import convert_to_openai_object
+
+
+def normalize_messages(messages):
+    """
+    Normalise chat messages for cache keys: whitespace is collapsed and the
+    content case-folded so "Thanks " and "thanks" share an entry.
+    """
+    return [
+        {
+            "role": message.get("role"),
+            "content": re.sub(r"\s+", " ", str(message.get("content", ""))).strip().casefold(),
+        }
+        for message in messages
+    ]
+
+
+def make_cache_key(messages, params):
+    """
+    Hash the normalised messages together with the model and sampling parameters.
+    """
+    payload = json.dumps(
+        {"messages": normalize_messages(messages), "params": params},
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LocalLRUCache:
+    """
+    Small thread-safe in-process cache with per-entry TTL and LRU eviction.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class LLMResponseCache:
+    """
+    Exact-match cache for label-style LLM calls.
+
+    Lookups go to the in-process LRU tier first and then to the shared Django
+    cache backend, so a label computed by one worker is reused by the others.
+    Only the stages with a TTL in LLM_CACHE_TTLS are cached.
+    """
+
+    key_prefix = "llm:response"
+
+    def __init__(self, alias, ttls, max_local_entries, enabled=True):
+        self.alias = alias
+        self.ttls = ttls
+        self.enabled = enabled
+        self.local = LocalLRUCache(max_local_entries)
+        self._counters = defaultdict(lambda: defaultdict(int))
+        self._counters_lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            alias=settings.LLM_CACHE_ALIAS,
+            ttls=settings.LLM_CACHE_TTLS,
+            max_local_entries=settings.LLM_CACHE_LOCAL_MAX_ENTRIES,
+            enabled=settings.LLM_CACHE_ENABLED,
+        )
+
+    @property
+    def shared(self):
+        return caches[self.alias]
+
+    def is_cacheable(self, stage):
+        return self.enabled and stage in self.ttls
+
+    def get(self, stage, key):
+        """
+        Return the cached completion for key as an OpenAI object, or None.
+        """
+        value = self.local.get(key)
+        tier = "local_hits"
+        if value is None:
+            try:
+                value = self.shared.get(f"{self.key_prefix}:{stage}:{key}")
+            except Exception as e:
+                logger.warning(f"LLM cache backend read failed: {str(e)}")
+                value = None
+            tier = "shared_hits"
+            if value is not None:
+                self.local.set(key, value, self.ttls[stage])
+
+        if value is None:
+            self._count(stage, "misses")
+            return None
+
+        self._count(stage, tier)
+        self._count(
+            stage, "tokens_saved", value.get("usage", {}).get("total_tokens", 0)
+        )
+        return convert_to_openai_object(value)
+
+    def set(self, stage, key, response):
+        if not isinstance(response, OpenAIObject):
+            return  # failed calls are never cached
+        value = response.to_dict_recursive()
+        ttl = self.ttls[stage]
+        self.local.set(key, value, ttl)
+        try:
+            self.shared.set(f"{self.key_prefix}:{stage}:{key}", value, ttl)
+        except Exception as e:
+            logger.warning(f"LLM cache backend write failed: {str(e)}")
+
+    def _count(self, stage, counter, amount=1):
+        with self._counters_lock:
+            self._counters[stage][counter] += amount
+
+    def stats(self):
+        """
+        Hit/miss counters per stage for this process.
+        """
+        with self._counters_lock:
+            stages = {stage: dict(counters) for stage, counters in self._counters.items()}
+
+        for counters in stages.values():
+            hits = counters.get("local_hits", 0) + counters.get("shared_hits", 0)
+            lookups = hits + counters.get("misses", 0)
+            counters["hit_ratio"] = round(hits / lookups, 4) if lookups else 0.0
+
+        return {
+            "enabled": self.enabled,
+            "local_entries": len(self.local),
+            "stages": stages,
+        }
+
+
+response_cache = LLMResponseCache.from_settings()
@@ -0,0 +1,161 @@
+import asyncio
+import os
+import threading
+import weakref
+from functools import partial
+
+import aiohttp
+import openai
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+from .metrics import LLMCall
+from .providers import build_provider
+from .ratelimit import RateLimiter
+from .retry import CircuitBreaker, RetryPolicy, acall_with_retry, call_with_retry
+
+
+class PooledSession(requests.Session):
+    """
+    A requests session shared by every thread of the process.
+
+    The openai library closes the session it was given every few minutes to
+    recycle connections. close() is a no-op here so the pooled keep-alive
+    connections survive that; use shutdown() to really release the pool.
+    """
+
+    def __init__(self, pool_connections, pool_maxsize, pool_block=False):
+        super().__init__()
+        adapter = HTTPAdapter(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            pool_block=pool_block,
+            max_retries=0,  # retries are decided by the callers, not the transport
+        )
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
+    def close(self):
+        pass
+
+    def shutdown(self):
+        super().close()
+
+
+class LLMClient:
+    """
+    Entry point for every outbound LLM call.
+
+    Sends completions to the configured provider (see LLM_PROVIDER) so that
+    they all share one pooled session, carry the configured (connect, read)
+    timeouts, go through the retry policy and the process-wide circuit
+    breaker and have each attempt admitted by the rate limiter. Every call
+    is traced and recorded in the LLM metrics under its stage (see
+    LLMStage) and the business of the current company_scope.
+
+    The a-prefixed methods are their coroutine counterparts for async views.
+    They share the limiter and breaker with the threaded calls and pool
+    their connections in one aiohttp session per event loop.
+    """
+
+    def __init__(self, provider, session, timeout, retry_policy, breaker, limiter):
+        self.provider = provider
+        self.session = session
+        self.timeout = timeout
+        self.retry_policy = retry_policy
+        self.breaker = breaker
+        self.limiter = limiter
+        self._aiosessions = weakref.WeakKeyDictionary()
+
+    def _create(self, create, params, stage):
+        params.setdefault("request_timeout", self.timeout)
+        with LLMCall(stage, params) as call:
+            response = call_with_retry(
+                partial(create, **params),
+                policy=self.retry_policy,
+                breaker=self.breaker,
+                on_retry=call.retried,
+                admit=partial(self.limiter.admit, params),
+            )
+        return call.finish(response)
+
+    def chat_completion(self, stage=None, **params):
+        return self._create(self.provider.chat_completion, params, stage)
+
+    def completion(self, stage=None, **params):
+        return self._create(self.provider.completion, params, stage)
+
+    def aiosession(self):
+        """The aiohttp session of the running event loop, created on first use."""
+        loop = asyncio.get_running_loop()
+        session = self._aiosessions.get(loop)
+        if session is None or session.closed:
+            session = self._aiosessions[loop] = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=settings.LLM_POOL_MAXSIZE)
+            )
+        return session
+
+    async def _acreate(self, acreate, params, stage):
+        params.setdefault("request_timeout", self.timeout)
+        token = openai.aiosession.set(self.aiosession())
+        try:
+            with LLMCall(stage, params) as call:
+                response = await acall_with_retry(
+                    partial(acreate, **params),
+                    policy=self.retry_policy,
+                    breaker=self.breaker,
+                    on_retry=call.retried,
+                    admit=partial(self.limiter.aadmit, params),
+                )
+        finally:
+            openai.aiosession.reset(token)
+        return call.finish(response)
+
+    async def achat_completion(self, stage=None, **params):
+        return await self._acreate(self.provider.achat_completion, params, stage)
+
+    async def acompletion(self, stage=None, **params):
+        return await self._acreate(self.provider.acompletion, params, stage)
+
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+def build_session():
+    return PooledSession(
+        pool_connections=settings.LLM_POOL_CONNECTIONS,
+        pool_maxsize=settings.LLM_POOL_MAXSIZE,
+        pool_block=settings.LLM_POOL_BLOCK,
+    )
+
+
+def get_client():
+    """
+    Return the process-wide LLM client, creating it on first use.
+
+    The client is rebuilt after a fork so worker processes never share
+    sockets with their parent.
+    """
+    global _client, _client_pid
+
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _client_lock:
+            if _client is None or _client_pid != pid:
+                session = build_session()
+                openai.requestssession = session
+                if settings.LLM_API_BASE:
+                    openai.api_base = settings.LLM_API_BASE
+                _client = LLMClient(
+                    build_provider(settings.LLM_PROVIDER),
+                    session,
+                    timeout=(settings.LLM_CONNECT_TIMEOUT, settings.LLM_READ_TIMEOUT),
+                    retry_policy=RetryPolicy.from_settings(),
+                    breaker=CircuitBreaker.from_settings(),
+                    limiter=RateLimiter.from_settings(),
+                )
+                _client_pid = pid
+    return _client
@@ -0,0 +1,278 @@
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from loguru import logger
+from opentelemetry import trace
+from opentelemetry.trace import Status, StatusCode
+
+from sanusi.utilities.helpers import count_tokens
+
+tracer = trace.get_tracer(__name__)
+
+# Business the LLM calls of the current request are made for, see
+# company_scope. run_concurrently copies it into its worker threads.
+current_company_id = ContextVar("llm_company_id", default=None)
+
+UNKNOWN_COMPANY = "unknown"
+UNLABELLED_STAGE = "unlabelled"
+
+
+@contextmanager
+def company_scope(company_id):
+    """Attribute the LLM calls made inside the block to company_id."""
+    token = current_company_id.set(str(company_id) if company_id else None)
+    try:
+        yield
+    finally:
+        current_company_id.reset(token)
+
+
+def call_cost(model, prompt_tokens, completion_tokens):
+    """Estimated USD cost of a call, from LLM_TOKEN_PRICES."""
+    prices = settings.LLM_TOKEN_PRICES.get(model)
+    if prices is None:
+        return 0.0
+    prompt_price, completion_price = prices
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+
+
+def prompt_text(params):
+    """Text sent to the provider by a chat completion or completion call."""
+    if "messages" in params:
+        return "\n".join(str(message.get("content", "")) for message in params["messages"])
+    prompt = params.get("prompt", "")
+    return prompt if isinstance(prompt, str) else "\n".join(prompt)
+
+
+class LLMMetrics:
+    """
+    Totals of the LLM calls made by this process, per business and stage.
+    """
+
+    def __init__(self):
+        self._totals = defaultdict(lambda: defaultdict(float))
+        self._lock = threading.Lock()
+
+    def record(
+        self,
+        company_id,
+        stage,
+        duration,
+        prompt_tokens,
+        completion_tokens,
+        retries,
+        cost,
+        failed,
+    ):
+        with self._lock:
+            totals = self._totals[(company_id, stage)]
+            totals["calls"] += 1
+            totals["errors"] += int(failed)
+            totals["retries"] += retries
+            totals["prompt_tokens"] += prompt_tokens
+            totals["completion_tokens"] += completion_tokens
+            totals["cost"] += cost
+            totals["duration"] += duration
+            totals["max_duration"] = max(totals["max_duration"], duration)
+
+    @staticmethod
+    def _summary(rows):
+        summary = defaultdict(float)
+        for totals in rows:
+            for name, value in totals.items():
+                if name == "max_duration":
+                    summary[name] = max(summary[name], value)
+                else:
+                    summary[name] += value
+        calls = int(summary["calls"])
+        return {
+            "calls": calls,
+            "errors": int(summary["errors"]),
+            "retries": int(summary["retries"]),
+            "prompt_tokens": int(summary["prompt_tokens"]),
+            "completion_tokens": int(summary["completion_tokens"]),
+            "cost": round(summary["cost"], 6),
+            "avg_duration_ms": round(summary["duration"] * 1000 / calls, 1) if calls else 0.0,
+            "max_duration_ms": round(summary["max_duration"] * 1000, 1),
+        }
+
+    def _by_stage(self, totals):
+        stages = defaultdict(list)
+        for (company_id, stage), counters in totals.items():
+            stages[stage].append(counters)
+        return {stage: self._summary(rows) for stage, rows in sorted(stages.items())}
+
+    def stats(self, company_id=None):
+        """
+        Summaries of the calls overall, per stage and per business, the most
+        expensive businesses first. With company_id, only that business's.
+        """
+        with self._lock:
+            totals = {key: dict(counters) for key, counters in self._totals.items()}
+
+        if company_id is not None:
+            company_id = str(company_id)
+            totals = {key: counters for key, counters in totals.items() if key[0] == company_id}
+            return {
+                "company_id": company_id,
+                "totals": self._summary(totals.values()),
+                "by_stage": self._by_stage(totals),
+            }
+
+        companies = defaultdict(dict)
+        for key, counters in totals.items():
+            companies[key[0]][key] = counters
+        by_company = {
+            company: {
+                "totals": self._summary(company_totals.values()),
+                "by_stage": self._by_stage(company_totals),
+            }
+            for company, company_totals in companies.items()
+        }
+        return {
+            "totals": self._summary(totals.values()),
+            "by_stage": self._by_stage(totals),
+            "by_company": dict(
+                sorted(by_company.items(), key=lambda item: -item[1]["totals"]["cost"])
+            ),
+        }
+
+
+llm_metrics = LLMMetrics()
+
+
+class LLMCall:
+    """
+    Trace and metrics record of one LLM call, retries included.
+
+    Used as a context manager around the provider call: the OpenTelemetry
+    span is current inside the block, so the HTTP spans of the attempts nest
+    under it. finish() records the call from the response usage; streamed
+    responses are recorded once the stream has been consumed.
+    """
+
+    def __init__(self, stage, params, metrics=llm_metrics):
+        self.stage = stage or UNLABELLED_STAGE
+        self.params = params
+        self.model = params.get("model") or params.get("engine")
+        self.company_id = current_company_id.get() or UNKNOWN_COMPANY
+        self.metrics = metrics
+        self.retries = 0
+        self.span = tracer.start_span(
+            f"llm.{self.stage}",
+            attributes={
+                "llm.stage": self.stage,
+                "llm.model": self.model or "",
+                "llm.company_id": self.company_id,
+                "llm.stream": bool(params.get("stream")),
+            },
+        )
+        self._scope = None
+        self._started = time.perf_counter()
+        self._ended = False
+
+    def __enter__(self):
+        self._scope = trace.use_span(
+            self.span, record_exception=False, set_status_on_exception=False
+        )
+        self._scope.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._scope.__exit__(exc_type, exc, tb)
+        if exc is not None and isinstance(exc, Exception):
+            self.fail(exc)
+        return False
+
+    def retried(self, attempt, exc):
+        self.retries += 1
+        self.span.add_event(
+            "llm.retry", {"attempt": attempt, "error.type": type(exc).__name__}
+        )
+
+    def finish(self, response):
+        """Record a successful call and return its response."""
+        if self.params.get("stream"):
+            if hasattr(response, "__aiter__"):
+                return self._aconsume_stream(response)
+            return self._consume_stream(response)
+        usage = response.get("usage") or {}
+        prompt_tokens = usage.get("prompt_tokens")
+        if prompt_tokens is None:
+            prompt_tokens = count_tokens(prompt_text(self.params))
+        self._end(prompt_tokens, usage.get("completion_tokens", 0))
+        return response
+
+    def fail(self, exc):
+        self.span.record_exception(exc)
+        self.span.set_status(Status(StatusCode.ERROR, type(exc).__name__))
+        self._end(0, 0, error=exc)
+
+    def _consume_stream(self, chunks):
+        # streamed completions carry no usage, it is counted from the text
+        parts = []
+        try:
+            for chunk in chunks:
+                parts.append(chunk["choices"][0].get("delta", {}).get("content") or "")
+                yield chunk
+        except Exception as e:
+            self.fail(e)
+            raise
+        finally:
+            self._end(count_tokens(prompt_text(self.params)), count_tokens("".join(parts)))
+
+    async def _aconsume_stream(self, chunks):
+        parts = []
+        try:
+            async for chunk in chunks:
+                parts.append(chunk["choices"][0].get("delta", {}).get("content") or "")
+                yield chunk
+        except Exception as e:
+            self.fail(e)
+            raise
+        finally:
+            self._end(count_tokens(prompt_text(self.params)), count_tokens("".join(parts)))
+
+    def _end(self, prompt_tokens, completion_tokens, error=None):
+        if self._ended:
+            return
+        self._ended = True
+        duration = time.perf_counter() - self._started
+        cost = call_cost(self.model, prompt_tokens, completion_tokens)
+
+        self.span.set_attributes(
+            {
+                "llm.usage.prompt_tokens": prompt_tokens,
+                "llm.usage.completion_tokens": completion_tokens,
+                "llm.retries": self.retries,
+                "llm.cost_usd": cost,
+                "operation.success": error is None,
+            }
+        )
+        self.span.end()
+        self.metrics.record(
+            self.company_id,
+            self.stage,
+            duration,
+            prompt_tokens,
+            completion_tokens,
+            self.retries,
+            cost,
+            failed=error is not None,
+        )
+        logger.info(
+            "LLM call",
+            stage=self.stage,
+            model=self.model,
+            company_id=self.company_id,
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            retries=self.retries,
+            duration_ms=round(duration * 1000, 1),
+            cost=round(cost, 6),
+            error=type(error).__name__ if error is not None else None,
+        )
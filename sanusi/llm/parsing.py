@@ -0,0 +1,277 @@
+import json
+import re
+import threading
+from collections import defaultdict
+
+from loguru import logger
+
+from sanusi.utils import (
+    REQUIRED_RESPONSE_KEYS,
+    RESPONSE_FORMAT_VALIDATORS,
+    invalid_format_fields,
+    normalize_structured_response,
+)
+
+
+class Repair:
+    """
+    Names of the fixes AnswerParser applies to answers that are not plain
+    JSON, reported on the ParsedAnswer and counted in its stats.
+    """
+
+    CODE_FENCE = "code_fence"
+    PROSE = "prose"
+    SINGLE_QUOTES = "single_quotes"
+    INNER_QUOTES = "inner_quotes"
+    PYTHON_LITERALS = "python_literals"
+    BARE_KEYS = "bare_keys"
+    BARE_VALUES = "bare_values"
+    TRAILING_COMMA = "trailing_comma"
+    TRUNCATED = "truncated"
+    KEY_VALUES = "key_values"
+
+
+CODE_FENCE_RE = re.compile(r"```[a-zA-Z]*\s*(.*?)\s*```", re.DOTALL)
+BARE_WORD_RE = re.compile(r"[A-Za-z_][^,:{}\[\]\"'\r\n]*")
+# runs of characters copied through as they are
+PLAIN_RE = re.compile(r"[^{}\[\]\"',A-Za-z_]+")
+UNESCAPED_QUOTE_RE = re.compile(r'(?<!\\)"')
+# "Response: ... escalate_issue: false, severity: low" blocks of the completion prompts
+RESPONSE_LABEL_RE = re.compile(r"[\"']?response[\"']?\s*:", re.IGNORECASE)
+# the labels following the response, matched by name as the values are not
+# always separated ("escalate_issue: false severity: low")
+LABEL_RE = re.compile(
+    r"[\"']?\b({})[\"']?\s*:".format(
+        "|".join(key for key in RESPONSE_FORMAT_VALIDATORS if key != "response")
+    ),
+    re.IGNORECASE,
+)
+
+JSON_LITERALS = {"true", "false", "null"}
+PYTHON_LITERALS = {"True": "true", "False": "false", "None": "null"}
+KEY_VALUE_LITERALS = {"true": True, "false": False, "null": None, "none": None, "": None}
+WHITESPACE = " \t\r\n"
+
+
+class ParsedAnswer:
+    """
+    An LLM answer parsed by AnswerParser.
+
+    data is the parsed object, or None if no object could be read from the
+    answer. repairs lists the Repair names applied to get it and
+    invalid_fields the schema fields that are missing or invalid.
+    """
+
+    def __init__(self, data, repairs, invalid_fields):
+        self.data = data
+        self.repairs = repairs
+        self.invalid_fields = invalid_fields
+
+    @property
+    def valid(self):
+        return self.data is not None and not self.invalid_fields
+
+
+def _skip_whitespace(text, i):
+    while i < len(text) and text[i] in WHITESPACE:
+        i += 1
+    return i
+
+
+def _string_end(text, start):
+    """
+    Index of the quote closing the string opened at start, or -1 if it is
+    never closed. Only a quote followed by a delimiter closes the string,
+    so apostrophes and unescaped quotes inside it are kept.
+    """
+    quote = text[start]
+    i = text.find(quote, start + 1)
+    while i != -1:
+        escapes = len(text[start + 1 : i]) - len(text[start + 1 : i].rstrip("\\"))
+        if escapes % 2 == 0:
+            after = _skip_whitespace(text, i + 1)
+            if after >= len(text) or text[after] in ",:}]":
+                return i
+        i = text.find(quote, i + 1)
+    return -1
+
+
+def _to_json_string(body, quote, repairs):
+    if quote == "'":
+        repairs.add(Repair.SINGLE_QUOTES)
+        body = body.replace("\\'", "'")
+    escaped, count = UNESCAPED_QUOTE_RE.subn('\\"', body)
+    if count and quote == '"':
+        repairs.add(Repair.INNER_QUOTES)
+    return f'"{escaped}"'
+
+
+def _rewrite_object(text, start):
+    """
+    Rewrite the object literal starting at text[start] as JSON in one scan.
+
+    Returns a (json_text, end, repairs) tuple, end being the index just
+    past the object.
+    """
+    out = []
+    repairs = set()
+    closers = []
+    i = start
+    while i < len(text):
+        char = text[i]
+        if char in "{[":
+            closers.append("}" if char == "{" else "]")
+            out.append(char)
+            i += 1
+        elif char in "}]":
+            if closers:
+                closers.pop()
+            out.append(char)
+            i += 1
+            if not closers:
+                break
+        elif char in "\"'":
+            end = _string_end(text, i)
+            if end == -1:
+                repairs.add(Repair.TRUNCATED)
+                end = len(text)
+            out.append(_to_json_string(text[i + 1 : end], char, repairs))
+            i = end + 1
+        elif char == ",":
+            after = _skip_whitespace(text, i + 1)
+            if after < len(text) and text[after] in "}]":
+                repairs.add(Repair.TRAILING_COMMA)
+            else:
+                out.append(char)
+            i += 1
+        elif char.isalpha() or char == "_":
+            word = BARE_WORD_RE.match(text, i).group(0).rstrip()
+            i += len(word)
+            after = _skip_whitespace(text, i)
+            if after < len(text) and text[after] == ":":
+                repairs.add(Repair.BARE_KEYS)
+                out.append(json.dumps(word))
+            elif word in JSON_LITERALS:
+                out.append(word)
+            elif word in PYTHON_LITERALS:
+                repairs.add(Repair.PYTHON_LITERALS)
+                out.append(PYTHON_LITERALS[word])
+            else:
+                repairs.add(Repair.BARE_VALUES)
+                out.append(json.dumps(word))
+        else:
+            plain = PLAIN_RE.match(text, i)
+            out.append(plain.group(0))
+            i = plain.end()
+
+    if closers:
+        repairs.add(Repair.TRUNCATED)
+        out.extend(reversed(closers))
+    return "".join(out), i, repairs
+
+
+def _key_value(value):
+    value = value.strip().rstrip(",;").strip().strip("\"'").strip()
+    return KEY_VALUE_LITERALS.get(value.lower(), value)
+
+
+def _parse_key_values(text, start):
+    """Read a "Response: ... escalate_issue: ..." block starting at text[start]."""
+    body = text[start:]
+    labels = list(LABEL_RE.finditer(body))
+    response = body[: labels[0].start()] if labels else body
+    data = {"response": response.strip().rstrip(",").strip().strip("\"'")}
+    for label, following in zip(labels, labels[1:] + [None]):
+        if following is not None:
+            value = body[label.end() : following.start()]
+        else:
+            # the last value ends with its line, prose may follow
+            value = body[label.end() :].split("\n", 1)[0]
+        data[label.group(1).lower()] = _key_value(value)
+    return data
+
+
+class AnswerParser:
+    """
+    Tolerant parser for the JSON-ish answers our prompts get back.
+
+    Plain JSON is read as is. Anything else is repaired in a single scan:
+    code fences and the prose around the object are dropped, single-quoted
+    strings, Python literals, bare keys and values and trailing commas are
+    rewritten as JSON and truncated objects are closed. Answers without an
+    object are read as "Response: ... escalate_issue: ..." key-value blocks.
+    The result is validated against the structured response schema.
+    """
+
+    def __init__(self):
+        self._counters = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def parse(self, answer, fields=REQUIRED_RESPONSE_KEYS):
+        """
+        Parse answer and check fields against the response schema.
+
+        Returns:
+            ParsedAnswer: data is None if no object could be read from answer.
+        """
+        repairs = set()
+        data = None
+        if isinstance(answer, str):
+            text = answer.strip()
+            try:
+                data = json.loads(text)
+            except ValueError:
+                data = self._repair(text, repairs)
+        if not isinstance(data, dict):
+            data = None
+
+        invalid_fields = invalid_format_fields(normalize_structured_response(data), fields)
+        self._record(data, repairs, invalid_fields)
+        return ParsedAnswer(data, sorted(repairs), invalid_fields)
+
+    def _repair(self, text, repairs):
+        fence = CODE_FENCE_RE.search(text)
+        if fence:
+            repairs.add(Repair.CODE_FENCE)
+            text = fence.group(1)
+
+        start = text.find("{")
+        if start != -1:
+            json_text, end, object_repairs = _rewrite_object(text, start)
+            try:
+                data = json.loads(json_text, strict=False)
+            except ValueError:
+                pass
+            else:
+                if text[:start].strip() or text[end:].strip():
+                    object_repairs.add(Repair.PROSE)
+                repairs.update(object_repairs)
+                return data
+
+        response = RESPONSE_LABEL_RE.search(text)
+        if response:
+            repairs.add(Repair.KEY_VALUES)
+            return _parse_key_values(text, response.end())
+        return None
+
+    def _record(self, data, repairs, invalid_fields):
+        with self._lock:
+            if data is None:
+                self._counters["failed"] += 1
+            elif repairs:
+                self._counters["repaired"] += 1
+            else:
+                self._counters["clean"] += 1
+            if data is not None and invalid_fields:
+                self._counters["invalid"] += 1
+            for repair in repairs:
+                self._counters[f"repair:{repair}"] += 1
+        if repairs:
+            logger.debug("Repaired LLM answer", repairs=sorted(repairs), parsed=data is not None)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters)
+
+
+answer_parser = AnswerParser()
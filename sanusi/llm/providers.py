@@ -0,0 +1,252 @@
+import asyncio
+import json
+import random
+import re
+import threading
+import time
+import uuid
+
+import openai
+from django.conf import settings
+from openai import error as openai_error
+from openai.util import convert_to_openai_object
+
+from sanusi.utilities.helpers import count_tokens
+
+
+class OpenAIProvider:
+    """Completions from the OpenAI API (or any OpenAI-compatible LLM_API_BASE)."""
+
+    name = "openai"
+
+    def chat_completion(self, **params):
+        return openai.ChatCompletion.create(**params)
+
+    def completion(self, **params):
+        return openai.Completion.create(**params)
+
+    async def achat_completion(self, **params):
+        return await openai.ChatCompletion.acreate(**params)
+
+    async def acompletion(self, **params):
+        return await openai.Completion.acreate(**params)
+
+
+# (pattern, template) pairs tried in order against the prompt text; the
+# first match answers. "{message}" in a template is replaced by the
+# customer's message.
+FAKE_RESPONSE_RULES = [
+    (
+        r"JSON object",
+        json.dumps(
+            {
+                "response": "Thanks for reaching out about \"{message}\". We are looking into it.",
+                "escalate_issue": "false",
+                "escalation_department": "null",
+                "severity": "low",
+                "sentiment": "neutral",
+                "chat_context": "general enquiry",
+            }
+        ),
+    ),
+    (r"^escalation_instructions:", "none"),
+    (r"^sentiment_analysis:", "neutral"),
+    (r"^severity_instructions:", "low"),
+    (r"^Chat Context instructions:", "general enquiry"),
+    (r"which knowledge base should be used", "general"),
+    (r"which product category", "Sorry, we currently don't have this product."),
+    (r"Which one is the most relevant\?", "None"),
+    (r"Should the issue be escalated\?", "false"),
+    (r"name of the department it should be escalated to", "null"),
+    (r"Type the severity of the issue", "low"),
+    (r"Type the sentiment of the user", "neutral"),
+    (r"Clean this data", "{message}"),
+    (r"", "Thanks for reaching out about \"{message}\". We are looking into it."),
+]
+
+
+class FakeProvider:
+    """
+    Offline, in-process stand-in for the OpenAI API.
+
+    Answers with canned or templated completions after a simulated latency
+    drawn from a log-normal distribution, and fails a configurable share of
+    calls with a provider error, so the auto response path can be load
+    tested and profiled without a paid API. Streams are emitted word by word.
+    """
+
+    name = "fake"
+
+    def __init__(
+        self,
+        latency_median,
+        latency_sigma,
+        error_rate,
+        token_delay,
+        rules=None,
+        seed=None,
+    ):
+        self.latency_median = latency_median
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.token_delay = token_delay
+        self.rules = [
+            (re.compile(pattern, re.MULTILINE), template)
+            for pattern, template in (rules or FAKE_RESPONSE_RULES)
+        ]
+        self._random = random.Random(seed)
+        self._random_lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls):
+        rules = None
+        if settings.LLM_FAKE_RESPONSES_FILE:
+            with open(settings.LLM_FAKE_RESPONSES_FILE) as rules_file:
+                rules = json.load(rules_file) + FAKE_RESPONSE_RULES[-1:]
+        return cls(
+            latency_median=settings.LLM_FAKE_LATENCY_MEDIAN,
+            latency_sigma=settings.LLM_FAKE_LATENCY_SIGMA,
+            error_rate=settings.LLM_FAKE_ERROR_RATE,
+            token_delay=settings.LLM_FAKE_TOKEN_DELAY,
+            rules=rules,
+            seed=settings.LLM_FAKE_SEED,
+        )
+
+    def _draw_call(self):
+        """Latency and outcome of the next simulated call."""
+        with self._random_lock:
+            latency = (
+                self._random.lognormvariate(0, self.latency_sigma) * self.latency_median
+            )
+            failed = self._random.random() < self.error_rate
+        return latency, failed
+
+    @staticmethod
+    def _raise_if_failed(failed):
+        if failed:
+            raise openai_error.ServiceUnavailableError(
+                "Simulated provider failure", http_status=503
+            )
+
+    def _simulate_call(self):
+        latency, failed = self._draw_call()
+        time.sleep(latency)
+        self._raise_if_failed(failed)
+
+    async def _asimulate_call(self):
+        latency, failed = self._draw_call()
+        await asyncio.sleep(latency)
+        self._raise_if_failed(failed)
+
+    def _answer(self, prompt_text, message):
+        for pattern, template in self.rules:
+            if pattern.search(prompt_text):
+                if template.startswith("{"):
+                    message = json.dumps(message)[1:-1]  # keep JSON templates valid
+                return template.replace("{message}", message)
+
+    def _usage(self, prompt_text, answer):
+        prompt_tokens = count_tokens(prompt_text)
+        completion_tokens = count_tokens(answer)
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+
+    def chat_completion(self, messages, model=None, stream=False, **params):
+        self._simulate_call()
+        return self._chat_response(messages, model, stream)
+
+    async def achat_completion(self, messages, model=None, stream=False, **params):
+        await self._asimulate_call()
+        if stream:
+            return self._astream(self._chat_response(messages, model), model)
+        return self._chat_response(messages, model)
+
+    def _chat_response(self, messages, model, stream=False):
+        prompt_text = "\n".join(str(message.get("content", "")) for message in messages)
+        user_messages = [m for m in messages if m.get("role") == "user"]
+        message = str((user_messages or messages)[-1].get("content", ""))
+        answer = self._answer(prompt_text, message)
+
+        if stream:
+            return self._stream(answer, model)
+        return convert_to_openai_object(
+            {
+                "id": f"chatcmpl-fake-{uuid.uuid4().hex}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": answer},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": self._usage(prompt_text, answer),
+            }
+        )
+
+    def _stream(self, answer, model):
+        for word in re.findall(r"\S+\s*", answer):
+            time.sleep(self.token_delay)
+            yield convert_to_openai_object(
+                {
+                    "object": "chat.completion.chunk",
+                    "model": model,
+                    "choices": [{"index": 0, "delta": {"content": word}}],
+                }
+            )
+
+    async def _astream(self, response, model):
+        answer = response["choices"][0]["message"]["content"]
+        for word in re.findall(r"\S+\s*", answer):
+            await asyncio.sleep(self.token_delay)
+            yield convert_to_openai_object(
+                {
+                    "object": "chat.completion.chunk",
+                    "model": model,
+                    "choices": [{"index": 0, "delta": {"content": word}}],
+                }
+            )
+
+    def completion(self, prompt, model=None, engine=None, **params):
+        self._simulate_call()
+        return self._completion_response(prompt, model or engine)
+
+    async def acompletion(self, prompt, model=None, engine=None, **params):
+        await self._asimulate_call()
+        return self._completion_response(prompt, model or engine)
+
+    def _completion_response(self, prompt, model):
+        prompt_text = prompt if isinstance(prompt, str) else "\n".join(prompt)
+        # the field prompt to answer is the last line of a completion prompt
+        lines = prompt_text.strip().splitlines() or [""]
+        answer = self._answer(lines[-1], lines[0][:200])
+        return convert_to_openai_object(
+            {
+                "id": f"cmpl-fake-{uuid.uuid4().hex}",
+                "object": "text_completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "text": answer, "finish_reason": "stop"}],
+                "usage": self._usage(prompt_text, answer),
+            }
+        )
+
+
+PROVIDERS = {
+    OpenAIProvider.name: OpenAIProvider,
+    FakeProvider.name: FakeProvider.from_settings,
+}
+
+
+def build_provider(name):
+    try:
+        return PROVIDERS[name]()
+    except KeyError:
+        raise ValueError(
+            f"Unknown LLM_PROVIDER {name!r}, expected one of {', '.join(PROVIDERS)}"
+        )
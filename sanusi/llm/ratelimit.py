@@ -0,0 +1,357 @@
+import asyncio
+import threading
+import time
+from collections import defaultdict
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from loguru import logger
+from rest_framework.exceptions import Throttled
+
+from sanusi.utilities.helpers import count_tokens
+
+from .metrics import current_company_id, prompt_text
+
+# Longest a call may wait for room under the rate limits, see max_wait.
+# None uses the limiter's configured wait.
+admission_wait = ContextVar("llm_admission_wait", default=None)
+
+
+@contextmanager
+def max_wait(seconds):
+    """Let the LLM calls made inside the block wait up to seconds for room."""
+    token = admission_wait.set(seconds)
+    try:
+        yield
+    finally:
+        admission_wait.reset(token)
+
+
+def is_shared_cache(alias):
+    """Whether the alias cache is seen by every worker process."""
+    return not isinstance(caches[alias], (LocMemCache, DummyCache))
+
+
+def check_settings():
+    """
+    Refuse enabled rate limits counted in a per-process cache, where every
+    worker process would get the whole budget.
+    """
+    if settings.LLM_RATELIMIT_ENABLED and not is_shared_cache(settings.LLM_RATELIMIT_ALIAS):
+        raise ImproperlyConfigured(
+            f"LLM_RATELIMIT_ENABLED needs LLM_RATELIMIT_ALIAS to be a cache shared by "
+            f"the worker processes, {settings.LLM_RATELIMIT_ALIAS!r} is per process"
+        )
+
+
+class RateLimitExceeded(Throttled):
+    """
+    An LLM call did not fit in the request or token budget in time.
+    Rendered by DRF as a 429 with a Retry-After header.
+    """
+
+    default_detail = "Too many requests to the language model, please try again later."
+    default_code = "llm_rate_limited"
+
+
+def estimated_tokens(params):
+    """Tokens a call may use: its prompt plus all of the completion it allows."""
+    return count_tokens(prompt_text(params)) + int(params.get("max_tokens") or 256)
+
+
+class Admission:
+    """Budget reserved for one admitted call, settled with its actual usage."""
+
+    def __init__(self, limiter, window, reserved):
+        self.limiter = limiter
+        self.window = window
+        # (scope, tokens) reserved in each scope with a token budget
+        self.reserved = reserved
+
+    def settle(self, response):
+        """Give back the reserved tokens the call did not use, or charge the excess."""
+        try:
+            used = response["usage"]["total_tokens"]
+        except (KeyError, TypeError):
+            return  # streams carry no usage, keep the reservation
+        self.limiter._add_tokens(
+            [(scope, used - tokens) for scope, tokens in self.reserved], self.window
+        )
+
+    async def asettle(self, response):
+        await sync_to_async(self.settle, thread_sensitive=False)(response)
+
+
+class RateLimiter:
+    """
+    Admission control in front of the LLM provider.
+
+    Every call reserves one request and its estimated tokens in a
+    per-minute budget for all businesses and one for its business (see
+    company_scope), counted in the alias cache. The budgets only hold
+    across worker processes when that cache is shared by them (e.g. Redis);
+    with a per-process cache every process gets the whole budget, which
+    from_settings warns about. Usage is estimated over a sliding minute
+    from the counters of the current and previous windows. A call that does
+    not fit waits for room up to max_wait seconds and then raises
+    RateLimitExceeded. A semaphore bounds the calls in flight per process.
+    Retried calls are admitted again for every attempt.
+    """
+
+    key_prefix = "llm:ratelimit"
+    window_seconds = 60
+
+    def __init__(
+        self,
+        alias,
+        global_limits,
+        company_limits,
+        company_overrides,
+        max_wait,
+        max_concurrency,
+        poll_interval=0.1,
+        enabled=True,
+    ):
+        self.alias = alias
+        self.global_limits = global_limits
+        self.company_limits = company_limits
+        self.company_overrides = company_overrides
+        self.max_wait = max_wait
+        self.poll_interval = poll_interval
+        self.enabled = enabled
+        self._semaphore = (
+            threading.BoundedSemaphore(max_concurrency) if max_concurrency else None
+        )
+        self._counters = defaultdict(int)
+        self._counters_lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls):
+        check_settings()
+        return cls(
+            alias=settings.LLM_RATELIMIT_ALIAS,
+            global_limits=(settings.LLM_GLOBAL_RPM, settings.LLM_GLOBAL_TPM),
+            company_limits=(settings.LLM_COMPANY_RPM, settings.LLM_COMPANY_TPM),
+            company_overrides=settings.LLM_COMPANY_RATE_LIMITS,
+            max_wait=settings.LLM_RATELIMIT_MAX_WAIT,
+            max_concurrency=settings.LLM_MAX_CONCURRENCY,
+            enabled=settings.LLM_RATELIMIT_ENABLED,
+        )
+
+    @property
+    def shared(self):
+        return caches[self.alias]
+
+    def scopes_for(self, company_id):
+        """(scope, requests per minute, tokens per minute) budgets of a call."""
+        scopes = [("global", *self.global_limits)]
+        if company_id:
+            limits = self.company_overrides.get(company_id, self.company_limits)
+            scopes.append((f"company:{company_id}", *limits))
+        return [scope for scope in scopes if scope[1] or scope[2]]
+
+    def _key(self, scope, window, counter):
+        return f"{self.key_prefix}:{scope}:{window}:{counter}"
+
+    def _incr(self, key, delta):
+        if not delta:
+            return self.shared.get(key, 0)
+        self.shared.add(key, 0, self.window_seconds * 2)
+        try:
+            if delta > 0:
+                return self.shared.incr(key, delta)
+            return self.shared.decr(key, -delta)
+        except ValueError:
+            return 0  # expired in between, nothing left to count against
+
+    def _add_tokens(self, deltas, window):
+        try:
+            for scope, delta in deltas:
+                self._incr(self._key(scope, window, "tokens"), delta)
+        except Exception as e:
+            logger.warning(f"Rate limit backend failed: {str(e)}")
+
+    def _try_reserve(self, scopes, tokens, now):
+        """
+        Reserve a request and tokens in every scope.
+
+        Returns a (scope, window, reserved) tuple: scope is the first scope
+        without room, after undoing the reservations made so far, or None
+        once all of them are reserved in window; reserved then lists the
+        (scope, tokens) reserved in the scopes with a token budget.
+        """
+        window, elapsed = divmod(now, self.window_seconds)
+        window = int(window)
+        # share of the previous window still inside the sliding minute
+        previous_weight = 1 - elapsed / self.window_seconds
+
+        reserved = []
+        for scope, rpm, tpm in scopes:
+            previous_requests = self._key(scope, window - 1, "requests")
+            previous_tokens = self._key(scope, window - 1, "tokens")
+            previous = self.shared.get_many([previous_requests, previous_tokens])
+            cost = min(tokens, tpm) if tpm else 0
+            requests = self._incr(self._key(scope, window, "requests"), 1)
+            used_tokens = self._incr(self._key(scope, window, "tokens"), cost)
+            reserved.append((scope, cost))
+
+            requests += previous.get(previous_requests, 0) * previous_weight
+            used_tokens += previous.get(previous_tokens, 0) * previous_weight
+            if (rpm and requests > rpm) or (tpm and used_tokens > tpm):
+                for reserved_scope, reserved_cost in reserved:
+                    self._incr(self._key(reserved_scope, window, "requests"), -1)
+                    self._incr(self._key(reserved_scope, window, "tokens"), -reserved_cost)
+                return scope, window, []
+        return None, window, [(scope, cost) for scope, cost in reserved if cost]
+
+    def _reserve(self, scopes, tokens):
+        """
+        One reservation attempt: a (scope, admission) tuple, scope being the
+        first scope without room. Failures of the backend admit the call.
+        """
+        try:
+            scope, window, reserved = self._try_reserve(scopes, tokens, time.time())
+        except Exception as e:
+            # an unreachable backend must not take the LLM calls down with it
+            logger.warning(f"Rate limit backend failed: {str(e)}")
+            return None, None
+        if scope is not None:
+            return scope, None
+        return None, Admission(self, window, reserved)
+
+    def _rejected(self, scope, company_id):
+        self._count("rejected")
+        logger.warning(
+            "LLM call rejected by the rate limiter",
+            scope=scope,
+            company_id=company_id,
+        )
+        return RateLimitExceeded(
+            wait=self.window_seconds - time.time() % self.window_seconds,
+            detail=f"The {scope.split(':')[0]} language model budget is used up, please try again later.",
+        )
+
+    def _concurrency_rejected(self):
+        self._count("rejected_concurrency")
+        return RateLimitExceeded(
+            wait=1,
+            detail="Too many language model calls in progress, please try again later.",
+        )
+
+    def acquire(self, params, deadline):
+        """
+        Wait until the time.monotonic() deadline for room for the call
+        described by params.
+
+        Returns:
+            Admission: to settle with the response, or None when nothing is limited.
+        """
+        company_id = current_company_id.get()
+        scopes = self.scopes_for(company_id)
+        if not scopes:
+            return None
+
+        tokens = estimated_tokens(params)
+        waited = False
+        while True:
+            scope, admission = self._reserve(scopes, tokens)
+            if scope is None:
+                if admission is not None:
+                    self._count("waited" if waited else "admitted")
+                return admission
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise self._rejected(scope, company_id)
+            waited = True
+            time.sleep(min(self.poll_interval, remaining))
+
+    async def aacquire(self, params, deadline):
+        """acquire() for async callers, waiting without blocking the event loop."""
+        company_id = current_company_id.get()
+        scopes = self.scopes_for(company_id)
+        if not scopes:
+            return None
+
+        tokens = estimated_tokens(params)
+        reserve = sync_to_async(self._reserve, thread_sensitive=False)
+        waited = False
+        while True:
+            scope, admission = await reserve(scopes, tokens)
+            if scope is None:
+                if admission is not None:
+                    self._count("waited" if waited else "admitted")
+                return admission
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise self._rejected(scope, company_id)
+            waited = True
+            await asyncio.sleep(min(self.poll_interval, remaining))
+
+    def _deadline(self):
+        wait = admission_wait.get()
+        return time.monotonic() + (self.max_wait if wait is None else wait)
+
+    @contextmanager
+    def admit(self, params):
+        """
+        Hold a slot in the process's concurrent calls and room in the rate
+        limits for the duration of the block.
+        """
+        if not self.enabled:
+            yield None
+            return
+
+        deadline = self._deadline()
+        if self._semaphore is not None:
+            if not self._semaphore.acquire(timeout=max(deadline - time.monotonic(), 0)):
+                raise self._concurrency_rejected()
+        try:
+            yield self.acquire(params, deadline)
+        finally:
+            if self._semaphore is not None:
+                self._semaphore.release()
+
+    @asynccontextmanager
+    async def aadmit(self, params):
+        """
+        admit() for async callers. The slots are shared with the threads of
+        the process, so they are polled for rather than waited on.
+        """
+        if not self.enabled:
+            yield None
+            return
+
+        deadline = self._deadline()
+        if self._semaphore is not None:
+            while not self._semaphore.acquire(blocking=False):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise self._concurrency_rejected()
+                await asyncio.sleep(min(self.poll_interval, remaining))
+        try:
+            yield await self.aacquire(params, deadline)
+        finally:
+            if self._semaphore is not None:
+                self._semaphore.release()
+
+    def _count(self, counter):
+        with self._counters_lock:
+            self._counters[counter] += 1
+
+    def stats(self):
+        with self._counters_lock:
+            counters = dict(self._counters)
+        return {
+            "enabled": self.enabled,
+            "global_limits": self.global_limits,
+            "company_limits": self.company_limits,
+            **counters,
+        }
@@ -0,0 +1,431 @@
+import fcntl
+import os
+import tempfile
+import threading
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+
+import joblib
+import numpy as np
+from django.conf import settings
+from django.db.models import Count, Max
+from loguru import logger
+from sklearn.feature_extraction.text import ENGLISH_STOP_WORDS
+
+from business.models import KnowledgeBase
+from sanusi.preprocessing.clean_text import lowercase_text, remove_punctuation
+from sanusi.preprocessing.lemmatize import lemmatize_text
+from sanusi.preprocessing.stopword_removal import remove_stopwords
+from sanusi.preprocessing.tokenize import tokenize_text
+from sanusi.utilities.helpers import count_tokens
+
+_missing_nltk_data = False
+
+
+def index_terms(text):
+    """
+    The terms text is indexed and searched by, from the sanusi.preprocessing
+    steps: lower-cased, without punctuation, tokenized, without stop words
+    and lemmatized ("Refunds?" -> "refund").
+    """
+    global _missing_nltk_data
+
+    text = remove_punctuation(lowercase_text(str(text)))
+    try:
+        return lemmatize_text(remove_stopwords(tokenize_text(text)))
+    except LookupError as e:
+        # the NLTK data is installed by the dockerfile; without it search
+        # degrades to whitespace tokens rather than failing every request
+        if not _missing_nltk_data:
+            _missing_nltk_data = True
+            logger.error(f"NLTK data missing, knowledge base search is degraded: {str(e)}")
+        return [word for word in text.split() if word not in ENGLISH_STOP_WORDS]
+
+
+def knowledge_base_fingerprint(company_id):
+    """Entry count and last change of the business's knowledge base, from the database."""
+    stats = KnowledgeBase.objects.filter(business_id=company_id).aggregate(
+        count=Count("pk"), last_updated=Max("last_updated")
+    )
+    return stats["count"], stats["last_updated"]
+
+
+ENTRY_FIELDS = (
+    "knowledgebase_id",
+    "title",
+    "content",
+    "cleaned_data",
+    "is_company_description",
+    "last_updated",
+)
+
+
+def index_entry(knowledgebase_id, title, content, cleaned_data, is_company_description, last_updated):
+    """Index entry of a KnowledgeBase row read with ENTRY_FIELDS."""
+    # entries still waiting for background cleaning are used as-is
+    cleaned_data = cleaned_data or content
+    return {
+        "knowledgebase_id": str(knowledgebase_id),
+        "title": title,
+        "text": f"{title}\n{content}\n{cleaned_data}",
+        "cleaned_data": cleaned_data,
+        "tokens": count_tokens(str(cleaned_data)),
+        "pinned": is_company_description,
+        "last_updated": last_updated,
+    }
+
+
+class KnowledgeBaseIndex:
+    """
+    BM25 inverted index over one business's knowledge base entries.
+
+    Each entry's title, content and cleaned_data are indexed by their
+    index_terms. The postings only hold term frequencies and the BM25
+    weights are computed at query time, so entries can be added, replaced
+    and removed (see apply) without touching the others. A removed entry
+    leaves an empty slot in entries until the index is compacted.
+    """
+
+    k1 = 1.5
+    b = 0.75
+
+    def __init__(self):
+        self.entries = []
+        self.slots = {}
+        self.lengths = []
+        self.postings = {}
+        self.total_length = 0
+        self._clear_arrays()
+
+    def _clear_arrays(self):
+        self._term_arrays = {}
+        self._length_array = None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state.pop("_term_arrays")
+        state.pop("_length_array")
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._clear_arrays()
+
+    def __len__(self):
+        return len(self.slots)
+
+    @classmethod
+    def for_business(cls, company_id):
+        index = cls()
+        rows = (
+            KnowledgeBase.objects.filter(business_id=company_id)
+            .order_by("date_created")
+            .values_list(*ENTRY_FIELDS)
+        )
+        for row in rows:
+            index.put(index_entry(*row))
+        return index
+
+    @property
+    def fingerprint(self):
+        """knowledge_base_fingerprint of the entries in the index."""
+        updated = [
+            entry["last_updated"]
+            for entry in self.entries
+            if entry is not None and entry["last_updated"] is not None
+        ]
+        return len(self.slots), max(updated, default=None)
+
+    def live_slots(self):
+        return [slot for slot, entry in enumerate(self.entries) if entry is not None]
+
+    def put(self, entry):
+        """Add entry, or replace the entry with the same knowledgebase_id in its slot."""
+        slot = self.slots.get(entry["knowledgebase_id"])
+        if slot is None:
+            slot = len(self.entries)
+            self.entries.append(None)
+            self.lengths.append(0)
+            self.slots[entry["knowledgebase_id"]] = slot
+        else:
+            self._unindex(slot)
+
+        entry = dict(entry)
+        terms = index_terms(entry.pop("text"))
+        frequencies = Counter(terms)
+        for term, frequency in frequencies.items():
+            self.postings.setdefault(term, {})[slot] = frequency
+            self._term_arrays.pop(term, None)
+        entry["terms"] = list(frequencies)
+        self.entries[slot] = entry
+        self.lengths[slot] = len(terms)
+        self.total_length += len(terms)
+        self._length_array = None
+
+    def remove(self, knowledgebase_id):
+        slot = self.slots.pop(str(knowledgebase_id), None)
+        if slot is not None:
+            self._unindex(slot)
+            self.entries[slot] = None
+
+    def _unindex(self, slot):
+        for term in self.entries[slot]["terms"]:
+            posting = self.postings[term]
+            posting.pop(slot, None)
+            if not posting:
+                del self.postings[term]
+            self._term_arrays.pop(term, None)
+        self.total_length -= self.lengths[slot]
+        self.lengths[slot] = 0
+        self._length_array = None
+
+    def apply(self, rows, knowledgebase_ids):
+        """
+        Bring the entries of knowledgebase_ids up to date: the ones read in
+        rows (with ENTRY_FIELDS) are added or replaced, the others removed.
+        """
+        present = set()
+        for row in rows:
+            entry = index_entry(*row)
+            present.add(entry["knowledgebase_id"])
+            self.put(entry)
+        for knowledgebase_id in knowledgebase_ids:
+            if str(knowledgebase_id) not in present:
+                self.remove(knowledgebase_id)
+        if len(self.entries) > 2 * len(self.slots) + 16:
+            self.compact()
+
+    def compact(self):
+        """Drop the slots of removed entries."""
+        moves = {old: new for new, old in enumerate(self.live_slots())}
+        self.entries = [self.entries[old] for old in moves]
+        self.lengths = [self.lengths[old] for old in moves]
+        self.slots = {entry["knowledgebase_id"]: slot for slot, entry in enumerate(self.entries)}
+        self.postings = {
+            term: {moves[slot]: frequency for slot, frequency in posting.items()}
+            for term, posting in self.postings.items()
+        }
+        self._clear_arrays()
+
+    def _arrays(self, term):
+        arrays = self._term_arrays.get(term)
+        if arrays is None:
+            posting = self.postings.get(term)
+            if not posting:
+                return None
+            arrays = self._term_arrays[term] = (
+                np.fromiter(posting.keys(), dtype=np.int64, count=len(posting)),
+                np.fromiter(posting.values(), dtype=np.float64, count=len(posting)),
+            )
+        return arrays
+
+    def scores(self, query):
+        """BM25 score of every slot for query."""
+        scores = np.zeros(len(self.entries))
+        if not self.slots:
+            return scores
+        if self._length_array is None:
+            self._length_array = np.array(self.lengths, dtype=np.float64)
+        average_length = self.total_length / len(self.slots) or 1.0
+
+        for term in set(index_terms(query)):
+            arrays = self._arrays(term)
+            if arrays is None:
+                continue
+            slots, frequencies = arrays
+            idf = np.log(1 + (len(self.slots) - len(slots) + 0.5) / (len(slots) + 0.5))
+            norms = self.k1 * (1 - self.b + self.b * self._length_array[slots] / average_length)
+            scores[slots] += idf * frequencies * (self.k1 + 1) / (frequencies + norms)
+        return scores
+
+    def ranked(self, query, top_k):
+        """
+        Return (slot, score) of the top_k entries matching query, best
+        first. Entries sharing no term with the query are left out.
+        """
+        if not self.slots:
+            return []
+        scores = self.scores(query)
+        ranked = np.argsort(-scores, kind="stable")[:top_k]
+        return [(int(slot), float(scores[slot])) for slot in ranked if scores[slot] > 0]
+
+    def search(self, query, top_k):
+        return [slot for slot, score in self.ranked(query, top_k)]
+
+    def search_ids(self, query, top_k):
+        return [
+            (self.entries[slot]["knowledgebase_id"], score)
+            for slot, score in self.ranked(query, top_k)
+        ]
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # written aside and renamed, so other workers never load half a file
+        descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(descriptor, "wb") as index_file:
+                joblib.dump(self, index_file)
+            os.replace(temporary_path, path)
+        except BaseException:
+            os.unlink(temporary_path)
+            raise
+
+    @classmethod
+    def load(cls, path):
+        index = joblib.load(path)
+        if not isinstance(index, cls):
+            raise ValueError(f"not a {cls.__name__}")
+        return index
+
+
+def index_path(company_id):
+    return os.path.join(settings.KB_INDEX_DIR, f"{company_id}.joblib")
+
+
+@contextmanager
+def index_lock(company_id):
+    """Serialize the index updates of a business across processes."""
+    path = index_path(company_id) + ".lock"
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _load_index(path):
+    try:
+        return KnowledgeBaseIndex.load(path)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning(f"Failed to load knowledge base index {path}: {str(e)}")
+        return None
+
+
+def _save_index(index, path):
+    try:
+        index.save(path)
+    except OSError as e:
+        logger.warning(f"Failed to persist knowledge base index {path}: {str(e)}")
+
+
+def load_or_build_index(company_id, fingerprint=None):
+    """
+    The business's persisted index if it is still up to date with the
+    database (fingerprint, its knowledge_base_fingerprint), otherwise a
+    freshly built one, which is persisted in turn.
+    """
+    path = index_path(company_id)
+    index = _load_index(path)
+    if fingerprint is None:
+        fingerprint = knowledge_base_fingerprint(company_id)
+    if index is not None and index.fingerprint == fingerprint:
+        return index
+
+    index = KnowledgeBaseIndex.for_business(company_id)
+    _save_index(index, path)
+    return index
+
+
+def update_index(company_id, knowledgebase_ids=None):
+    """
+    Apply the changes of the given entries to the business's persisted
+    index: entries still in the database are added or replaced, the others
+    removed. The index is rebuilt instead without knowledgebase_ids, when
+    there is no index yet or when the result does not match the database.
+    Processes holding an older index in memory reload it on their next
+    get_index, as it no longer matches the database.
+    """
+    company_id = str(company_id)
+    path = index_path(company_id)
+    with index_lock(company_id):
+        index = _load_index(path) if knowledgebase_ids is not None else None
+        if index is not None:
+            rows = KnowledgeBase.objects.filter(
+                business_id=company_id, knowledgebase_id__in=knowledgebase_ids
+            ).values_list(*ENTRY_FIELDS)
+            index.apply(rows, knowledgebase_ids)
+            if index.fingerprint != knowledge_base_fingerprint(company_id):
+                # changed by writes this update was not told about
+                index = None
+        if index is None:
+            index = KnowledgeBaseIndex.for_business(company_id)
+        _save_index(index, path)
+    return index
+
+
+_indexes = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def get_index(company_id):
+    """
+    Return the business's index, reloaded whenever it no longer matches the
+    knowledge_base_fingerprint of the database, so every process picks up
+    the changes whichever process wrote them. Indexes are kept per process
+    for the most recent businesses.
+    """
+    company_id = str(company_id)
+    fingerprint = knowledge_base_fingerprint(company_id)
+    with _indexes_lock:
+        cached = _indexes.get(company_id)
+        if cached and cached[0] == fingerprint:
+            _indexes.move_to_end(company_id)
+            return cached[1]
+
+    index = load_or_build_index(company_id, fingerprint)
+    with _indexes_lock:
+        # keyed on the index's own fingerprint, a write racing the build
+        # makes the next call reload it
+        _indexes[company_id] = (index.fingerprint, index)
+        _indexes.move_to_end(company_id)
+        while len(_indexes) > settings.KB_INDEX_CACHE_SIZE:
+            _indexes.popitem(last=False)
+    return index
+
+
+def search_knowledge_base(company_id, query, top_k=None):
+    """
+    Search the business's knowledge base.
+
+    Returns:
+        list: (knowledgebase_id, score) of the top_k best matching entries.
+    """
+    return get_index(company_id).search_ids(query, top_k or settings.KB_RETRIEVAL_TOP_K)
+
+
+def retrieve_knowledge_base(company_id, message, top_k=None, token_budget=None):
+    """
+    Select the knowledge base entries to put in the prompt for message.
+
+    Company description entries come first, then the top_k entries most
+    relevant to the message; when nothing matches, entries are taken in
+    order. Entries are added while they fit in token_budget, but at least one
+    is always returned so long as the business has any.
+
+    Returns:
+        list: cleaned_data of the selected entries.
+    """
+    top_k = top_k or settings.KB_RETRIEVAL_TOP_K
+    token_budget = token_budget or settings.KB_RETRIEVAL_TOKEN_BUDGET
+    index = get_index(company_id)
+    if not len(index):
+        return []
+
+    pinned = [i for i in index.live_slots() if index.entries[i]["pinned"]]
+    matches = [i for i in index.search(message, top_k) if i not in pinned]
+    if not matches:
+        matches = [i for i in index.live_slots() if i not in pinned][:top_k]
+
+    selected = []
+    used_tokens = 0
+    for i in pinned + matches:
+        entry = index.entries[i]
+        if selected and used_tokens + entry["tokens"] > token_budget:
+            continue
+        selected.append(entry["cleaned_data"])
+        used_tokens += entry["tokens"]
+    return selected
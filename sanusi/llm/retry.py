@@ -0,0 +1,295 @@
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, nullcontext
+
+import requests
+from django.conf import settings
+from loguru import logger
+from openai import error as openai_error
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling the provider while the circuit breaker is open."""
+
+
+RETRYABLE_ERRORS = (
+    openai_error.RateLimitError,
+    openai_error.APIConnectionError,
+    openai_error.Timeout,
+    openai_error.ServiceUnavailableError,
+    openai_error.TryAgain,
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+)
+
+
+def is_retryable(exc):
+    """
+    Whether exc is a transient provider failure worth retrying.
+
+    Client errors (bad request, authentication, permissions) would fail the
+    same way again and are not retried.
+    """
+    if isinstance(exc, RETRYABLE_ERRORS):
+        return True
+    if isinstance(exc, openai_error.APIError):
+        return exc.http_status is None or exc.http_status >= 500
+    return False
+
+
+def retry_after(exc):
+    """Seconds the provider asked us to wait, from a Retry-After header."""
+    headers = getattr(exc, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+    """
+    Capped exponential backoff with full jitter.
+
+    budget bounds the total time a single call may spend sleeping between
+    attempts, so a worker thread is never pinned for long by one call.
+    """
+
+    def __init__(self, max_attempts, base_delay, max_delay, budget):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            max_attempts=settings.LLM_RETRY_MAX_ATTEMPTS,
+            base_delay=settings.LLM_RETRY_BASE_DELAY,
+            max_delay=settings.LLM_RETRY_MAX_DELAY,
+            budget=settings.LLM_RETRY_BUDGET,
+        )
+
+    def delay(self, attempt, exc=None):
+        """Backoff before retry number attempt (1-based)."""
+        requested = retry_after(exc) if exc is not None else None
+        if requested is not None:
+            return min(requested, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+class CircuitBreaker:
+    """
+    Per-process breaker over the outcomes of recent provider calls.
+
+    The breaker opens once at least minimum_calls calls were seen in the last
+    window seconds and the failure rate among them reaches failure_rate; it
+    then fails fast for open_seconds before letting a single probe call
+    through (half-open). A successful probe closes it again.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_rate, minimum_calls, window, open_seconds):
+        self.failure_rate = failure_rate
+        self.minimum_calls = minimum_calls
+        self.window = window
+        self.open_seconds = open_seconds
+        self.state = self.CLOSED
+        self._outcomes = deque()
+        self._opened_at = None
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+        self._counters = {
+            "successes": 0,
+            "failures": 0,
+            "neutral": 0,
+            "rejected": 0,
+            "opened": 0,
+        }
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            failure_rate=settings.LLM_BREAKER_FAILURE_RATE,
+            minimum_calls=settings.LLM_BREAKER_MINIMUM_CALLS,
+            window=settings.LLM_BREAKER_WINDOW,
+            open_seconds=settings.LLM_BREAKER_OPEN_SECONDS,
+        )
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.open_seconds:
+                    self._counters["rejected"] += 1
+                    return False
+                self.state = self.HALF_OPEN
+                self._probe_in_flight = False
+
+            if self.state == self.HALF_OPEN:
+                if self._probe_in_flight:
+                    self._counters["rejected"] += 1
+                    return False
+                self._probe_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._counters["successes"] += 1
+            if self.state == self.HALF_OPEN:
+                self.state = self.CLOSED
+                self._outcomes.clear()
+                self._probe_in_flight = False
+            self._record(True)
+
+    def record_neutral(self):
+        """
+        A call that says nothing about the provider's health, e.g. a request
+        it rejected as invalid: the state and window are left as they are,
+        only a half-open probe is released for the next call.
+        """
+        with self._lock:
+            self._counters["neutral"] += 1
+            if self.state == self.HALF_OPEN:
+                self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._counters["failures"] += 1
+            if self.state == self.HALF_OPEN:
+                self._open()
+                return
+            self._record(False)
+            failures = sum(1 for _, ok in self._outcomes if not ok)
+            if (
+                self.state == self.CLOSED
+                and len(self._outcomes) >= self.minimum_calls
+                and failures / len(self._outcomes) >= self.failure_rate
+            ):
+                self._open()
+
+    def _record(self, ok):
+        now = time.monotonic()
+        self._outcomes.append((now, ok))
+        while self._outcomes and now - self._outcomes[0][0] > self.window:
+            self._outcomes.popleft()
+
+    def _open(self):
+        self.state = self.OPEN
+        self._opened_at = time.monotonic()
+        self._probe_in_flight = False
+        self._counters["opened"] += 1
+        logger.error("LLM circuit breaker opened, failing fast", open_seconds=self.open_seconds)
+
+    def stats(self):
+        with self._lock:
+            failures = sum(1 for _, ok in self._outcomes if not ok)
+            return {
+                "state": self.state,
+                "window_calls": len(self._outcomes),
+                "window_failure_rate": (
+                    round(failures / len(self._outcomes), 4) if self._outcomes else 0.0
+                ),
+                **self._counters,
+            }
+
+
+def _backoff(exc, attempt, slept, policy, breaker):
+    """
+    Record a failed attempt with the breaker and return the delay before
+    the next one, or None when exc is to be raised.
+    """
+    if not is_retryable(exc):
+        breaker.record_neutral()  # the request was bad, not the provider
+        return None
+    breaker.record_failure()
+    delay = policy.delay(attempt, exc)
+    if attempt >= policy.max_attempts or slept + delay > policy.budget:
+        return None
+    logger.warning(
+        f"LLM call failed: {str(exc)}. Retrying in {delay:.2f}s",
+        attempt=attempt,
+    )
+    return delay
+
+
+def call_with_retry(call, policy, breaker, on_retry=None, admit=None):
+    """
+    Run call() under the retry policy and circuit breaker.
+
+    Retryable failures are retried with backoff until the attempts or the
+    sleep budget run out; anything else is raised straight away. Raises
+    CircuitOpenError without calling the provider while the breaker is open.
+    on_retry(attempt, exc) is called before each retry. admit(), when
+    given, returns the context manager each attempt runs in, e.g. the rate
+    limiter's admission; what it yields is settled with the response.
+    """
+    slept = 0.0
+    attempt = 1
+    while True:
+        with admit() if admit is not None else nullcontext() as admission:
+            if not breaker.allow():
+                raise CircuitOpenError("LLM provider circuit breaker is open")
+            try:
+                result = call()
+            except Exception as e:
+                error = e
+            else:
+                error = None
+                if admission is not None:
+                    admission.settle(result)
+
+        if error is None:
+            breaker.record_success()
+            return result
+        delay = _backoff(error, attempt, slept, policy, breaker)
+        if delay is None:
+            raise error
+        if on_retry is not None:
+            on_retry(attempt, error)
+        time.sleep(delay)
+        slept += delay
+        attempt += 1
+
+
+@asynccontextmanager
+async def _anullcontext():
+    # contextlib.nullcontext only supports async with from Python 3.10
+    yield None
+
+
+async def acall_with_retry(call, policy, breaker, on_retry=None, admit=None):
+    """
+    call_with_retry for a coroutine function: await call() and back off
+    without blocking the event loop. admit() returns an async context manager.
+    """
+    slept = 0.0
+    attempt = 1
+    while True:
+        async with admit() if admit is not None else _anullcontext() as admission:
+            if not breaker.allow():
+                raise CircuitOpenError("LLM provider circuit breaker is open")
+            try:
+                result = await call()
+            except Exception as e:
+                error = e
+            else:
+                error = None
+                if admission is not None:
+                    await admission.asettle(result)
+
+        if error is None:
+            breaker.record_success()
+            return result
+        delay = _backoff(error, attempt, slept, policy, breaker)
+        if delay is None:
+            raise error
+        if on_retry is not None:
+            on_retry(attempt, error)
+        await asyncio.sleep(delay)
+        slept += delay
+        attempt += 1
@@ -0,0 +1,194 @@
+import re
+import threading
+import uuid
+from collections import defaultdict
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import caches
+from loguru import logger
+
+from sanusi.analysis.semantic_similarity import cosine_similarities, embed_text
+
+
+class SemanticAnswerCache:
+    """
+    Per-business cache of answered customer messages, matched by similarity.
+
+    Entries are scoped by company_id and channel and keyed by the business's
+    knowledge base version, a token in the shared cache that invalidate
+    replaces, so a knowledge base change orphans all of its previous answers
+    in every process. Answers are served to other customers of the business,
+    so the customer's name is stored as a placeholder and the chat_fields,
+    which describe the whole chat rather than the message, are not stored.
+    Escalated answers are not stored since they are specific to one issue.
+    """
+
+    key_prefix = "llm:semantic"
+    chat_fields = ("chat_context",)
+    name_placeholder = "{customer_name}"
+    # longest a store holds the lock of the entries it rewrites
+    lock_timeout = 5
+
+    def __init__(self, alias, threshold, max_entries, ttl, min_words, enabled=True):
+        self.alias = alias
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.min_words = min_words
+        self.enabled = enabled
+        self._counters = defaultdict(int)
+        self._counters_lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            alias=settings.LLM_CACHE_ALIAS,
+            threshold=settings.SEMANTIC_CACHE_THRESHOLD,
+            max_entries=settings.SEMANTIC_CACHE_MAX_ENTRIES,
+            ttl=settings.SEMANTIC_CACHE_TTL,
+            min_words=settings.SEMANTIC_CACHE_MIN_WORDS,
+            enabled=settings.SEMANTIC_CACHE_ENABLED,
+        )
+
+    @property
+    def shared(self):
+        return caches[self.alias]
+
+    def is_eligible(self, message):
+        # very short messages ("yes", "ok thanks") only make sense in context
+        return self.enabled and len(str(message).split()) >= self.min_words
+
+    def _version_key(self, company_id):
+        return f"{self.key_prefix}:{company_id}:version"
+
+    def invalidate(self, company_id):
+        """Orphan every answer of the business, e.g. when its knowledge base changes."""
+        self.shared.set(self._version_key(company_id), uuid.uuid4().hex, None)
+
+    def _entries_key(self, company_id, channel):
+        version = self.shared.get_or_set(self._version_key(company_id), uuid.uuid4().hex, None)
+        return f"{self.key_prefix}:{company_id}:{version}:{channel}"
+
+    def _name_pattern(self, customer_name):
+        """Pattern of the customer's full name and first name, longest first."""
+        name = " ".join(str(customer_name or "").split())
+        names = sorted({name, name.split(" ")[0]} - {""}, key=len, reverse=True)
+        names = [name for name in names if len(name) > 1]
+        if not names:
+            return None
+        return re.compile(r"\b(?:%s)\b" % "|".join(map(re.escape, names)), re.IGNORECASE)
+
+    def lookup(self, company_id, channel, message, customer_name=None):
+        """
+        Return the stored response_json of the closest past message, with
+        the name placeholder filled in with customer_name's first name and
+        without the chat_fields, or None when nothing is similar enough.
+        """
+        if not self.is_eligible(message):
+            return None
+
+        try:
+            entries = self.shared.get(self._entries_key(company_id, channel))
+        except Exception as e:
+            logger.warning(f"Semantic cache backend read failed: {str(e)}")
+            return None
+
+        if not entries:
+            self._count("misses")
+            return None
+
+        embeddings = np.frombuffer(entries["embeddings"], dtype=np.float32).reshape(
+            len(entries["responses"]), -1
+        )
+        similarities = cosine_similarities(embed_text(message), embeddings)
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.threshold:
+            self._count("misses")
+            return None
+
+        response_json = dict(entries["responses"][best])
+        if self.name_placeholder in response_json["response"]:
+            first_name = str(customer_name or "").split()[:1]
+            if not first_name:
+                # the answer addresses the customer by a name we do not have
+                self._count("misses")
+                return None
+            response_json["response"] = response_json["response"].replace(
+                self.name_placeholder, first_name[0]
+            )
+
+        self._count("hits")
+        logger.info(
+            "Semantic cache hit",
+            company_id=str(company_id),
+            channel=channel,
+            similarity=round(float(similarities[best]), 4),
+        )
+        return response_json
+
+    def store(self, company_id, channel, message, response_json, customer_name=None):
+        if not self.is_eligible(message) or response_json.get("escalate_issue"):
+            return
+
+        response_json = {
+            field: value for field, value in response_json.items() if field not in self.chat_fields
+        }
+        name_pattern = self._name_pattern(customer_name)
+        if name_pattern is not None:
+            response_json["response"] = name_pattern.sub(
+                self.name_placeholder, response_json["response"]
+            )
+        try:
+            key = self._entries_key(company_id, channel)
+            # the entries are rewritten whole, so concurrent stores would
+            # drop each other's entry; a store that finds them locked skips
+            if not self.shared.add(f"{key}:lock", 1, self.lock_timeout):
+                self._count("store_conflicts")
+                return
+            try:
+                self._append(key, message, response_json)
+            finally:
+                self.shared.delete(f"{key}:lock")
+            self._count("stores")
+        except Exception as e:
+            logger.warning(f"Semantic cache backend write failed: {str(e)}")
+
+    def _append(self, key, message, response_json):
+        entries = self.shared.get(key) or {
+            "embeddings": b"",
+            "messages": [],
+            "responses": [],
+        }
+        embeddings = entries["embeddings"] + embed_text(message).tobytes()
+        messages = entries["messages"] + [message]
+        responses = entries["responses"] + [response_json]
+
+        overflow = len(responses) - self.max_entries
+        if overflow > 0:
+            row_size = len(embeddings) // len(responses)
+            embeddings = embeddings[overflow * row_size :]
+            messages = messages[overflow:]
+            responses = responses[overflow:]
+
+        self.shared.set(
+            key,
+            {"embeddings": embeddings, "messages": messages, "responses": responses},
+            self.ttl,
+        )
+
+    def _count(self, counter):
+        with self._counters_lock:
+            self._counters[counter] += 1
+
+    def stats(self):
+        with self._counters_lock:
+            counters = dict(self._counters)
+        lookups = counters.get("hits", 0) + counters.get("misses", 0)
+        counters["hit_ratio"] = (
+            round(counters.get("hits", 0) / lookups, 4) if lookups else 0.0
+        )
+        return {"enabled": self.enabled, "threshold": self.threshold, **counters}
+
+
+semantic_cache = SemanticAnswerCache.from_settings()
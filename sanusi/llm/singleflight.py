@@ -0,0 +1,189 @@
+import asyncio
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+from django.conf import settings
+from django.core.cache import caches
+from loguru import logger
+from openai.openai_object import OpenAIObject
+from openai.util import convert_to_openai_object
+
+
+class SingleFlight:
+    """
+    Coalesces identical in-flight LLM calls.
+
+    The first caller for a key runs the call; callers arriving while it is in
+    flight wait for its result instead of sending a duplicate request. Within
+    a process waiters share a Future. With shared=True the leader also takes
+    a lock in the shared cache backend and publishes its result there, so
+    other processes wait on it too. Waiters that get no result within
+    wait_timeout make the call themselves.
+    """
+
+    key_prefix = "llm:inflight"
+    # long enough for every waiter polling the shared backend to pick it up
+    result_ttl = 10
+
+    def __init__(self, alias, wait_timeout, poll_interval, shared=False, enabled=True):
+        self.alias = alias
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+        self.shared = shared
+        self.enabled = enabled
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._counters = defaultdict(int)
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            alias=settings.LLM_CACHE_ALIAS,
+            wait_timeout=settings.LLM_SINGLEFLIGHT_WAIT,
+            poll_interval=settings.LLM_SINGLEFLIGHT_POLL_INTERVAL,
+            shared=settings.LLM_SINGLEFLIGHT_SHARED,
+            enabled=settings.LLM_SINGLEFLIGHT_ENABLED,
+        )
+
+    @property
+    def backend(self):
+        return caches[self.alias]
+
+    def do(self, key, call):
+        """
+        Return call(), or the result of the identical call already in flight.
+        Exceptions of the leading call are raised to its local waiters too.
+        """
+        if not self.enabled:
+            return call()
+
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+            self._counters["leaders" if leader else "coalesced_local"] += 1
+
+        if not leader:
+            try:
+                return future.result(timeout=self.wait_timeout)
+            except FutureTimeoutError:
+                self._count("local_wait_timeouts")
+                return call()
+
+        try:
+            result = self._call_shared(key, call) if self.shared else call()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+
+    async def ado(self, key, call):
+        """
+        do() for async callers: await call(), or the result of the identical
+        call already in flight in this process, whether it was started by a
+        thread or a coroutine. Calls are only coalesced within the process.
+        """
+        if not self.enabled:
+            return await call()
+
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+            self._counters["leaders" if leader else "coalesced_local"] += 1
+
+        if not leader:
+            try:
+                # shielded, a waiter timing out must not cancel the leader's future
+                return await asyncio.wait_for(
+                    asyncio.shield(asyncio.wrap_future(future)), self.wait_timeout
+                )
+            except asyncio.TimeoutError:
+                self._count("local_wait_timeouts")
+                return await call()
+
+        try:
+            result = await call()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+
+    def _call_shared(self, key, call):
+        lock_key = f"{self.key_prefix}:lock:{key}"
+        result_key = f"{self.key_prefix}:result:{key}"
+        try:
+            locked, value = self._wait_for_shared(lock_key, result_key)
+        except Exception as e:
+            logger.warning(f"Single-flight backend failed: {str(e)}")
+            return call()
+        if value is not None:
+            self._count("coalesced_shared")
+            return convert_to_openai_object(value)
+        if not locked:
+            return call()
+
+        try:
+            result = call()
+            # published before the lock is released, so a process that takes
+            # the lock in between finds the result instead of calling again
+            if isinstance(result, OpenAIObject):
+                try:
+                    self.backend.set(result_key, result.to_dict_recursive(), self.result_ttl)
+                except Exception as e:
+                    logger.warning(f"Single-flight backend failed: {str(e)}")
+        finally:
+            try:
+                self.backend.delete(lock_key)
+            except Exception as e:
+                logger.warning(f"Single-flight backend failed: {str(e)}")
+        return result
+
+    def _wait_for_shared(self, lock_key, result_key):
+        """
+        Take the shared lock, or wait for the result of the process holding it.
+
+        Returns a (locked, result) tuple: result is the published result if
+        one showed up, locked whether this process now holds the lock.
+        """
+        deadline = time.monotonic() + self.wait_timeout
+        while not self.backend.add(lock_key, 1, self.wait_timeout):
+            if time.monotonic() >= deadline:
+                self._count("shared_wait_timeouts")
+                return False, None
+            time.sleep(self.poll_interval)
+            value = self.backend.get(result_key)
+            if value is not None:
+                return False, value
+        return True, None
+
+    def _count(self, counter):
+        with self._lock:
+            self._counters[counter] += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "shared": self.shared,
+                "in_flight": len(self._calls),
+                **self._counters,
+            }
+
+
+single_flight = SingleFlight.from_settings()
@@ -0,0 +1,57 @@
+import json
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from sanusi.llm.parsing import AnswerParser
+
+DEFAULT_CORPUS = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(__file__))), "llm", "parser_corpus.json"
+)
+
+
+class Command(BaseCommand):
+    help = "Check the LLM answer parser against a corpus of answers and time it"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--corpus",
+            default=DEFAULT_CORPUS,
+            help="JSON list of cases with name, answer and the expected data and repairs.",
+        )
+        parser.add_argument("--iterations", type=int, default=2000)
+
+    def handle(self, *args, **options):
+        try:
+            with open(options["corpus"]) as corpus_file:
+                cases = json.load(corpus_file)
+        except (OSError, ValueError) as e:
+            raise CommandError(f"Could not read the corpus {options['corpus']}: {str(e)}")
+
+        # a parser of its own, so the runs stay out of the process's stats
+        parser = AnswerParser()
+        iterations = options["iterations"]
+        mismatches = 0
+        total = 0.0
+        for case in cases:
+            parsed = parser.parse(case["answer"])
+            matches = parsed.data == case["data"] and parsed.repairs == case["repairs"]
+            mismatches += not matches
+
+            started = time.perf_counter()
+            for _ in range(iterations):
+                parser.parse(case["answer"])
+            per_parse = (time.perf_counter() - started) / iterations
+            total += per_parse
+
+            line = f"{case['name']:<32} {per_parse * 1e6:8.1f} us  repairs={','.join(parsed.repairs) or '-'}"
+            if matches:
+                self.stdout.write(line)
+            else:
+                self.stdout.write(self.style.ERROR(f"{line}  expected {case['repairs']} {case['data']}, got {parsed.data}"))
+
+        summary = f"{len(cases)} answers, {total / max(len(cases), 1) * 1e6:.1f} us per parse on average"
+        if mismatches:
+            raise CommandError(f"{summary}, {mismatches} not parsed as expected")
+        self.stdout.write(self.style.SUCCESS(summary))
@@ -0,0 +1,107 @@
+import csv
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Prefetch, Q
+
+from chat.models import Chat, Message
+from sanusi.analysis.sentiment_analysis import SENTIMENT_LABELS
+from sanusi.analysis.text_classification import train_classifier
+from sanusi.utilities.constants import LLMStage
+
+
+def chat_label_examples(chat, contents):
+    """
+    (task, text, label) examples of a chat's customer messages, in order.
+
+    The local models label one message at a time, so every example is a
+    single message. Chat.sentiment is the label of the latest message. The
+    message that escalated a chat is not recorded, so an escalated chat only
+    labels its latest message, by then escalated to Chat.department, while
+    every message of a chat that was never escalated is a "none" example.
+    """
+    if not contents:
+        return []
+    examples = []
+    if chat.sentiment in SENTIMENT_LABELS:
+        examples.append((LLMStage.SENTIMENT, contents[-1], chat.sentiment))
+    if not chat.escalated:
+        examples.extend((LLMStage.ESCALATION, content, "none") for content in contents)
+    elif chat.department and chat.department.lower() != "none":
+        examples.append((LLMStage.ESCALATION, contents[-1], chat.department.lower()))
+    return examples
+
+
+class Command(BaseCommand):
+    help = "Train the local sentiment/escalation/severity label models from chat history"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--labels-csv",
+            help="Extra labelled examples, a CSV with task,text,label columns. "
+            "Severity is not stored on chats, so it can only be trained from here.",
+        )
+        parser.add_argument(
+            "--tasks",
+            nargs="+",
+            default=[LLMStage.SENTIMENT, LLMStage.ESCALATION, LLMStage.SEVERITY],
+        )
+        parser.add_argument("--min-samples", type=int, default=None)
+
+    def handle(self, *args, **options):
+        examples = defaultdict(lambda: ([], []))
+        self.collect_chat_history(examples)
+        if options["labels_csv"]:
+            self.collect_csv(options["labels_csv"], examples)
+
+        for task in options["tasks"]:
+            texts, labels = examples[task]
+            classifier = train_classifier(
+                task, texts, labels, min_samples=options["min_samples"]
+            )
+            if classifier is None:
+                self.stdout.write(
+                    self.style.WARNING(f"{task}: skipped, {len(texts)} examples")
+                )
+            else:
+                self.stdout.write(
+                    self.style.SUCCESS(
+                        f"{task}: trained on {len(texts)} examples, labels {classifier.labels}"
+                    )
+                )
+
+    def collect_chat_history(self, examples):
+        """
+        Chats with a sentiment, an escalation department or no escalation at
+        all, each labelled customer message being one example.
+        """
+        customer_messages = Prefetch(
+            "messages",
+            queryset=Message.objects.exclude(sender="agent").order_by("sent_time"),
+            to_attr="customer_messages",
+        )
+        chats = (
+            Chat.objects.filter(
+                Q(sentiment__in=SENTIMENT_LABELS)
+                | Q(escalated=False)
+                | ~Q(department__in=["", "none"])
+            )
+            .prefetch_related(customer_messages)
+            .iterator(chunk_size=500)
+        )
+        for chat in chats:
+            contents = [message.content for message in chat.customer_messages]
+            for task, text, label in chat_label_examples(chat, contents):
+                texts, labels = examples[task]
+                texts.append(text)
+                labels.append(label)
+
+    def collect_csv(self, path, examples):
+        try:
+            with open(path, newline="") as csv_file:
+                for row in csv.DictReader(csv_file):
+                    texts, labels = examples[row["task"]]
+                    texts.append(row["text"])
+                    labels.append(row["label"].strip().lower())
+        except (OSError, KeyError) as e:
+            raise CommandError(f"Could not read labels from {path}: {str(e)}")
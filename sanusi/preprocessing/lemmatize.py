@@ -1,8 +1,16 @@
 # preprocessing/lemmatize.py
 
+from functools import lru_cache
+
 from nltk.stem import WordNetLemmatizer
 
+lemmatizer = WordNetLemmatizer()
+
+
+@lru_cache(maxsize=65536)
+def lemmatize_token(token):
+    return lemmatizer.lemmatize(token)
+
 
 def lemmatize_text(tokens):
-    lemmatizer = WordNetLemmatizer()
-    return [lemmatizer.lemmatize(token) for token in tokens]
+    return [lemmatize_token(token) for token in tokens]
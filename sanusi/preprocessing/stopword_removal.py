@@ -1,8 +1,16 @@
 # preprocessing/stopword_removal.py
 
+from functools import lru_cache
+
 from nltk.corpus import stopwords
 
 
+@lru_cache(maxsize=None)
+def english_stopwords():
+    # reading the corpus costs more than filtering a message, do it once
+    return frozenset(stopwords.words("english"))
+
+
 def remove_stopwords(tokens):
-    stop_words = set(stopwords.words("english"))
+    stop_words = english_stopwords()
     return [token for token in tokens if token not in stop_words]
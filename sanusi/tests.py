@@ -0,0 +1,462 @@
+import asyncio
+import datetime
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.test import SimpleTestCase, override_settings
+from openai import error as openai_error
+
+from sanusi.analysis import text_classification
+from sanusi.analysis.text_classification import confident_labels, train_classifier
+from sanusi.llm.parsing import AnswerParser
+from sanusi.llm.ratelimit import RateLimiter, check_settings
+from sanusi.llm.retrieval import KnowledgeBaseIndex, index_entry
+from sanusi.llm.retry import (
+    CircuitBreaker,
+    CircuitOpenError,
+    RetryPolicy,
+    acall_with_retry,
+    call_with_retry,
+)
+from sanusi.llm.semantic_cache import SemanticAnswerCache
+from sanusi.management.commands.train_label_models import chat_label_examples
+from sanusi.utilities import helpers
+from sanusi.utils import invalid_format_fields
+
+PARSER_CORPUS = os.path.join(os.path.dirname(__file__), "llm", "parser_corpus.json")
+
+
+def rate_limiter(rpm=0, tpm=0):
+    return RateLimiter(
+        alias="default",
+        global_limits=(rpm, tpm),
+        company_limits=(0, 0),
+        company_overrides={},
+        max_wait=0,
+        max_concurrency=0,
+    )
+
+
+class RateLimiterTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def used_tokens(self, limiter, admission):
+        return cache.get(limiter._key("global", admission.window, "tokens"))
+
+    def test_settle_refunds_unused_tokens(self):
+        limiter = rate_limiter(tpm=1000)
+        scope, admission = limiter._reserve(limiter.scopes_for(None), 300)
+        self.assertIsNone(scope)
+        self.assertEqual(self.used_tokens(limiter, admission), 300)
+
+        admission.settle({"usage": {"total_tokens": 120}})
+        self.assertEqual(self.used_tokens(limiter, admission), 120)
+
+    def test_settle_against_capped_reservation(self):
+        # a call estimated above the budget only reserves the budget
+        limiter = rate_limiter(tpm=100)
+        scope, admission = limiter._reserve(limiter.scopes_for(None), 500)
+        self.assertIsNone(scope)
+        self.assertEqual(self.used_tokens(limiter, admission), 100)
+
+        admission.settle({"usage": {"total_tokens": 80}})
+        self.assertEqual(self.used_tokens(limiter, admission), 80)
+
+    def test_settle_without_usage_keeps_reservation(self):
+        limiter = rate_limiter(tpm=1000)
+        scope, admission = limiter._reserve(limiter.scopes_for(None), 300)
+        admission.settle({})
+        self.assertEqual(self.used_tokens(limiter, admission), 300)
+
+    def test_rejected_call_undoes_its_reservation(self):
+        limiter = rate_limiter(rpm=1)
+        scopes = limiter.scopes_for(None)
+        self.assertIsNone(limiter._reserve(scopes, 10)[0])
+        scope, admission = limiter._reserve(scopes, 10)
+        self.assertEqual(scope, "global")
+        self.assertIsNone(admission)
+
+    def test_every_attempt_is_admitted(self):
+        limiter = rate_limiter(rpm=10, tpm=1000)
+        attempts = []
+
+        def call():
+            attempts.append(1)
+            if len(attempts) < 3:
+                raise openai_error.ServiceUnavailableError("unavailable")
+            return {"usage": {"total_tokens": 5}}
+
+        call_with_retry(
+            call,
+            policy=RetryPolicy(max_attempts=3, base_delay=0, max_delay=0, budget=1),
+            breaker=CircuitBreaker(failure_rate=1, minimum_calls=100, window=60, open_seconds=60),
+            admit=lambda: limiter.admit({"prompt": "hello", "max_tokens": 10}),
+        )
+        self.assertEqual(len(attempts), 3)
+        self.assertEqual(limiter.stats()["admitted"], 3)
+
+    @override_settings(LLM_RATELIMIT_ENABLED=True, LLM_RATELIMIT_ALIAS="default")
+    def test_refuses_a_per_process_cache(self):
+        with self.assertRaises(ImproperlyConfigured):
+            check_settings()
+        with self.settings(LLM_RATELIMIT_ENABLED=False):
+            check_settings()
+
+
+class SemanticAnswerCacheTests(SimpleTestCase):
+    message = "what are your opening hours"
+    answer = {
+        "response": "Hi Ada Obi, we open at nine. See you soon Ada!",
+        "chat_context": "opening hours",
+        "escalate_issue": False,
+    }
+
+    def setUp(self):
+        cache.clear()
+        self.semantic_cache = SemanticAnswerCache("default", threshold=0.9, max_entries=2, ttl=60, min_words=3)
+
+    def test_answers_are_shared_by_the_customers_of_the_business(self):
+        self.semantic_cache.store("company", "chat", self.message, self.answer, "Ada Obi")
+
+        self.assertEqual(
+            self.semantic_cache.lookup("company", "chat", "what are your opening hours?", "Bob Smith"),
+            {"response": "Hi Bob, we open at nine. See you soon Bob!", "escalate_issue": False},
+        )
+        self.assertIsNone(self.semantic_cache.lookup("other", "chat", self.message, "Bob"))
+        # without a name the answer cannot be addressed to the customer
+        self.assertIsNone(self.semantic_cache.lookup("company", "chat", self.message))
+
+    def test_knowledge_base_change_orphans_the_answers(self):
+        self.semantic_cache.store("company", "chat", self.message, self.answer, "Ada")
+        self.semantic_cache.invalidate("company")
+
+        self.assertIsNone(self.semantic_cache.lookup("company", "chat", self.message, "Ada"))
+
+    def test_store_skips_while_another_store_holds_the_entries(self):
+        key = self.semantic_cache._entries_key("company", "chat")
+        cache.add(f"{key}:lock", 1)
+        self.semantic_cache.store("company", "chat", self.message, self.answer, "Ada")
+
+        self.assertIsNone(cache.get(key))
+        self.assertEqual(self.semantic_cache.stats()["store_conflicts"], 1)
+
+
+class LabelModelTests(SimpleTestCase):
+    texts = [
+        "I was charged twice on my card",
+        "please refund my payment",
+        "my invoice amount is wrong",
+        "the app crashes when I log in",
+        "the website shows an error page",
+        "the login button does not work",
+    ]
+    labels = ["billing"] * 3 + ["engineering"] * 3
+
+    def setUp(self):
+        model_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(model_dir.cleanup)
+        settings_override = override_settings(LABEL_MODEL_DIR=model_dir.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.addCleanup(text_classification._models.clear)
+
+    def test_too_few_samples_or_labels_trains_nothing(self):
+        self.assertIsNone(train_classifier("escalation", self.texts, self.labels, min_samples=10))
+        self.assertIsNone(train_classifier("escalation", self.texts, ["billing"] * 6, min_samples=2))
+        self.assertEqual(confident_labels("refund my payment", ["escalation"], 0.1), {})
+
+    def test_trained_model_labels_a_message(self):
+        classifier = train_classifier("escalation", self.texts * 5, self.labels * 5, min_samples=2)
+
+        self.assertEqual(classifier.labels, ["billing", "engineering"])
+        self.assertEqual(
+            confident_labels("I need a refund for my payment", ["escalation", "sentiment"], 0.5),
+            {"escalation": "billing"},
+        )
+        # below the minimum confidence the label is left to the LLM
+        self.assertEqual(confident_labels("I need a refund", ["escalation"], 0.999), {})
+
+    def test_chat_examples_are_single_messages(self):
+        chat = mock.Mock(sentiment="negative", escalated=False, department="")
+        self.assertEqual(
+            chat_label_examples(chat, ["hi", "my card was charged twice"]),
+            [
+                ("sentiment", "my card was charged twice", "negative"),
+                ("escalation", "hi", "none"),
+                ("escalation", "my card was charged twice", "none"),
+            ],
+        )
+
+        chat = mock.Mock(sentiment="", escalated=True, department="Billing")
+        self.assertEqual(
+            chat_label_examples(chat, ["hi", "my card was charged twice"]),
+            [("escalation", "my card was charged twice", "billing")],
+        )
+        chat = mock.Mock(sentiment="", escalated=True, department="none")
+        self.assertEqual(chat_label_examples(chat, ["hi"]), [])
+
+
+class RunConcurrentlyTests(SimpleTestCase):
+    def test_batch_run_from_a_saturated_pool_does_not_deadlock(self):
+        pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sanusi-call")
+        self.addCleanup(pool.shutdown)
+        with mock.patch.object(helpers, "call_executor", return_value=pool):
+            # the only worker runs a batch of calls that need a worker too
+            outer = pool.submit(helpers.run_concurrently, {"a": lambda: 1, "b": lambda: 2})
+            self.assertEqual(outer.result(timeout=2), {"a": 1, "b": 2})
+
+    def test_failed_and_late_calls_map_to_none(self):
+        results = helpers.run_concurrently(
+            {"ok": lambda: 1, "fails": lambda: 1 / 0, "late": lambda: time.sleep(0.5)},
+            timeout=0.1,
+        )
+        self.assertEqual(results, {"ok": 1, "fails": None, "late": None})
+
+
+class CircuitBreakerTests(SimpleTestCase):
+    def breaker(self):
+        return CircuitBreaker(failure_rate=0.5, minimum_calls=4, window=60, open_seconds=30)
+
+    def open_breaker(self, breaker):
+        for _ in range(4):
+            self.assertTrue(breaker.allow())
+            breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+    def test_stays_closed_below_minimum_calls(self):
+        breaker = self.breaker()
+        for _ in range(3):
+            breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_stays_closed_below_failure_rate(self):
+        breaker = self.breaker()
+        for ok in (True, True, True, False, True, False):
+            if ok:
+                breaker.record_success()
+            else:
+                breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_open_rejects_until_open_seconds_pass(self):
+        breaker = self.breaker()
+        with mock.patch("sanusi.llm.retry.time.monotonic", return_value=100.0):
+            self.open_breaker(breaker)
+            self.assertFalse(breaker.allow())
+        with mock.patch("sanusi.llm.retry.time.monotonic", return_value=131.0):
+            self.assertTrue(breaker.allow())
+            self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+            # one probe at a time
+            self.assertFalse(breaker.allow())
+        self.assertEqual(breaker.stats()["rejected"], 2)
+
+    def test_successful_probe_closes(self):
+        breaker = self.breaker()
+        with mock.patch("sanusi.llm.retry.time.monotonic", return_value=100.0):
+            self.open_breaker(breaker)
+        with mock.patch("sanusi.llm.retry.time.monotonic", return_value=131.0):
+            self.assertTrue(breaker.allow())
+            breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(breaker.allow())
+
+    def test_client_error_probe_keeps_the_breaker_half_open(self):
+        breaker = self.breaker()
+        with mock.patch("sanusi.llm.retry.time.monotonic", return_value=100.0):
+            self.open_breaker(breaker)
+        with mock.patch("sanusi.llm.retry.time.monotonic", return_value=131.0):
+            self.assertTrue(breaker.allow())
+            breaker.record_neutral()
+            self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+            # the next call probes instead
+            self.assertTrue(breaker.allow())
+
+    def test_failed_probe_reopens(self):
+        breaker = self.breaker()
+        with mock.patch("sanusi.llm.retry.time.monotonic", return_value=100.0):
+            self.open_breaker(breaker)
+        with mock.patch("sanusi.llm.retry.time.monotonic", return_value=131.0):
+            self.assertTrue(breaker.allow())
+            breaker.record_failure()
+            self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+            self.assertFalse(breaker.allow())
+        self.assertEqual(breaker.stats()["opened"], 2)
+
+
+class RetryPolicyTests(SimpleTestCase):
+    def test_delay_is_capped_exponential(self):
+        policy = RetryPolicy(max_attempts=5, base_delay=1, max_delay=4, budget=10)
+        with mock.patch("sanusi.llm.retry.random.uniform", side_effect=lambda low, high: high):
+            self.assertEqual([policy.delay(attempt) for attempt in (1, 2, 3, 4)], [1, 2, 4, 4])
+
+    def test_delay_honours_retry_after(self):
+        policy = RetryPolicy(max_attempts=5, base_delay=1, max_delay=4, budget=10)
+        error = openai_error.RateLimitError("slow down", headers={"retry-after": "2"})
+        self.assertEqual(policy.delay(1, error), 2)
+        error = openai_error.RateLimitError("slow down", headers={"retry-after": "60"})
+        self.assertEqual(policy.delay(1, error), 4)
+
+    def call(self, errors, policy, breaker=None):
+        attempts = []
+
+        def call():
+            attempts.append(1)
+            if len(attempts) <= len(errors):
+                raise errors[len(attempts) - 1]
+            return "ok"
+
+        breaker = breaker or CircuitBreaker(failure_rate=1, minimum_calls=100, window=60, open_seconds=60)
+        with mock.patch("sanusi.llm.retry.time.sleep"):
+            return call_with_retry(call, policy=policy, breaker=breaker), len(attempts)
+
+    def test_retries_transient_errors(self):
+        policy = RetryPolicy(max_attempts=3, base_delay=0, max_delay=0, budget=1)
+        errors = [openai_error.Timeout("timeout"), openai_error.APIConnectionError("reset")]
+        self.assertEqual(self.call(errors, policy), ("ok", 3))
+
+    def test_gives_up_after_max_attempts(self):
+        policy = RetryPolicy(max_attempts=2, base_delay=0, max_delay=0, budget=1)
+        errors = [openai_error.Timeout("timeout")] * 3
+        with self.assertRaises(openai_error.Timeout):
+            self.call(errors, policy)
+
+    def test_gives_up_when_the_budget_runs_out(self):
+        policy = RetryPolicy(max_attempts=5, base_delay=1, max_delay=1, budget=1.5)
+        errors = [openai_error.RateLimitError("slow down", headers={"retry-after": "1"})] * 3
+        with self.assertRaises(openai_error.RateLimitError):
+            self.call(errors, policy)
+
+    def test_client_errors_are_not_retried(self):
+        policy = RetryPolicy(max_attempts=3, base_delay=0, max_delay=0, budget=1)
+        breaker = CircuitBreaker(failure_rate=1, minimum_calls=100, window=60, open_seconds=60)
+        with self.assertRaises(openai_error.InvalidRequestError):
+            self.call([openai_error.InvalidRequestError("bad", "prompt")], policy, breaker)
+        # neither a failure nor a success of the provider
+        stats = breaker.stats()
+        self.assertEqual((stats["failures"], stats["successes"], stats["neutral"]), (0, 0, 1))
+        self.assertEqual(stats["window_calls"], 0)
+
+    def test_async_client_errors_leave_the_breaker_alone(self):
+        policy = RetryPolicy(max_attempts=3, base_delay=0, max_delay=0, budget=1)
+        breaker = CircuitBreaker(failure_rate=1, minimum_calls=100, window=60, open_seconds=60)
+
+        async def call():
+            raise openai_error.AuthenticationError("bad key")
+
+        with self.assertRaises(openai_error.AuthenticationError):
+            asyncio.run(acall_with_retry(call, policy=policy, breaker=breaker))
+        stats = breaker.stats()
+        self.assertEqual((stats["failures"], stats["successes"], stats["neutral"]), (0, 0, 1))
+
+    def test_open_breaker_fails_fast(self):
+        policy = RetryPolicy(max_attempts=3, base_delay=0, max_delay=0, budget=1)
+        breaker = CircuitBreaker(failure_rate=0.5, minimum_calls=1, window=60, open_seconds=60)
+        breaker.record_failure()
+        with self.assertRaises(CircuitOpenError):
+            self.call([], policy, breaker)
+
+
+class AnswerParserTests(SimpleTestCase):
+    def test_corpus(self):
+        with open(PARSER_CORPUS) as f:
+            corpus = json.load(f)
+        parser = AnswerParser()
+        for entry in corpus:
+            with self.subTest(entry["name"]):
+                parsed = parser.parse(entry["answer"])
+                self.assertEqual(parsed.data, entry["data"])
+                self.assertEqual(parsed.repairs, entry["repairs"])
+
+    def test_response_must_be_a_string(self):
+        self.assertEqual(invalid_format_fields({"response": ["hello"]}, ["response"]), ["response"])
+        self.assertEqual(invalid_format_fields({"response": None}, ["response"]), ["response"])
+        self.assertEqual(invalid_format_fields({"response": "hello"}, ["response"]), [])
+
+
+def knowledge_base_row(knowledgebase_id, title, content, minute=0, is_company_description=False):
+    last_updated = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc) + datetime.timedelta(
+        minutes=minute
+    )
+    return (knowledgebase_id, title, content, content, is_company_description, last_updated)
+
+
+def built_index(rows):
+    index = KnowledgeBaseIndex()
+    for row in rows:
+        index.put(index_entry(*row))
+    return index
+
+
+class KnowledgeBaseIndexTests(SimpleTestCase):
+    queries = ["refund policy", "shipping times", "opening hours", "red sneakers", "warranty"]
+
+    rows = [
+        knowledge_base_row("1", "About us", "We sell sneakers and boots online.", 0, True),
+        knowledge_base_row("2", "Refunds", "Refunds are paid within five days of the return.", 1),
+        knowledge_base_row("3", "Shipping", "Orders ship within two days, shipping is free.", 2),
+        knowledge_base_row("4", "Hours", "Our store opening hours are nine to five.", 3),
+        knowledge_base_row("5", "Sneakers", "The red sneakers are back in stock.", 4),
+    ]
+
+    def assertSameIndex(self, index, expected):
+        self.assertEqual(len(index), len(expected))
+        self.assertEqual(index.fingerprint, expected.fingerprint)
+        self.assertEqual(index.total_length, expected.total_length)
+        for query in self.queries:
+            with self.subTest(query):
+                ranked = index.search_ids(query, 10)
+                expected_ranked = expected.search_ids(query, 10)
+                self.assertEqual(
+                    sorted(knowledgebase_id for knowledgebase_id, score in ranked),
+                    sorted(knowledgebase_id for knowledgebase_id, score in expected_ranked),
+                )
+                for (_, score), (_, expected_score) in zip(
+                    sorted(ranked), sorted(expected_ranked)
+                ):
+                    self.assertAlmostEqual(score, expected_score)
+
+    def test_apply_matches_rebuild(self):
+        index = built_index(self.rows)
+        changed = [
+            knowledge_base_row("2", "Refunds", "Refunds are paid within ten days, no warranty claims.", 5),
+            knowledge_base_row("6", "Warranty", "Every pair has a two year warranty.", 6),
+        ]
+        # 3 is deleted, 2 replaced and 6 added
+        index.apply(changed, ["2", "3", "6"])
+
+        expected = built_index([self.rows[0], changed[0], self.rows[3], self.rows[4], changed[1]])
+        self.assertSameIndex(index, expected)
+        self.assertEqual(index.search_ids("shipping", 10), [])
+
+    def test_remove_matches_rebuild(self):
+        index = built_index(self.rows)
+        index.remove("4")
+        index.remove("unknown")
+        self.assertSameIndex(index, built_index(self.rows[:3] + self.rows[4:]))
+        self.assertIsNone(index.entries[3])
+
+    def test_compact_matches_rebuild(self):
+        index = built_index(self.rows)
+        index.remove("1")
+        index.remove("3")
+        index.compact()
+
+        expected = built_index([self.rows[1], self.rows[3], self.rows[4]])
+        self.assertSameIndex(index, expected)
+        self.assertEqual(index.live_slots(), [0, 1, 2])
+        self.assertEqual(index.slots, expected.slots)
+        self.assertEqual(index.postings, expected.postings)
+
+    def test_apply_compacts_removed_slots(self):
+        rows = [knowledge_base_row(str(i), f"Entry {i}", f"content number {i}", i) for i in range(40)]
+        index = built_index(rows)
+        index.apply([], [str(i) for i in range(30)])
+        self.assertEqual(len(index.entries), 10)
+        self.assertSameIndex(index, built_index(rows[30:]))
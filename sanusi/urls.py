@@ -1,9 +1,11 @@
 from django.urls import path, include
 
 from .views import (
+    AsyncSanusiMessageChannelView,
     SanusiMessageChannelViewSet,
     get_single_chat_session,
     get_messages,
+    get_llm_stats,
 )
 
 
@@ -13,10 +15,16 @@ urlpatterns = [
         SanusiMessageChannelViewSet.as_view(),
         name="_message_channel",
     ),
+    path(
+        "message/async/",
+        AsyncSanusiMessageChannelView.as_view(),
+        name="_message_channel_async",
+    ),
     path(
         "get-one-message-session/<str:message_id>/",
         get_single_chat_session,
         name="get_single_chat_session",
     ),
     path("get-messages/", get_messages, name="get_messages"),
+    path("llm-stats/", get_llm_stats, name="llm_stats"),
 ]
@@ -0,0 +1,17 @@
+class LLMStage:
+    """
+    Names of the LLM calls made while answering a message, used to tag
+    calls for caching and metrics.
+    """
+
+    RESPONSE = "response"
+    FUSED = "fused"
+    ESCALATION = "escalation"
+    SENTIMENT = "sentiment"
+    SEVERITY = "severity"
+    CHAT_CONTEXT = "chat_context"
+    KB_ROUTING = "kb_routing"
+    CATEGORY = "category"
+    PRODUCT_PICK = "product_pick"
+    KB_CLEANING = "kb_cleaning"
+    RESTRUCTURE = "restructure"
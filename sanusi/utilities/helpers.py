@@ -0,0 +1,200 @@
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextvars import copy_context
+
+import tiktoken
+from django.conf import settings
+from loguru import logger
+
+
+# Seconds a batch run from a call_executor worker waits for the pool to
+# start its calls before running them on the worker itself.
+STEAL_AFTER = 0.05
+
+_executor = None
+_executor_pid = None
+_executor_lock = threading.Lock()
+
+
+def call_executor():
+    """
+    Thread pool shared by every run_concurrently batch of the process,
+    CONCURRENT_CALLS_MAX_WORKERS threads, recreated after a fork.
+    """
+    global _executor, _executor_pid
+
+    pid = os.getpid()
+    with _executor_lock:
+        if _executor is None or _executor_pid != pid:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.CONCURRENT_CALLS_MAX_WORKERS,
+                thread_name_prefix="sanusi-call",
+            )
+            _executor_pid = pid
+        return _executor
+
+
+def in_call_executor():
+    """Whether the current thread is a worker of the call_executor pool."""
+    return threading.current_thread().name.startswith("sanusi-call")
+
+
+def _run_inline(call):
+    future = Future()
+    try:
+        future.set_result(copy_context().run(call))
+    except BaseException as e:
+        future.set_exception(e)
+    return future
+
+
+def run_concurrently(calls, timeout=None, max_workers=None, propagate=()):
+    """
+    Run independent callables together and wait for all of them under one deadline.
+
+    Each call runs in a copy of the caller's context, so context variables
+    such as the current trace span and company_scope carry over to it.
+
+    A batch run from a call_executor worker (e.g. by a pipeline stage) runs
+    the calls no worker has started within STEAL_AFTER seconds on the
+    calling worker, so batches waiting on a saturated pool cannot deadlock it.
+
+    Args:
+        calls (dict): Mapping of name -> zero-argument callable
+        timeout (float): Seconds to wait for the whole batch, None waits forever
+        max_workers (int): Calls of the batch running at once, defaults to all
+        propagate (tuple): Exception types raised to the caller instead of
+            mapping the failed call to None
+
+    Returns:
+        dict: Mapping of name -> result. Calls that raised or missed the
+        deadline map to None.
+    """
+    if not calls:
+        return {}
+
+    executor = call_executor()
+    deadline = None if timeout is None else time.monotonic() + timeout
+    nested = in_call_executor()
+    queued = list(calls.items())
+    limit = max_workers or len(queued)
+    futures = {}
+    running = {}
+    try:
+        while queued or running:
+            while queued and len(running) < limit:
+                name, call = queued.pop(0)
+                futures[name] = executor.submit(copy_context().run, call)
+                running[futures[name]] = (name, call)
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+            wait_for = remaining
+            if nested:
+                wait_for = STEAL_AFTER if remaining is None else min(remaining, STEAL_AFTER)
+            done, _ = wait(running, timeout=wait_for, return_when=FIRST_COMPLETED)
+            for future in done:
+                del running[future]
+            if done:
+                continue
+            if remaining is not None and time.monotonic() >= deadline:
+                break
+            if nested:
+                # a worker waiting on its own pool: run a call no worker has started
+                for future, (name, call) in list(running.items()):
+                    if future.cancel():
+                        del running[future]
+                        futures[name] = _run_inline(call)
+                        break
+
+        results = {}
+        for name in calls:
+            future = futures.get(name)
+            if future is None or not future.done():
+                logger.warning("Concurrent call missed the deadline", call=name)
+                results[name] = None
+                continue
+            try:
+                results[name] = future.result()
+            except propagate:
+                raise
+            except Exception as e:
+                logger.error(f"Concurrent call failed: {str(e)}", call=name)
+                results[name] = None
+        return results
+    finally:
+        # Never block the caller on stragglers, they finish in the background
+        for future in running:
+            future.cancel()
+
+
+async def arun_concurrently(calls, timeout=None, propagate=()):
+    """
+    run_concurrently for coroutine functions: run them as tasks on the
+    running event loop and wait for all of them under one deadline. Calls
+    still running at the deadline are cancelled.
+
+    Args:
+        calls (dict): Mapping of name -> zero-argument coroutine function
+        timeout (float): Seconds to wait for the whole batch, None waits forever
+        propagate (tuple): Exception types raised to the caller instead of
+            mapping the failed call to None
+
+    Returns:
+        dict: Mapping of name -> result. Calls that raised or missed the
+        deadline map to None.
+    """
+    if not calls:
+        return {}
+
+    tasks = {name: asyncio.ensure_future(call()) for name, call in calls.items()}
+    try:
+        done, not_done = await asyncio.wait(tasks.values(), timeout=timeout)
+
+        results = {}
+        for name, task in tasks.items():
+            if task in not_done:
+                logger.warning("Concurrent call missed the deadline", call=name)
+                results[name] = None
+                continue
+            try:
+                results[name] = task.result()
+            except propagate:
+                raise
+            except Exception as e:
+                logger.error(f"Concurrent call failed: {str(e)}", call=name)
+                results[name] = None
+        return results
+    finally:
+        for task in tasks.values():
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled():
+                task.exception()  # retrieved, so asyncio does not log it again
+
+
+_encoding = None
+_encoding_lock = threading.Lock()
+
+
+def count_tokens(text):
+    """
+    Number of tokens text takes in a gpt-3.5-turbo prompt.
+
+    Falls back to the usual ~4 characters per token estimate when the
+    tiktoken encoding cannot be loaded (it is downloaded on first use).
+    """
+    global _encoding
+
+    if _encoding is None:
+        with _encoding_lock:
+            if _encoding is None:
+                try:
+                    _encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
+                except Exception as e:
+                    logger.warning(f"tiktoken unavailable, estimating tokens: {str(e)}")
+                    _encoding = False
+    if _encoding is False:
+        return len(text) // 4 + 1
+    return len(_encoding.encode(text, disallowed_special=()))
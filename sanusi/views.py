@@ -1,8 +1,9 @@
 import requests
 import json
 import ast
-import time
+from functools import partial
 
+from asgiref.sync import sync_to_async
 from django.views.decorators.csrf import csrf_exempt
 from django.conf import settings
 from django.db import transaction
@@ -11,25 +12,50 @@ from django.core.exceptions import ObjectDoesNotExist
 
 from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
-from rest_framework.decorators import api_view
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.permissions import IsAdminUser
 from rest_framework import status, serializers, generics, mixins
 
 import openai
+from loguru import logger
 from llama_index import GPTListIndex, LLMPredictor, PromptHelper, GPTVectorStoreIndex
 from langchain import OpenAI as oai
 
+from .llm.cache import make_cache_key, response_cache
+from .llm.client import get_client
+from .llm.metrics import llm_metrics
+from .llm.parsing import answer_parser
+from .llm.ratelimit import RateLimitExceeded
+from .llm.semantic_cache import semantic_cache
+from .llm.singleflight import single_flight
 from .models import Message, ChannelTypes
 from .serializers import (
     MessageInputSerializer,
     AllMessagesSerializer,
     MessageSerializer,
 )
+from .utils import REQUIRED_RESPONSE_KEYS, normalize_structured_response
+from .utilities.constants import LLMStage
 
+from business.models import CleanedContent
 from business.private.models import KnowledgeBase
+from chat.pipeline import pipeline_metrics
+from sanusi_backend.classes.custom import AsyncAPIView
 
 # Create your views here.
 openai.api_key = settings.OPENAI_KEY
 
+# LLM stage of the per-field completion answering each response field
+FIELD_STAGES = {
+    "response": LLMStage.RESPONSE,
+    "escalate_issue": LLMStage.ESCALATION,
+    "escalation_department": LLMStage.ESCALATION,
+    "severity": LLMStage.SEVERITY,
+    "sentiment": LLMStage.SENTIMENT,
+}
+
+FUSED_FIELDS_PROMPT = 'Answer all of the questions above at once. Return only a JSON object with the keys "response", "escalate_issue", "escalation_department", "severity" and "sentiment", each holding the answer to its question. Use "null" for escalation_department if the issue should not be escalated.'
+
 
 def construct_index(knowledge_base):
     max_input_size = 4096
@@ -62,30 +88,225 @@ def construct_index(knowledge_base):
     return index
 
 
-def generate_response_chat(prompt, max_tokens):
-    response = None
+def chat_completion_params(max_tokens):
+    return dict(
+        model=settings.LLM_CHAT_MODEL,
+        max_tokens=max_tokens,
+        n=1,
+        temperature=0.6,  # adjust as needed
+        frequency_penalty=1.29,
+        presence_penalty=1.02,
+    )
+
+
+def generate_response_chat(prompt, max_tokens, stage=None):
+    """
+    Generate a chat completion for prompt.
+
+    Label-style stages (see LLM_CACHE_TTLS) are answered from the exact-match
+    response cache when the same normalised prompt was seen before, and
+    concurrent identical prompts share one provider call.
+    """
+    params = chat_completion_params(max_tokens)
+    cache_key = make_cache_key(prompt, params)
+    cacheable = response_cache.is_cacheable(stage)
+    if cacheable:
+        cached = response_cache.get(stage, cache_key)
+        if cached is not None:
+            return cached
+
+    try:
+        # transient failures are retried with backoff inside the client, and
+        # identical prompts already in flight are waited on, not re-sent
+        response = single_flight.do(
+            cache_key,
+            partial(
+                get_client().chat_completion, messages=prompt, stage=stage, **params
+            ),
+        )
+    except RateLimitExceeded:
+        raise  # over budget, the caller gets a 429 rather than a degraded answer
+    except Exception as e:
+        logger.warning(f"LLM completion failed after retries: {str(e)}", stage=stage)
+        return Response({"data": "Failed to generate response after retries."})
+
+    if cacheable:
+        response_cache.set(stage, cache_key, response)
+    return response
+
+
+async def agenerate_response_chat(prompt, max_tokens, stage=None):
+    """
+    generate_response_chat for async views: the same caching and coalescing,
+    with the cache read and written off the event loop.
+    """
+    params = chat_completion_params(max_tokens)
+    cache_key = make_cache_key(prompt, params)
+    cacheable = response_cache.is_cacheable(stage)
+    if cacheable:
+        cached = await sync_to_async(response_cache.get, thread_sensitive=False)(
+            stage, cache_key
+        )
+        if cached is not None:
+            return cached
+
+    try:
+        response = await single_flight.ado(
+            cache_key,
+            partial(
+                get_client().achat_completion, messages=prompt, stage=stage, **params
+            ),
+        )
+    except RateLimitExceeded:
+        raise
+    except Exception as e:
+        logger.warning(f"LLM completion failed after retries: {str(e)}", stage=stage)
+        return Response({"data": "Failed to generate response after retries."})
+
+    if cacheable:
+        await sync_to_async(response_cache.set, thread_sensitive=False)(
+            stage, cache_key, response
+        )
+    return response
+
+
+def stream_response_chat(prompt, max_tokens, stage=LLMStage.RESPONSE):
+    """
+    Yield the text of a chat completion for prompt as it is generated.
+
+    Failing to start the stream raises like any other call; the retry policy
+    only covers opening the stream, not a stream that breaks halfway.
+    """
+    chunks = get_client().chat_completion(
+        messages=prompt, stream=True, stage=stage, **chat_completion_params(max_tokens)
+    )
+    for chunk in chunks:
+        content = chunk["choices"][0].get("delta", {}).get("content")
+        if content:
+            yield content
+
+
+async def astream_response_chat(prompt, max_tokens, stage=LLMStage.RESPONSE):
+    """stream_response_chat for async views."""
+    chunks = await get_client().achat_completion(
+        messages=prompt, stream=True, stage=stage, **chat_completion_params(max_tokens)
+    )
+    async for chunk in chunks:
+        content = chunk["choices"][0].get("delta", {}).get("content")
+        if content:
+            yield content
+
+
+def generate_structured_response(prompt, max_tokens, fields=REQUIRED_RESPONSE_KEYS):
+    """
+    Generate a reply and its labels with a single structured-output chat completion.
+
+    The prompt must ask for one JSON object; the answer is parsed, normalised
+    and then validated field by field against the is_valid_format rules.
+
+    Parameters:
+    - prompt: The chat messages, ending with the JSON format instructions and the user's message.
+    - max_tokens: The maximum number of tokens to generate for the whole object.
+    - fields: The fields the object must contain.
+
+    Returns: A tuple of the parsed dictionary and the list of fields that are missing or invalid.
+    """
+    response = generate_response_chat(prompt, max_tokens, stage=LLMStage.FUSED)
+    return parse_structured_response(response, fields)
+
+
+async def agenerate_structured_response(prompt, max_tokens, fields=REQUIRED_RESPONSE_KEYS):
+    """generate_structured_response for async views."""
+    response = await agenerate_response_chat(prompt, max_tokens, stage=LLMStage.FUSED)
+    return parse_structured_response(response, fields)
+
+
+def parse_structured_response(response, fields):
+    try:
+        answer = response["choices"][0]["message"]["content"]
+    except (KeyError, IndexError, TypeError):
+        return {}, list(fields)
+
+    parsed = answer_parser.parse(answer, fields)
+    return normalize_structured_response(parsed.data) or {}, parsed.invalid_fields
+
+
+def _complete_field(prompt_text, params, stage=None):
+    response_text = ""
+    max_retries = 3
     retries = 0
-    while retries < 3:
+    while not response_text and retries < max_retries:
+        retries += 1
         try:
-            response = openai.ChatCompletion.create(
-                model="gpt-3.5-turbo-16k",
-                messages=prompt,
-                max_tokens=max_tokens,
-                n=1,
-                temperature=0.6,  # adjust as needed
-                frequency_penalty=1.29,
-                presence_penalty=1.02,
+            response = get_client().completion(
+                engine=settings.LLM_COMPLETION_MODEL,
+                prompt=prompt_text,
+                max_tokens=250,  # adjust as needed
+                stage=stage,
+                **params,
             )
-            break
+        except RateLimitExceeded:
+            raise
         except Exception as e:
-            print(f"Error: {str(e)}. Retrying in 3 seconds...")
-            time.sleep(3)
-            retries += 1
+            # the client already retried transient failures
+            logger.warning(f"LLM field completion failed after retries: {str(e)}", stage=stage)
+            break
+        response_text = response.choices[0].text.strip()
+        if not response_text:
+            logger.debug("Empty field completion, retrying", stage=stage, attempt=retries, max_retries=max_retries)
+    return response_text
 
-    if response is None:
-        return Response({"data": "Failed to generate response after double retries."})
 
-    return response
+def _complete_fused_fields(context, field_prompts, params):
+    """
+    Ask every field question in one completion and keep the fields that validate.
+    """
+    prompt_text = "\n".join([context, *field_prompts, FUSED_FIELDS_PROMPT])
+    try:
+        response = get_client().completion(
+            engine=settings.LLM_COMPLETION_MODEL,
+            prompt=prompt_text,
+            max_tokens=400,
+            stage=LLMStage.FUSED,
+            **params,
+        )
+        answer = response.choices[0].text.strip()
+    except RateLimitExceeded:
+        raise
+    except Exception as e:
+        logger.warning(f"Fused completion failed, falling back to one call per field: {str(e)}")
+        return {}
+
+    parsed = answer_parser.parse(answer)
+    data = normalize_structured_response(parsed.data)
+    return {
+        field: str(data[field])
+        for field in REQUIRED_RESPONSE_KEYS
+        if field not in parsed.invalid_fields
+    }
+
+
+def generate_field_responses(prompt, field_prompts, params):
+    """
+    Answer each field prompt (response, escalate_issue, escalation_department,
+    severity, sentiment) about the conversation in prompt.
+
+    In "fused" execution mode all fields are requested in a single call and
+    only the fields that fail validation are asked for again one by one.
+    """
+    context = "\n".join([message["content"] for message in prompt])
+    fused = {}
+    if settings.AUTO_RESPONSE_EXECUTION_MODE == "fused":
+        fused = _complete_fused_fields(context, field_prompts, params)
+
+    responses = []
+    for field, field_prompt in zip(REQUIRED_RESPONSE_KEYS, field_prompts):
+        response_text = fused.get(field) or _complete_field(
+            context + "\n" + field_prompt, params, stage=FIELD_STAGES[field]
+        )
+        if response_text.strip():
+            responses.append(response_text)
+    return responses
 
 
 def generate_response_chat_v2(prompt):
@@ -96,60 +317,52 @@ def generate_response_chat_v2(prompt):
         'Type the severity of the issue using only one word: "low", "medium", or "high".',
         'Type the sentiment of the user\'s message using only one word: "positive", "negative", or "neutral".',
     ]
-    responses = []
-    for field_prompt in field_prompts:
-        prompt_text = (
-            "\n".join([message["content"] for message in prompt]) + "\n" + field_prompt
-        )
-        response_text = ""
-        max_retries = 3
-        retries = 0
-        while not response_text.strip() and retries < max_retries:
-            try:
-                response = openai.Completion.create(
-                    engine="text-davinci-003",
-                    prompt=prompt_text,
-                    max_tokens=250,  # adjust as needed
-                    temperature=0.4,  # adjust as needed
-                    frequency_penalty=0.3,
-                    presence_penalty=0.7,
-                )
-                response_text = response.choices[0].text.strip()
-                if response_text.strip():
-                    responses.append(response_text)
-                else:
-                    print(f"Empty response received. Retrying {retries+1}/3...")
-                    retries += 1
-            except Exception as e:
-                print(f"Error: {str(e)}. Retrying in 3 seconds...")
-                time.sleep(3)
-    return responses
+    return generate_field_responses(
+        prompt,
+        field_prompts,
+        dict(
+            temperature=0.4,  # adjust as needed
+            frequency_penalty=0.3,
+            presence_penalty=0.7,
+        ),
+    )
 
 
-def generate_response_email(prompt):
-    response = None
-    retries = 0
-    prompt_text = ", ".join([i for i in prompt])
+def email_completion_params(prompt):
+    return dict(
+        model=settings.LLM_COMPLETION_MODEL,
+        prompt=", ".join([i for i in prompt]),
+        max_tokens=250,
+        n=1,
+        temperature=0.6,  # adjust as needed
+        frequency_penalty=1.29,
+        presence_penalty=1.02,
+    )
+
+
+def generate_response_email(prompt, stage=LLMStage.RESPONSE):
+    try:
+        response = get_client().completion(stage=stage, **email_completion_params(prompt))
+    except RateLimitExceeded:
+        raise
+    except Exception as e:
+        logger.warning(f"LLM completion failed after retries: {str(e)}", stage=stage)
+        return Response({"data": "Failed to generate response after retries."})
+
+    return response
 
-    while retries < 3:
-        try:
-            response = openai.Completion.create(
-                model="text-davinci-003",
-                prompt=prompt_text,
-                max_tokens=250,
-                n=1,
-                temperature=0.6,  # adjust as needed
-                frequency_penalty=1.29,
-                presence_penalty=1.02,
-            )
-            break
-        except Exception as e:
-            print(f"Error: {str(e)}. Retrying in 3 seconds...")
-            time.sleep(3)
-            retries += 1
 
-    if response is None:
-        return Response({"data": "Failed to generate response after double retries."})
+async def agenerate_response_email(prompt, stage=LLMStage.RESPONSE):
+    """generate_response_email for async views."""
+    try:
+        response = await get_client().acompletion(
+            stage=stage, **email_completion_params(prompt)
+        )
+    except RateLimitExceeded:
+        raise
+    except Exception as e:
+        logger.warning(f"LLM completion failed after retries: {str(e)}", stage=stage)
+        return Response({"data": "Failed to generate response after retries."})
 
     return response
 
@@ -162,34 +375,15 @@ def generate_response_email_v2(prompt):
         'Type the severity of the issue using only one word: "low", "medium", or "high".',
         'Type the sentiment of the user\'s message using only one word: "positive", "negative", or "neutral".',
     ]
-    responses = []
-    for field_prompt in field_prompts:
-        prompt_text = (
-            "\n".join([message["content"] for message in prompt]) + "\n" + field_prompt
-        )
-        response_text = ""
-        max_retries = 3
-        retries = 0
-        while not response_text.strip() and retries < max_retries:
-            try:
-                response = openai.Completion.create(
-                    engine="text-davinci-003",
-                    prompt=prompt_text,
-                    max_tokens=250,  # adjust as needed
-                    temperature=0.0,  # adjust as needed
-                    frequency_penalty=0,
-                    presence_penalty=0,
-                )
-                response_text = response.choices[0].text.strip()
-                if response_text.strip():
-                    responses.append(response_text)
-                else:
-                    print(f"Empty response received. Retrying {retries+1}/3...")
-                    retries += 1
-            except Exception as e:
-                print(f"Error: {str(e)}. Retrying in 3 seconds...")
-                time.sleep(3)
-    return responses
+    return generate_field_responses(
+        prompt,
+        field_prompts,
+        dict(
+            temperature=0.0,  # adjust as needed
+            frequency_penalty=0,
+            presence_penalty=0,
+        ),
+    )
 
     # if type(response["choices"][0]["message"]["content"]) is not dict:
     #     data = response["choices"][0]["message"]["content"]
@@ -215,11 +409,12 @@ def generate_response(prompt, tokens=200, temperature=0.5):
 
     Returns: A string which is the AI's response.
     """
-    response = openai.Completion.create(
+    response = get_client().completion(
         engine="text-davinci-002",
         prompt=prompt,
         max_tokens=tokens,
         temperature=temperature,
+        stage=LLMStage.RESPONSE,
     )
     return response.choices[0].text.strip()
 
@@ -248,6 +443,79 @@ def structure_response(
     }
 
 
+def channel_message_prompt(data):
+    """
+    Look up the message a channel message continues and build the prompt
+    answering it, from its knowledge base or the one sent along.
+
+    Returns: A tuple of the existing message, or None for a new one, and the prompt.
+    """
+    message = data["message"]
+    knowledge_base_prompt = data.get("knowledge_base")
+    knowledge_id = data.get("knowledge_id")
+    instructions = data.get("instructions")
+
+    try:
+        message_obj = Message.objects.get(message_id=data["message_id"])
+    except ObjectDoesNotExist:
+        if not knowledge_base_prompt:
+            raise serializers.ValidationError("Invalid request data")
+
+        prompt = [
+            {"role": "assistant", "content": f"{knowledge_base_prompt}\nQ:{message}\nA:"},
+            {"role": "user", "content": message},
+        ]
+        return None, prompt
+
+    if not knowledge_base_prompt:
+        return message_obj, [{"role": "user", "content": message}]
+
+    if not knowledge_id:
+        raise serializers.ValidationError("Invalid request data")
+
+    try:
+        knowledge_base = KnowledgeBase.objects.get(id=knowledge_id)
+    except KnowledgeBase.DoesNotExist:
+        raise serializers.ValidationError("Knowledge base not found")
+
+    prompt = [
+        {
+            "role": "assistant",
+            "content": f"Knowledge base:{knowledge_base.content} Instructions: {instructions} Q:{message}\nA:",
+        },
+        {
+            "role": "user",
+            "content": message,
+        },
+    ]
+    return message_obj, prompt
+
+
+def save_channel_message(message_obj, data, response):
+    """Record the exchange on the message, creating it if it is new."""
+    message = data["message"]
+    content = response["choices"][0]["message"]["content"]
+    chat_session = [
+        {"role": "user", "content": message},
+        {"role": "assistant", "content": content},
+    ]
+
+    if message_obj:
+        message_obj.chat_session = chat_session
+        message_obj.sanusi_response = content
+        message_obj.save()
+    else:
+        Message.objects.create(
+            message_id=data["message_id"],
+            message_content=message,
+            sanusi_response=content,
+            sender_email="",
+            chat_session=chat_session,
+            channel=data["channel"],
+        )
+    return content
+
+
 class SanusiMessageChannelViewSet(mixins.CreateModelMixin, generics.GenericAPIView):
     serializer_class = MessageInputSerializer
 
@@ -256,84 +524,29 @@ class SanusiMessageChannelViewSet(mixins.CreateModelMixin, generics.GenericAPIVi
         serializer.is_valid(raise_exception=True)
         data = serializer.validated_data
 
-        # name = data.get("name")
-        message = data["message"]
-        channel = data["channel"]
-        knowledge_base_prompt = data.get("knowledge_base")
-        business_id = data.get("business_id")
-        knowledge_id = data.get("knowledge_id")
-        instructions = data.get("instructions")
+        message_obj, prompt = channel_message_prompt(data)
+        response = generate_response_chat(prompt, 300)
+        content = save_channel_message(message_obj, data, response)
+        return Response({"response": content}, status=status.HTTP_201_CREATED)
 
-        try:
-            message_obj = Message.objects.get(message_id=data["message_id"])
-            if not knowledge_base_prompt and message_obj:
-                knowledge_base = message_obj.business.business_kb.first()
-                prompt = [
-                    {
-                        "role": "user",
-                        "content": message,
-                    }
-                ]
-                response = generate_response_chat(prompt)
-            else:
-                if not knowledge_id:
-                    raise serializers.ValidationError("Invalid request data")
-
-                try:
-                    knowledge_base = KnowledgeBase.objects.get(id=knowledge_id)
-                except KnowledgeBase.DoesNotExist:
-                    raise serializers.ValidationError("Knowledge base not found")
-
-                prompt = [
-                    {
-                        "role": "assistant",
-                        "content": f"Knowledge base:{knowledge_base.content} Instructions: {instructions} Q:{message}\nA:",
-                    },
-                    {
-                        "role": "user",
-                        "content": message,
-                    },
-                ]
-                response = generate_response_chat(prompt)
-                conversation_id = response["id"]
-        except ObjectDoesNotExist:
-            if not knowledge_base_prompt:
-                raise serializers.ValidationError("Invalid request data")
-
-            knowledge_base = knowledge_base_prompt
-            prompt = [
-                {"role": "assistant", "content": f"{knowledge_base}\nQ:{message}\nA:"},
-                {"role": "user", "content": message},
-            ]
-
-            response = generate_response_chat(prompt)
-
-        chat_session = [
-            {"role": "user", "content": message},
-            {
-                "role": "assistant",
-                "content": response["choices"][0]["message"]["content"],
-            },
-        ]
 
-        if message_obj:
-            message_obj.chat_session = chat_session
-            message_obj.sanusi_response = chat_session[-1]["content"]
-            message_obj.save()
-        else:
-            Message.objects.create(
-                business_id=business_id,
-                message_id=data["message_id"],
-                message_content=message,
-                sanusi_response=chat_session[-1]["content"],
-                sender_email="",
-                chat_session=chat_session,
-                channel=channel,
-            )
+class AsyncSanusiMessageChannelView(AsyncAPIView):
+    """
+    SanusiMessageChannelViewSet for ASGI deployments: the completion is
+    awaited on the event loop instead of holding a worker thread.
+    """
 
-        return Response(
-            {"response": chat_session[-1]["content"]}, status=status.HTTP_201_CREATED
-        )
+    serializer_class = MessageInputSerializer
+
+    async def post(self, request, *args, **kwargs):
+        serializer = self.serializer_class(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        data = serializer.validated_data
+
+        message_obj, prompt = await sync_to_async(channel_message_prompt)(data)
+        response = await agenerate_response_chat(prompt, 300)
+        content = await sync_to_async(save_channel_message)(message_obj, data, response)
+        return Response({"response": content}, status=status.HTTP_201_CREATED)
 
 
 @csrf_exempt
@@ -356,3 +569,32 @@ def get_messages(request):
     messages = Message.objects.all()
     serializer = AllMessagesSerializer(messages, many=True)
     return Response(serializer.data)
+
+
+@api_view(["GET"])
+@permission_classes([IsAdminUser])
+def get_llm_stats(request):
+    """
+    Counters of the LLM layer for this worker process.
+
+    "usage" holds the calls, tokens, retries, latency and estimated cost per
+    stage and per business; pass company_id to get a single business's.
+    "pipelines" holds the runs, cache hits and timings of each auto response
+    pipeline stage and "parsing" how often answers needed repairs to parse.
+    "kb_cleaning" holds the knowledge base cleanings served from the
+    cleaning store instead of the LLM, across all workers.
+    """
+    company_id = request.query_params.get("company_id")
+    return Response(
+        {
+            "usage": llm_metrics.stats(company_id),
+            "cache": response_cache.stats(),
+            "semantic_cache": semantic_cache.stats(),
+            "circuit_breaker": get_client().breaker.stats(),
+            "rate_limit": get_client().limiter.stats(),
+            "single_flight": single_flight.stats(),
+            "pipelines": pipeline_metrics.stats(),
+            "parsing": answer_parser.stats(),
+            "kb_cleaning": CleanedContent.stats(),
+        }
+    )
@@ -9,8 +9,13 @@ https://docs.djangoproject.com/en/4.1/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'sanusi_backend.settings')
 
-application = get_asgi_application()
+django.setup(set_prefix=False)
+
+# streams the async auto response events (see AsyncStreamingHttpResponse)
+from sanusi_backend.classes.custom import StreamingASGIHandler  # noqa: E402
+
+application = StreamingASGIHandler()
@@ -1,10 +1,10 @@
-# import os
-# from celery import Celery
+import os
+from celery import Celery
 
-# os.environ.setdefault("DJANGO_SETTINGS_MODULE", "sanusi_backend.settings")
-# app = Celery("sanusi_backend")
-# app.config_from_object("django.conf:settings", namespace="CELERY")
-# app.autodiscover_tasks()
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "sanusi_backend.settings")
+app = Celery("sanusi_backend")
+app.config_from_object("django.conf:settings", namespace="CELERY")
+app.autodiscover_tasks()
 
 
 # import os
@@ -1,5 +1,14 @@
 
+import asyncio
+import json
+
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIHandler
+from django.db import transaction
+from django.http import StreamingHttpResponse
 from rest_framework.pagination import PageNumberPagination
+from rest_framework.renderers import BaseRenderer
+from rest_framework.views import APIView
 from django_filters import FilterSet, CharFilter, DateTimeFilter, NumberFilter
 
 # Custom Pagination Class
@@ -38,4 +47,100 @@ class BaseSearchFilter(FilterSet):
             field_name=relation_path, 
             lookup_expr=lookup_expr
         )
-        cls._meta.fields.append(field_name)
\ No newline at end of file
+        cls._meta.fields.append(field_name)
+
+
+# Lets views answer "Accept: text/event-stream" requests with a
+# StreamingHttpResponse; anything else they return is rendered as JSON.
+class EventStreamRenderer(BaseRenderer):
+    media_type = "text/event-stream"
+    format = "event-stream"
+    charset = "utf-8"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return json.dumps(data)
+
+
+# StreamingHttpResponse of an async iterator. Django 4.1 only streams sync
+# iterators, and under ASGI it iterates them on the event loop, so this one
+# is sent by StreamingASGIHandler and cannot be served over WSGI.
+class AsyncStreamingHttpResponse(StreamingHttpResponse):
+    is_async = True
+
+    def _set_streaming_content(self, value):
+        self._iterator = value
+
+    def __iter__(self):
+        raise TypeError("AsyncStreamingHttpResponse is only served by StreamingASGIHandler")
+
+    async def __aiter__(self):
+        try:
+            async for part in self._iterator:
+                yield self.make_bytes(part)
+        finally:
+            if hasattr(self._iterator, "aclose"):
+                await self._iterator.aclose()
+
+
+# ASGIHandler that also sends AsyncStreamingHttpResponse, each part as soon
+# as its iterator produces it.
+class StreamingASGIHandler(ASGIHandler):
+    async def send_response(self, response, send):
+        if not getattr(response, "is_async", False):
+            return await super().send_response(response, send)
+
+        headers = [
+            (
+                header.encode("ascii") if isinstance(header, str) else bytes(header),
+                value.encode("latin1") if isinstance(value, str) else bytes(value),
+            )
+            for header, value in response.items()
+        ]
+        headers += [
+            (b"Set-Cookie", cookie.output(header="").encode("ascii").strip())
+            for cookie in response.cookies.values()
+        ]
+        await send({"type": "http.response.start", "status": response.status_code, "headers": headers})
+        parts = response.__aiter__()
+        try:
+            async for part in parts:
+                for chunk, _ in self.chunk_bytes(part):
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        finally:
+            await parts.aclose()
+        await send({"type": "http.response.body"})
+
+
+# APIView whose handlers are coroutines (async def post(...)), so Django
+# serves it as an async view: under ASGI a request waiting on the LLM does
+# not hold a worker thread. Authentication, permissions and throttling
+# run off the event loop since they may hit the database.
+class AsyncAPIView(APIView):
+    @classmethod
+    def as_view(cls, **initkwargs):
+        # ATOMIC_REQUESTS cannot wrap a coroutine, handlers open their own transactions
+        return transaction.non_atomic_requests(super().as_view(**initkwargs))
+
+    async def dispatch(self, request, *args, **kwargs):
+        self.args = args
+        self.kwargs = kwargs
+        request = self.initialize_request(request, *args, **kwargs)
+        self.request = request
+        self.headers = self.default_response_headers
+
+        try:
+            await sync_to_async(self.initial)(request, *args, **kwargs)
+            if request.method.lower() in self.http_method_names:
+                handler = getattr(
+                    self, request.method.lower(), self.http_method_not_allowed
+                )
+            else:
+                handler = self.http_method_not_allowed
+            response = handler(request, *args, **kwargs)
+            if asyncio.iscoroutine(response):
+                response = await response
+        except Exception as exc:
+            response = self.handle_exception(exc)
+
+        self.response = self.finalize_response(request, response, *args, **kwargs)
+        return self.response
@@ -92,6 +92,7 @@ combine_router.registry.extend(accounts_router.registry)
 urlpatterns = [
     path("admin/", admin.site.urls),
     path("api/sanusi/", include("sanusi.urls")),
+    path("api/", include("chat.urls")),
     path("api/", include(combine_router.urls)),
     # path("", include("frontend.urls")),
 ]